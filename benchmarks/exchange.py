@@ -0,0 +1,238 @@
+# benchmarks/exchange.py
+"""Бенчмарк горячих путей обменника.
+
+Апдейты прогоняются через настоящий Dispatcher из main.py (все роутеры и
+middleware), бот работает через FakeSession, а OnlyPays и CoinGecko
+подменены локальной заглушкой. База - временный SQLite-файл.
+
+Запуск из корня проекта:
+    python -m benchmarks.exchange --users 50 --concurrency 10
+    python -m benchmarks.exchange --scenarios calculator,buy --api-latency 0.05 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from benchmarks.fakes import ExternalApiStub, FakeSession, UpdateFactory, free_port
+from benchmarks.stats import ScenarioResult, format_table
+
+BTC_ADDRESS = 'bc1qar0srrr7xfkvy5l643lydnw9re59gtzzwf5mdq'
+
+
+def configure_environment(workdir: str, api_port: int):
+    """Окружение задается до импорта config и обработчиков"""
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCHMARK',
+        'DATABASE_URL': os.path.join(workdir, 'bench.db'),
+        'ONLYPAYS_BASE_URL': f'http://127.0.0.1:{api_port}',
+        'COINGECKO_API_URL': f'http://127.0.0.1:{api_port}/api/v3',
+        'ONLYPAYS_API_ID': 'bench',
+        'ONLYPAYS_SECRET_KEY': 'bench',
+        'CAPTCHA_ENABLED': 'true',
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'ADMIN_USER_ID': '1',
+    })
+
+
+class ExchangeBenchmark:
+    def __init__(self, users: int, concurrency: int, tg_latency: float):
+        import main
+        from aiogram import Bot
+        from database.models import Database
+        from config import config
+        
+        self.dp = main.dp
+        self.session = FakeSession(latency=tg_latency)
+        self.bot = Bot(config.BOT_TOKEN, session=self.session)
+        self.db = Database(config.DATABASE_URL)
+        self.updates = UpdateFactory()
+        self.users = users
+        self.concurrency = concurrency
+        self._next_user_id = 10_000
+
+    def new_user_ids(self) -> List[int]:
+        start = self._next_user_id
+        self._next_user_id += self.users
+        return list(range(start, start + self.users))
+
+    async def feed(self, result: ScenarioResult, update):
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            result.add_error(e)
+        result.latencies.append(time.perf_counter() - started)
+
+    async def run_users(self, name: str, flow: Callable[[ScenarioResult, int], Awaitable[None]]) -> ScenarioResult:
+        result = ScenarioResult(name)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(user_id: int):
+            async with semaphore:
+                await flow(result, user_id)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(run(user_id) for user_id in self.new_user_ids()))
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    async def start_captcha_flow(self, result: ScenarioResult, user_id: int):
+        await self.feed(result, self.updates.message(user_id, '/start'))
+        session = await self.db.get_captcha_session(user_id)
+        answer = session['answer'] if session else 'XXXX'
+        await self.feed(result, self.updates.message(user_id, answer))
+
+    async def register(self, user_id: int):
+        await self.db.add_user(user_id, f'user{user_id}', f'User{user_id}')
+
+    async def calculator_flow(self, result: ScenarioResult, user_id: int):
+        await self.register(user_id)
+        amount = random.choice(['1000', '5000', '10000', '50000'])
+        for update in (
+            self.updates.message(user_id, 'Калькулятор валют'),
+            self.updates.callback(user_id, 'calc_rub_btc'),
+            self.updates.callback(user_id, f'calc_amount_rub_btc_{amount}'),
+            self.updates.callback(user_id, 'calc_btc_rub'),
+            self.updates.callback(user_id, 'calc_amount_btc_rub_0.01'),
+        ):
+            await self.feed(result, update)
+
+    async def buy_flow(self, result: ScenarioResult, user_id: int):
+        """Покупка через меню: сумма, адрес, способ оплаты (OnlyPays get_requisite), проверка статуса"""
+        await self.register(user_id)
+        amount = str(random.randint(2, 50) * 1000)
+        for update in (
+            self.updates.message(user_id, '₽ → ₿ Рубли в Bitcoin'),
+            self.updates.message(user_id, amount),
+            self.updates.message(user_id, BTC_ADDRESS),
+            self.updates.message(user_id, '💳 Банковская карта'),
+            self.updates.message(user_id, '🔄 Проверить статус'),
+        ):
+            await self.feed(result, update)
+
+    async def buy_inline_flow(self, result: ScenarioResult, user_id: int):
+        """Покупка через inline-кнопки до создания и подтверждения заявки"""
+        await self.register(user_id)
+        for update in (
+            self.updates.message(user_id, 'Купить'),
+            self.updates.callback(user_id, 'buy_btc'),
+            self.updates.callback(user_id, 'amount_btc_rub_to_crypto_5000'),
+            self.updates.callback(user_id, 'payment_btc_rub_to_crypto_5000.0_card'),
+            self.updates.message(user_id, BTC_ADDRESS),
+        ):
+            await self.feed(result, update)
+        confirm = self.session.find_callback(user_id, 'confirm_order_')
+        if confirm:
+            await self.feed(result, self.updates.callback(user_id, confirm))
+
+    async def webhook_burst(self) -> ScenarioResult:
+        """Пачка уведомлений OnlyPays: каждое 'finished' приходит дважды одновременно"""
+        from handlers.operator import process_onlypays_webhook
+        
+        order_ids = []
+        for user_id in self.new_user_ids():
+            await self.register(user_id)
+            order_id = await self.db.create_order(user_id, 5000, 0.0008, BTC_ADDRESS, 6500000, 6250, 'card')
+            await self.db.update_order(order_id, onlypays_id=f'bench-{order_id}', personal_id=f'bench-{order_id}')
+            order_ids.append(order_id)
+        
+        result = ScenarioResult('webhook_burst')
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(order_id: int):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await process_onlypays_webhook({
+                        'id': f'bench-{order_id}',
+                        'status': 'finished',
+                        'personal_id': str(order_id),
+                        'received_sum': 6250,
+                    })
+                except Exception as e:
+                    result.add_error(e)
+                result.latencies.append(time.perf_counter() - started)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(deliver(order_id) for order_id in order_ids * 2))
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    async def run(self, scenarios: List[str]) -> List[ScenarioResult]:
+        await self.db.init_db()
+        flows = {
+            'start_captcha': self.start_captcha_flow,
+            'calculator': self.calculator_flow,
+            'buy': self.buy_flow,
+            'buy_inline': self.buy_inline_flow,
+        }
+        results = []
+        for name in scenarios:
+            if name == 'webhook_burst':
+                results.append(await self.webhook_burst())
+            else:
+                results.append(await self.run_users(name, flows[name]))
+        return results
+
+
+SCENARIOS = ['start_captcha', 'calculator', 'buy', 'buy_inline', 'webhook_burst']
+
+
+async def main(args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory(prefix='oswbit-bench-') as workdir:
+        api_port = free_port()
+        configure_environment(workdir, api_port)
+        
+        stub = ExternalApiStub(latency=args.api_latency)
+        await stub.start(api_port)
+        benchmark = ExchangeBenchmark(args.users, args.concurrency, args.tg_latency)
+        try:
+            results = await benchmark.run(args.scenarios)
+        finally:
+            await stub.stop()
+            await benchmark.bot.session.close()
+    
+    return {
+        'results': [result.as_dict() for result in results],
+        'errors': {result.name: dict(result.error_types) for result in results if result.errors},
+        'telegram_calls': dict(benchmark.session.calls),
+        'api_calls': dict(stub.calls),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Exchange hot path benchmark')
+    parser.add_argument('--users', type=int, default=50, help='virtual users per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='users processed at once')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        type=lambda value: [name for name in value.split(',') if name],
+                        help=f'comma separated: {",".join(SCENARIOS)}')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='OnlyPays/CoinGecko stub delay, s')
+    parser.add_argument('--tg-latency', type=float, default=0.0, help='Telegram fake session delay, s')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    report = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(format_table(report['results']))
+        if report['errors']:
+            print(f"\nErrors: {report['errors']}")
+        print(f"\nTelegram calls: {report['telegram_calls']}")
+        print(f"API calls: {report['api_calls']}")
@@ -0,0 +1,176 @@
+# benchmarks/fakes.py
+"""Подмены внешнего мира для бенчмарков: сессия Telegram без сети и заглушки OnlyPays/CoinGecko"""
+import asyncio
+import itertools
+import json
+import socket
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiohttp import web
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeSession(BaseSession):
+    """Сессия бота, отвечающая как Telegram, но без сети.
+    
+    Запрос сериализуется и ответ разбирается теми же средствами aiogram,
+    что и в настоящей сессии, поэтому их стоимость попадает в замеры.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.last_markup: Dict[int, Any] = {}
+        self._message_ids = itertools.count(1)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b''
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        files: Dict[str, Any] = {}
+        for key, value in method.model_dump(warnings=False).items():
+            self.prepare_value(value, bot=bot, files=files)
+        self.calls[type(method).__name__] += 1
+        
+        chat_id = getattr(method, 'chat_id', None)
+        markup = getattr(method, 'reply_markup', None)
+        if chat_id is not None and markup is not None:
+            self.last_markup[chat_id] = markup
+        
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if method.__returning__ is bool:
+            result: Any = True
+        else:
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id or 0, 'type': 'private'},
+                'text': getattr(method, 'text', None) or getattr(method, 'caption', None) or '',
+            }
+        response = self.check_response(bot, method, 200, json.dumps({'ok': True, 'result': result}))
+        return response.result
+
+    def find_callback(self, chat_id: int, prefix: str) -> Optional[str]:
+        """callback_data первой кнопки с префиксом в последней отправленной клавиатуре чата"""
+        markup = self.last_markup.get(chat_id)
+        for row in getattr(markup, 'inline_keyboard', None) or []:
+            for button in row:
+                if button.callback_data and button.callback_data.startswith(prefix):
+                    return button.callback_data
+        return None
+
+
+class UpdateFactory:
+    """Синтетические апдейты от пользователей в личных чатах"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, user_id: int, text: str) -> Dict[str, Any]:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+
+    def message(self, user_id: int, text: str) -> Update:
+        message = self._message(user_id, text)
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return Update.model_validate({'update_id': next(self._update_ids), 'message': message})
+
+    def callback(self, user_id: int, data: str) -> Update:
+        return Update.model_validate({
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(uuid.uuid4()),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'message': self._message(user_id, 'menu'),
+                'data': data,
+            }
+        })
+
+
+class ExternalApiStub:
+    """Локальный aiohttp-сервер, изображающий OnlyPays и CoinGecko"""
+
+    def __init__(self, btc_rate: float = 6500000.0, latency: float = 0.0, order_status: str = 'waiting'):
+        self.btc_rate = btc_rate
+        self.latency = latency
+        self.order_status = order_status
+        self.calls: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _respond(self, name: str, payload: Dict[str, Any]) -> web.Response:
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(payload)
+
+    async def price(self, request: web.Request) -> web.Response:
+        return await self._respond('coingecko.price', {'bitcoin': {'rub': self.btc_rate}})
+
+    async def get_requisite(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return await self._respond('onlypays.get_requisite', {
+            'success': True,
+            'data': {
+                'id': uuid.uuid4().hex[:12],
+                'requisite': '2200 0000 0000 0000',
+                'owner': 'Benchmark',
+                'bank': 'Test Bank',
+                'amount': data.get('amount_rub'),
+            }
+        })
+
+    async def get_status(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return await self._respond('onlypays.get_status', {
+            'success': True,
+            'data': {'id': data.get('id'), 'status': self.order_status}
+        })
+
+    async def cancel_order(self, request: web.Request) -> web.Response:
+        return await self._respond('onlypays.cancel_order', {'success': True})
+
+    async def start(self, port: int, host: str = '127.0.0.1'):
+        app = web.Application()
+        app.router.add_get('/api/v3/simple/price', self.price)
+        app.router.add_post('/get_requisite', self.get_requisite)
+        app.router.add_post('/get_status', self.get_status)
+        app.router.add_post('/cancel_order', self.cancel_order)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
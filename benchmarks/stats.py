@@ -0,0 +1,52 @@
+# benchmarks/stats.py
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    errors: int = 0
+    error_types: Counter = field(default_factory=Counter)
+    elapsed: float = 0.0
+
+    def add_error(self, error: Exception):
+        self.errors += 1
+        self.error_types[type(error).__name__] += 1
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'scenario': self.name,
+            'updates': len(self.latencies),
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 3),
+            'updates_per_sec': round(self.throughput, 1),
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2),
+            'max_ms': round(max(self.latencies, default=0) * 1000, 2),
+        }
+
+
+def format_table(rows: List[Dict[str, float]]) -> str:
+    if not rows:
+        return ''
+    columns = list(rows[0].keys())
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    lines = ['  '.join(column.ljust(widths[column]) for column in columns)]
+    for row in rows:
+        lines.append('  '.join(str(row[column]).ljust(widths[column]) for column in columns))
+    return '\n'.join(lines)
@@ -0,0 +1,242 @@
+# benchmarks/webhook_load.py
+"""Нагрузочный прогон webhook OnlyPays.
+
+Поднимает приложение из webhook.py на локальном порту с временной SQLite,
+создает заявки и засыпает эндпоинт уведомлениями 'finished'/'cancelled':
+с дубликатами, в перемешанном порядке и с конфликтующими статусами для
+одной заявки. После прогона проверяет согласованность:
+
+- у каждой заявки ровно один переход в order_events;
+- итоговый статус совпадает с журналом и не остался 'waiting';
+- клиент получил ровно одно уведомление;
+- сервер не записал в лог ни одной ошибки обработки webhook.
+
+При любом нарушении, ошибке HTTP или ошибке в логе процесс завершается
+с кодом 1, поэтому прогон можно ставить в CI.
+
+Запуск из корня проекта:
+    python -m benchmarks.webhook_load --orders 2000 --duplicates 3 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.exchange import BTC_ADDRESS, configure_environment
+from benchmarks.fakes import free_port
+from benchmarks.stats import ScenarioResult, format_table
+
+OPERATOR_CHAT_ID = -1001
+ADMIN_CHAT_ID = -1002
+# Ошибка, которую process_onlypays_webhook пишет в лог перед ответом 500
+WEBHOOK_ERROR = 'Webhook processing error'
+
+
+class ErrorLogCounter(logging.Handler):
+    """Считает записи уровня ERROR и выше по тексту до первого двоеточия"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.counts = Counter()
+
+    def emit(self, record: logging.LogRecord):
+        self.counts[record.getMessage().split(':', 1)[0]] += 1
+
+
+def build_deliveries(order_ids: List[int], duplicates: int, conflict_ratio: float,
+                     cancel_ratio: float) -> List[Tuple[int, str]]:
+    """Список (заявка, статус) в случайном порядке.
+    
+    Обычная заявка получает duplicates копий одного статуса. Конфликтная -
+    оба статуса, и какой придет первым, решает перемешивание.
+    """
+    deliveries = []
+    for order_id in order_ids:
+        if random.random() < conflict_ratio:
+            statuses = ['finished', 'cancelled']
+        else:
+            statuses = ['cancelled' if random.random() < cancel_ratio else 'finished']
+        for status in statuses:
+            deliveries.extend([(order_id, status)] * duplicates)
+    random.shuffle(deliveries)
+    return deliveries
+
+
+async def create_orders(db, count: int) -> List[int]:
+    order_ids = []
+    for user_id in range(100_000, 100_000 + count):
+        await db.add_user(user_id, f'user{user_id}', f'User{user_id}')
+        order_id = await db.create_order(user_id, 5000, 0.0008, BTC_ADDRESS, 6500000, 6250, 'card')
+        await db.update_order(order_id, onlypays_id=f'load-{order_id}', personal_id=f'load-{order_id}')
+        order_ids.append(order_id)
+    return order_ids
+
+
+async def send_deliveries(url: str, deliveries: List[Tuple[int, str]], concurrency: int) -> ScenarioResult:
+    result = ScenarioResult('webhook_http')
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(session: aiohttp.ClientSession, order_id: int, status: str):
+        payload = {
+            'id': f'load-{order_id}',
+            'personal_id': str(order_id),
+            'status': status,
+            'received_sum': 6250,
+        }
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=payload) as response:
+                    await response.read()
+                    if response.status != 200:
+                        result.add_error(RuntimeError(f'HTTP {response.status}'))
+            except Exception as e:
+                result.add_error(e)
+            result.latencies.append(time.perf_counter() - started)
+    
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(send(session, order_id, status) for order_id, status in deliveries))
+        result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def check_consistency(db, order_ids: List[int], sent: Dict[int, set],
+                            server_errors: int = 0) -> Dict[str, int]:
+    """Подсчет нарушений по итогам прогона; server_errors - ошибки обработки из лога сервера"""
+    async with db.connect() as connection:
+        async with connection.execute(
+            'SELECT order_id, COUNT(*), MAX(id) FROM order_events GROUP BY order_id'
+        ) as cursor:
+            events = {row[0]: (row[1], row[2]) for row in await cursor.fetchall()}
+        async with connection.execute(
+            'SELECT id, to_status FROM order_events'
+        ) as cursor:
+            event_status = dict(await cursor.fetchall())
+        async with connection.execute('SELECT id, user_id, status FROM orders') as cursor:
+            orders = {row[0]: (row[1], row[2]) for row in await cursor.fetchall()}
+        async with connection.execute(
+            'SELECT chat_id, COUNT(*) FROM notification_outbox WHERE chat_id > 0 GROUP BY chat_id'
+        ) as cursor:
+            client_notifications = dict(await cursor.fetchall())
+    
+    violations = Counter()
+    for order_id in order_ids:
+        user_id, status = orders[order_id]
+        event_count, last_event = events.get(order_id, (0, None))
+        allowed = {'paid_by_client' if s == 'finished' else 'cancelled' for s in sent[order_id]}
+        
+        if status == 'waiting' or event_count == 0:
+            violations['lost_updates'] += 1
+        elif event_count > 1:
+            violations['duplicate_transitions'] += 1
+        if last_event and event_status[last_event] != status:
+            violations['status_mismatch'] += 1
+        if status not in allowed and status != 'waiting':
+            violations['unexpected_status'] += 1
+        
+        notifications = client_notifications.get(user_id, 0)
+        if notifications > 1:
+            violations['double_notifications'] += 1
+        elif notifications == 0:
+            violations['missing_notifications'] += 1
+    
+    violations['server_errors'] = server_errors
+    for name in ('lost_updates', 'duplicate_transitions', 'status_mismatch', 'unexpected_status',
+                 'double_notifications', 'missing_notifications'):
+        violations.setdefault(name, 0)
+    return dict(violations)
+
+
+async def main(args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory(prefix='oswbit-webhook-') as workdir:
+        configure_environment(workdir, free_port())
+        os.environ['OPERATOR_CHAT_ID'] = str(OPERATOR_CHAT_ID)
+        os.environ['ADMIN_CHAT_ID'] = str(ADMIN_CHAT_ID)
+        
+        import webhook
+        from config import config
+        from database.models import Database
+        
+        db = Database(config.DATABASE_URL)
+        await db.init_db()
+        order_ids = await create_orders(db, args.orders)
+        deliveries = build_deliveries(order_ids, args.duplicates, args.conflicts, args.cancel_ratio)
+        sent: Dict[int, set] = {}
+        for order_id, status in deliveries:
+            sent.setdefault(order_id, set()).add(status)
+        
+        port = free_port()
+        runner = web.AppRunner(webhook.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        # Ошибки сервера видны только в логе: ответ 500 не говорит, что именно сломалось
+        error_log = ErrorLogCounter()
+        logging.getLogger().addHandler(error_log)
+        try:
+            result = await send_deliveries(
+                f'http://127.0.0.1:{port}/onlypays/notification', deliveries, args.concurrency
+            )
+        finally:
+            logging.getLogger().removeHandler(error_log)
+            await runner.cleanup()
+        
+        violations = await check_consistency(db, order_ids, sent, error_log.counts[WEBHOOK_ERROR])
+    
+    return {
+        'orders': len(order_ids),
+        'deliveries': len(deliveries),
+        'result': result.as_dict(),
+        'errors': dict(result.error_types),
+        'server_errors': dict(error_log.counts),
+        'violations': violations,
+    }
+
+
+def failed(report: Dict) -> bool:
+    """Прогон не прошел: есть нарушения, ошибки HTTP или ошибки в логе сервера"""
+    return bool(report['errors'] or report['server_errors'] or any(report['violations'].values()))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='OnlyPays webhook load test')
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--duplicates', type=int, default=3, help='copies of every notification')
+    parser.add_argument('--conflicts', type=float, default=0.1,
+                        help='share of orders receiving both finished and cancelled')
+    parser.add_argument('--cancel-ratio', type=float, default=0.3,
+                        help='share of non-conflicting orders that get cancelled')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(args.seed)
+    report = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"Orders: {report['orders']}, deliveries: {report['deliveries']}\n")
+        print(format_table([report['result']]))
+        if report['errors']:
+            print(f"\nErrors: {report['errors']}")
+        if report['server_errors']:
+            print(f"\nServer errors: {report['server_errors']}")
+        print('\nConsistency violations:')
+        for name, count in report['violations'].items():
+            print(f'  {name}: {count}')
+    sys.exit(1 if failed(report) else 0)
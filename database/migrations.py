@@ -0,0 +1,481 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+import aiosqlite
+
+from config import config
+from database.storage import COMPLETED_STATUSES
+
+logger = logging.getLogger(__name__)
+
+# Полнотекстовые индексы: (таблица FTS, исходная таблица, колонки, колонки для триггера UPDATE).
+# Индекс заявок есть и в архиве (см. Database._init_archive_schema)
+ORDERS_SEARCH_INDEX = (
+    'orders_fts', 'orders',
+    ('id', 'personal_id', 'onlypays_id', 'btc_address', 'requisites', 'operator_notes'),
+    ('personal_id', 'onlypays_id', 'btc_address', 'requisites', 'operator_notes'),
+)
+SEARCH_INDEXES = (
+    ('users_fts', 'users',
+     ('user_id', 'username', 'first_name', 'last_name'),
+     ('user_id', 'username', 'first_name', 'last_name')),
+    ORDERS_SEARCH_INDEX,
+)
+
+# Пересчет реферальных счетчиков из users и журнала referral_bonuses
+REBUILD_REFERRAL_COUNTERS = '''
+    UPDATE users SET
+        referral_count = (
+            SELECT COUNT(*) FROM users AS referral WHERE referral.referred_by = users.user_id
+        ),
+        referral_balance = (
+            SELECT COALESCE(SUM(amount), 0) FROM referral_bonuses WHERE referral_bonuses.user_id = users.user_id
+        )
+'''
+
+# Каждый LOYALTY_FREE_EVERY-й завершенный обмен до появления loyalty_free считается выданным
+# бесплатным, иначе после обновления клиент получил бы все накопленные разом
+LOYALTY_EVERY = max(config.LOYALTY_FREE_EVERY, 1)
+_COMPLETED_COUNT = f'''(
+    SELECT COUNT(*) FROM all_orders
+    WHERE all_orders.user_id = users.user_id AND all_orders.status IN {COMPLETED_STATUSES}
+)'''
+_FREE_ORDERS_COUNT = '''(
+    SELECT COUNT(*) FROM all_orders
+    WHERE all_orders.user_id = users.user_id AND all_orders.loyalty_free IS TRUE AND all_orders.status != 'cancelled'
+)'''
+
+# Пересчет числа и суммы завершенных обменов и выданных бесплатных обменов; all_orders включает архив
+REBUILD_USER_TOTALS = f'''
+    UPDATE users SET
+        total_operations = {_COMPLETED_COUNT},
+        total_amount = (
+            SELECT COALESCE(SUM(total_amount), 0) FROM all_orders
+            WHERE all_orders.user_id = users.user_id AND all_orders.status IN {COMPLETED_STATUSES}
+        ),
+        loyalty_free_used = CASE
+            WHEN {_COMPLETED_COUNT} / {LOYALTY_EVERY} > {_FREE_ORDERS_COUNT} THEN {_COMPLETED_COUNT} / {LOYALTY_EVERY}
+            ELSE {_FREE_ORDERS_COUNT}
+        END
+'''
+
+
+@dataclass
+class Backfill:
+    """Заполнение данных пачками по диапазонам rowid.
+    
+    sql выполняется как `{sql} WHERE rowid > ? AND rowid <= ?`, каждая пачка -
+    отдельная короткая транзакция, поэтому бот и webhook продолжают писать
+    в базу между пачками. Запрос должен быть идемпотентным: после перезапуска
+    посреди заполнения он повторяется с начала.
+    """
+    table: str
+    sql: str
+    batch_size: int = 5000
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable[[aiosqlite.Connection], Awaitable[None]]
+    backfill: Optional[Backfill] = None
+
+
+async def column_names(db, table: str) -> List[str]:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+
+async def add_column(db, table: str, column: str, definition: str):
+    """ALTER TABLE ADD COLUMN, пропускаемый, если колонка уже есть"""
+    if column not in await column_names(db, table):
+        await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+async def create_search_index(db, table: str, source: str, columns: Sequence[str],
+                              update_columns: Sequence[str], schema: str = 'main'):
+    """FTS5-индекс таблицы source в базе schema, синхронизируемый триггерами, с перестройкой"""
+    column_list = ', '.join(columns)
+    new_values = ', '.join(f'new.{column}' for column in columns)
+    old_values = ', '.join(f'old.{column}' for column in columns)
+    
+    await db.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.{table} USING fts5(
+            {column_list}, content='{source}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    # Триггер обращается к таблицам своей базы, поэтому имена в теле без схемы
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.{table}_ai AFTER INSERT ON {source} BEGIN
+            INSERT INTO {table} (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.{table}_ad AFTER DELETE ON {source} BEGIN
+            INSERT INTO {table} ({table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    # Статусы меняются постоянно, индекс трогаем только при смене искомых полей
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.{table}_au AFTER UPDATE OF {', '.join(update_columns)} ON {source} BEGIN
+            INSERT INTO {table} ({table}, rowid, {column_list}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {table} (rowid, {column_list}) VALUES (new.id, {new_values});
+        END
+    ''')
+    await db.execute(f"INSERT INTO {schema}.{table} ({table}) VALUES ('rebuild')")
+
+
+async def _create_search_index(db):
+    """FTS5-индексы пользователей и заявок, синхронизируемые триггерами"""
+    try:
+        for index in SEARCH_INDEXES:
+            await create_search_index(db, *index)
+    except aiosqlite.OperationalError as e:
+        logger.warning(f"Full-text search unavailable: {e}")
+
+
+async def _create_referral_ledger(db):
+    """referral_bonuses как журнал: только вставка, баланс в users ведет триггер"""
+    await add_column(db, 'referral_bonuses', 'kind', "TEXT NOT NULL DEFAULT 'manual'")
+    await add_column(db, 'referral_bonuses', 'source_user_id', 'INTEGER')
+    await add_column(db, 'referral_bonuses', 'order_id', 'INTEGER')
+    
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_referral_bonuses_user ON referral_bonuses (user_id, id)')
+    # Повторная доставка события не должна начислить бонус дважды
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uniq_referral_bonuses_signup
+        ON referral_bonuses (source_user_id) WHERE kind = 'signup'
+    ''')
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS uniq_referral_bonuses_order
+        ON referral_bonuses (order_id, user_id) WHERE kind = 'order'
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_referral_balance
+        ON users (referral_balance DESC) WHERE referral_balance > 0
+    ''')
+    
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS referral_bonuses_balance AFTER INSERT ON referral_bonuses BEGIN
+            UPDATE users SET referral_balance = referral_balance + new.amount WHERE user_id = new.user_id;
+        END
+    ''')
+    # Исправления проводятся новой записью (kind = 'adjustment'), а не правкой старой
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS referral_bonuses_no_update BEFORE UPDATE ON referral_bonuses BEGIN
+            SELECT RAISE(ABORT, 'referral_bonuses is append-only');
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS referral_bonuses_no_delete BEFORE DELETE ON referral_bonuses BEGIN
+            SELECT RAISE(ABORT, 'referral_bonuses is append-only');
+        END
+    ''')
+
+
+async def _baseline(db):
+    """Схема на момент перехода на версии.
+    
+    Базы, созданные раньше, приходят сюда с user_version = 0 и частью таблиц,
+    поэтому все шаги идемпотентны.
+    """
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone_number TEXT,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_blocked BOOLEAN DEFAULT FALSE,
+            referral_code TEXT,
+            referred_by INTEGER,
+            total_operations INTEGER DEFAULT 0,
+            total_amount REAL DEFAULT 0
+        )
+    ''')
+    await add_column(db, 'users', 'referral_count', 'INTEGER DEFAULT 0')
+    await add_column(db, 'users', 'referral_balance', 'REAL DEFAULT 0')
+    
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            onlypays_id TEXT,
+            amount_rub REAL NOT NULL,
+            amount_btc REAL,
+            btc_address TEXT NOT NULL,
+            rate REAL NOT NULL,
+            total_amount REAL NOT NULL,
+            payment_type TEXT NOT NULL,
+            status TEXT DEFAULT 'waiting',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            requisites TEXT,
+            is_problematic BOOLEAN DEFAULT FALSE,
+            operator_notes TEXT,
+            personal_id TEXT
+        )
+    ''')
+    await add_column(db, 'orders', 'operator_notes', 'TEXT')
+    await add_column(db, 'orders', 'personal_id', 'TEXT')
+    
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS captcha_sessions (
+            user_id INTEGER PRIMARY KEY,
+            answer TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS referral_bonuses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    await _create_referral_ledger(db)
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            actor TEXT,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events (order_id, id)')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+        ON notification_outbox (status, next_attempt_at)
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduled_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            run_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+    
+    await _create_search_index(db)
+
+
+async def _add_received_sum(db):
+    await add_column(db, 'orders', 'received_sum', 'REAL')
+
+
+async def _add_user_indexes(db):
+    """Индексы экранов администратора: регистрации, активные и заблокированные"""
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_date)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE total_operations > 0')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_blocked ON users (user_id) WHERE is_blocked = 1')
+
+
+async def _add_last_order_at(db):
+    """Дата последней заявки для сегментов рассылки; поддерживается триггером"""
+    await add_column(db, 'users', 'last_order_at', 'TIMESTAMP')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_last_order ON users (last_order_at)')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS orders_last_order_at AFTER INSERT ON orders BEGIN
+            UPDATE users SET last_order_at = new.created_at WHERE user_id = new.user_id;
+        END
+    ''')
+
+
+async def _add_delivery_error(db):
+    """Причина, по которой сообщения пользователю не доходят (бот заблокирован и т.п.)"""
+    await add_column(db, 'users', 'delivery_error', 'TEXT')
+    await add_column(db, 'users', 'delivery_error_at', 'TIMESTAMP')
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_undeliverable ON users (user_id) WHERE delivery_error IS NOT NULL'
+    )
+
+
+async def _index_user_operations(db):
+    """Частичный индекс по total_operations: COUNT сегментов по числу операций читает только индекс"""
+    await db.execute('DROP INDEX IF EXISTS idx_users_active')
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_operations ON users (total_operations) WHERE total_operations > 0'
+    )
+
+
+async def _add_loyalty_free(db):
+    """Бесплатные обмены по программе лояльности: признак на заявке и счетчик выданных у клиента"""
+    await add_column(db, 'orders', 'loyalty_free', 'INTEGER DEFAULT 0')
+    await add_column(db, 'users', 'loyalty_free_used', 'INTEGER DEFAULT 0')
+
+
+MIGRATIONS: Sequence[Migration] = (
+    Migration(
+        1, 'baseline schema',
+        _baseline,
+        # Счетчики могли только что появиться в заполненной базе
+        Backfill('users', REBUILD_REFERRAL_COUNTERS),
+    ),
+    Migration(
+        2, 'orders.received_sum',
+        _add_received_sum,
+        # Сумма, пришедшая в webhook, до этого сохранялась только в журнале order_events
+        Backfill('orders', '''
+            UPDATE orders SET received_sum = (
+                SELECT json_extract(details, '$.received_sum') FROM order_events
+                WHERE order_events.order_id = orders.id
+                  AND order_events.to_status = 'paid_by_client'
+                  AND json_valid(order_events.details)
+                ORDER BY order_events.id DESC LIMIT 1
+            )
+        '''),
+    ),
+    Migration(3, 'admin user indexes', _add_user_indexes),
+    Migration(
+        4, 'users.last_order_at',
+        _add_last_order_at,
+        # Архив при миграции не подключен; закрытые заявки старше срока хранения не учитываются
+        Backfill('users', '''
+            UPDATE users SET last_order_at = (
+                SELECT MAX(created_at) FROM orders WHERE orders.user_id = users.user_id
+            )
+        '''),
+    ),
+    Migration(5, 'users.delivery_error', _add_delivery_error),
+    # Сами счетчики пересчитывает задача rebuild_user_totals: ей нужен подключенный архив
+    Migration(6, 'users.total_operations index', _index_user_operations),
+    Migration(
+        7, 'loyalty free exchanges',
+        _add_loyalty_free,
+        # Прошлые бесплатные обмены считаются выданными, иначе клиент получил бы их все разом.
+        # Архив при миграции не подключен, а total_operations до rebuild_user_totals мог
+        # не вестись: берем большее, задача rebuild_user_totals затем пересчитывает по архиву
+        Backfill('users', f'''
+            UPDATE users SET loyalty_free_used = MAX(
+                COALESCE(total_operations, 0),
+                (SELECT COUNT(*) FROM orders
+                 WHERE orders.user_id = users.user_id AND orders.status IN {COMPLETED_STATUSES})
+            ) / {LOYALTY_EVERY}
+        '''),
+    ),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def get_version(db) -> int:
+    async with db.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def _set_version(db, version: int):
+    # PRAGMA не принимает параметры; version - целое из MIGRATIONS
+    await db.execute(f'PRAGMA user_version = {int(version)}')
+
+
+async def _run_backfill(db, backfill: Backfill, pause: float) -> int:
+    async with db.execute(f'SELECT MAX(rowid) FROM {backfill.table}') as cursor:
+        last_rowid = (await cursor.fetchone())[0] or 0
+    
+    updated = 0
+    start = 0
+    while start < last_rowid:
+        end = start + backfill.batch_size
+        cursor = await db.execute(f'{backfill.sql} WHERE rowid > ? AND rowid <= ?', (start, end))
+        updated += max(cursor.rowcount, 0)
+        await db.commit()
+        start = end
+        # Отдаем блокировку записи другим соединениям между пачками
+        await asyncio.sleep(pause)
+    return updated
+
+
+async def migrate(db, migrations: Sequence[Migration] = MIGRATIONS, pause: float = 0.05) -> Tuple[int, int]:
+    """Применяет недостающие миграции; возвращает (версия до, версия после).
+    
+    Для актуальной схемы это одно чтение PRAGMA user_version. Миграция без
+    заполнения данных применяется вместе со сменой версии в одной транзакции.
+    У миграции с заполнением схема фиксируется отдельно, данные заполняются
+    пачками, и только затем поднимается версия - прерванная миграция
+    повторится при следующем запуске.
+    """
+    current = await get_version(db)
+    pending = [migration for migration in migrations if migration.version > current]
+    if not pending:
+        return current, current
+    
+    if current == 0:
+        # Действует только для новой базы (до первой таблицы); существующую переводит VACUUM
+        await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
+    for migration in pending:
+        logger.info(f"Applying migration {migration.version}: {migration.description}")
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            await migration.apply(db)
+            if migration.backfill is None:
+                await _set_version(db, migration.version)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.error(f"Migration {migration.version} failed")
+            raise
+        
+        if migration.backfill is not None:
+            updated = await _run_backfill(db, migration.backfill, pause)
+            await _set_version(db, migration.version)
+            await db.commit()
+            logger.info(f"Migration {migration.version}: backfilled {updated} rows in {migration.backfill.table}")
+    
+    return current, pending[-1].version
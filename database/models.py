@@ -1,134 +1,159 @@
 from asyncio.log import logger
+import asyncio
 import aiosqlite
 import json
+import sqlite3
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-import config
+from typing import Optional, List, Dict, Any, Sequence, Tuple
 import os
+import time
+from config import config
+from utils.metrics import DB_ERRORS, DB_SECONDS, instrument_methods
+from database.profiler import connect
+from database.order_cache import order_cache
+from database.rows import Order, User
+from database.migrations import (
+    ORDERS_SEARCH_INDEX, REBUILD_REFERRAL_COUNTERS, REBUILD_USER_TOTALS, create_search_index, migrate,
+)
+from database.storage import (
+    ARCHIVABLE_STATUSES, COMPLETED_STATUSES, NOTIFICATION_LEASE, ORDER_EVENT_COLUMNS, ORDER_UPDATE_FIELDS,
+    Storage, TransitionNotifications,
+)
 
 
-
-class Database:
-    def __init__(self, db_path: str):
-        self.db_path = db_path
+@instrument_methods(DB_SECONDS, DB_ERRORS)
+class Database(Storage):
+    """Хранилище в файле SQLite (aiosqlite), соединение на каждый вызов"""
     
+    supports_backup = True
 
-        
-    async def get_commission_percentage(self):
-        return await self.get_setting("commission_percentage", float(os.getenv('COMMISSION_PERCENT', '20.0')))
-
-
+    def __init__(self, db_path: str, archive_path: str = None):
+        super().__init__(db_path)
+        # Архив закрытых заявок - отдельный файл рядом с рабочей базой
+        root, ext = os.path.splitext(db_path)
+        self.archive_path = archive_path or os.getenv('ARCHIVE_DATABASE_URL') or f"{root}_archive{ext or '.db'}"
+    
+    def connect(self):
+        """Соединение с БД (через профилировщик, если он включен)"""
+        return connect(self.db_path, config.DB_BUSY_TIMEOUT)
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY,
-                    user_id INTEGER UNIQUE NOT NULL,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    phone_number TEXT,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_blocked BOOLEAN DEFAULT FALSE,
-                    referral_code TEXT,
-                    referred_by INTEGER,
-                    total_operations INTEGER DEFAULT 0,
-                    total_amount REAL DEFAULT 0
-                )
-            ''')
-            
-            await self._migrate_users_table(db)
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    onlypays_id TEXT,
-                    amount_rub REAL NOT NULL,
-                    amount_btc REAL,
-                    btc_address TEXT NOT NULL,
-                    rate REAL NOT NULL,
-                    total_amount REAL NOT NULL,
-                    payment_type TEXT NOT NULL,
-                    status TEXT DEFAULT 'waiting',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    requisites TEXT,
-                    is_problematic BOOLEAN DEFAULT FALSE,
-                    operator_notes TEXT,
-                    personal_id TEXT
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS captcha_sessions (
-                    user_id INTEGER PRIMARY KEY,
-                    answer TEXT NOT NULL,
-                    attempts INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS referral_bonuses (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount REAL NOT NULL,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS reviews (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    status TEXT DEFAULT 'pending'
-                )
-            ''')
+        """Создание или обновление схемы (версии - в database/migrations.py)"""
+        async with self.connect() as db:
+            # WAL хранится в файле БД: читатели больше не блокируют запись и наоборот
+            await db.execute('PRAGMA journal_mode = WAL')
+            before, after = await migrate(db)
+            if before != after:
+                logger.info(f"Database schema migrated from version {before} to {after}")
 
-            await db.commit()
+    @staticmethod
+    def _fts_query(query: str) -> Optional[str]:
+        """Превращает ввод в префиксный запрос FTS5: каждое слово ищется как начало токена"""
+        tokens = [
+            token.strip('@#"*()').replace('"', '')
+            for token in query.split()
+        ]
+        tokens = [token for token in tokens if token]
+        if not tokens:
+            return None
+        return ' '.join(f'"{token}"*' for token in tokens)
 
-    async def _migrate_users_table(self, db):
-        cursor = await db.execute("PRAGMA table_info(users)")
-        columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
+    async def search_users(self, query: str, limit: int = 10) -> List[Dict]:
+        match = self._fts_query(query)
+        if not match:
+            return []
         
-        if 'referral_count' not in column_names:
-            await db.execute('ALTER TABLE users ADD COLUMN referral_count INTEGER DEFAULT 0')
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            try:
+                async with db.execute('''
+                    SELECT u.user_id, u.username, u.first_name, u.last_name, u.is_blocked
+                    FROM users_fts
+                    JOIN users u ON u.id = users_fts.rowid
+                    WHERE users_fts MATCH ?
+                    ORDER BY rank
+                    LIMIT ?
+                ''', (match, limit)) as cursor:
+                    return [dict(row) for row in await cursor.fetchall()]
+            except aiosqlite.OperationalError as e:
+                logger.warning(f"User search failed: {e}")
+                return []
+
+    async def search_orders(self, query: str, limit: int = 10) -> List[Dict]:
+        """Поиск заявок в рабочей базе и архиве; archived = 1 у перенесенных"""
+        match = self._fts_query(query)
+        if not match:
+            return []
         
-        await db.commit()
+        async with self.archive_connection() as db:
+            db.row_factory = aiosqlite.Row
+            try:
+                async with db.execute('''
+                    SELECT id, user_id, total_amount, status, created_at, personal_id, archived FROM (
+                        SELECT o.id, o.user_id, o.total_amount, o.status, o.created_at, o.personal_id,
+                               0 AS archived, f.rank AS rank
+                        FROM main.orders_fts AS f
+                        JOIN main.orders o ON o.id = f.rowid
+                        WHERE f.orders_fts MATCH ?
+                        UNION ALL
+                        SELECT o.id, o.user_id, o.total_amount, o.status, o.created_at, o.personal_id,
+                               1 AS archived, f.rank AS rank
+                        FROM archive.orders_fts AS f
+                        JOIN archive.orders o ON o.id = f.rowid
+                        WHERE f.orders_fts MATCH ?
+                    )
+                    ORDER BY rank
+                    LIMIT ?
+                ''', (match, match, limit)) as cursor:
+                    return [dict(row) for row in await cursor.fetchall()]
+            except aiosqlite.OperationalError as e:
+                logger.warning(f"Order search failed: {e}")
+                return []
 
     async def add_user(self, user_id: int, username: str = None, 
-                      first_name: str = None, last_name: str = None) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+                      first_name: str = None, last_name: str = None,
+                      referred_by: int = None, signup_bonus: float = 0) -> bool:
+        """Регистрация пользователя.
+        
+        Счетчик пригласившего и бонус за приглашение проводятся в той же транзакции.
+        """
+        if referred_by == user_id:
+            referred_by = None
+        
+        async with self.connect() as db:
             try:
+                # Несуществующий пригласивший превращается в NULL
                 await db.execute('''
-                    INSERT INTO users (user_id, username, first_name, last_name)
-                    VALUES (?, ?, ?, ?)
-                ''', (user_id, username, first_name, last_name))
+                    INSERT INTO users (user_id, username, first_name, last_name, referred_by)
+                    VALUES (?, ?, ?, ?, (SELECT user_id FROM users WHERE user_id = ?))
+                ''', (user_id, username, first_name, last_name, referred_by))
+                if referred_by:
+                    await db.execute(
+                        'UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?',
+                        (referred_by,)
+                    )
+                if referred_by and signup_bonus:
+                    await db.execute('''
+                        INSERT INTO referral_bonuses (user_id, amount, description, kind, source_user_id)
+                        SELECT user_id, ?, ?, 'signup', ? FROM users WHERE user_id = ?
+                    ''', (signup_bonus, 'Бонус за приглашение', user_id, referred_by))
                 await db.commit()
+                if referred_by and signup_bonus:
+                    self._invalidate_leaderboard()
                 return True
             except aiosqlite.IntegrityError:
                 return False
 
-    async def get_user(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+    async def get_user(self, user_id: int, fields: Sequence[str] = None) -> Optional[User]:
+        """Пользователь с колонками fields (по умолчанию - все)"""
+        columns = User.select_list(fields)
+        async with self.connect() as db:
+            async with db.execute(
+                f"SELECT {', '.join(columns)} FROM users WHERE user_id = ?", (user_id,)
+            ) as cursor:
                 row = await cursor.fetchone()
-                return dict(row) if row else None
+                return User.from_row(columns, row) if row else None
 
     async def update_user(self, user_id: int, **kwargs):
         if not kwargs:
@@ -137,7 +162,7 @@ class Database:
         fields = ', '.join([f"{key} = ?" for key in kwargs.keys()])
         values = list(kwargs.values()) + [user_id]
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute(f'UPDATE users SET {fields} WHERE user_id = ?', values)
             await db.commit()
 
@@ -147,13 +172,22 @@ class Database:
 
 
     async def create_order(self, user_id: int, amount_rub: float, amount_btc: float,
-                        btc_address: str, rate: float, total_amount: float, payment_type: str) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+                        btc_address: str, rate: float, total_amount: float, payment_type: str,
+                        loyalty_free: bool = False) -> int:
+        async with self.connect() as db:
             cursor = await db.execute('''
-                INSERT INTO orders (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type))
+                INSERT INTO orders (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type,
+                                    loyalty_free)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type, int(loyalty_free)))
             await db.commit()
+            
+            # Строку перечитываем только для пользователя, чья история уже в кэше
+            order_cache.touch(self.db_path, user_id)
+            if order_cache.has(self.db_path, user_id):
+                order = await self._fetch_order(db, cursor.lastrowid, Order.light_columns())
+                if order:
+                    order_cache.add_order(self.db_path, order)
             return cursor.lastrowid
 
 
@@ -161,15 +195,32 @@ class Database:
 
 
 
-    async def get_order(self, order_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM orders WHERE id = ?', (order_id,)) as cursor:
-                row = await cursor.fetchone()
-                return dict(row) if row else None
+    @staticmethod
+    async def _fetch_order(db, order_id: int, columns: Sequence[str]) -> Optional[Order]:
+        async with db.execute(
+            f"SELECT {', '.join(columns)} FROM orders WHERE id = ?", (order_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return Order.from_row(columns, row) if row else None
+
+    async def get_order(self, order_id: int, fields: Sequence[str] = None) -> Optional[Order]:
+        """Заявка с колонками fields; по умолчанию без requisites/operator_notes"""
+        columns = Order.select_list(fields)
+        async with self.connect() as db:
+            return await self._fetch_order(db, order_id, columns)
+
+    async def load_order_fields(self, order: Order, *fields: str) -> Order:
+        """Догружает невыбранные колонки заявки (по умолчанию - тяжелые текстовые)"""
+        missing = order.missing(Order.select_list(fields or Order.HEAVY))
+        if missing:
+            async with self.connect() as db:
+                loaded = await self._fetch_order(db, order['id'], missing)
+            if loaded:
+                order.update(loaded)
+        return order
 
     async def save_review(self, user_id: int, text: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             current_time = datetime.now().isoformat()
             
             cursor = await db.execute(
@@ -180,7 +231,7 @@ class Database:
             return cursor.lastrowid
 
     async def get_last_review_time(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             async with db.execute(
                 'SELECT created_at FROM reviews WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
                 (user_id,)
@@ -191,7 +242,7 @@ class Database:
                 return None
 
     async def update_review_status(self, review_id: int, status: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute(
                 'UPDATE reviews SET status = ? WHERE id = ?',
                 (status, review_id)
@@ -203,34 +254,369 @@ class Database:
         if not kwargs:
             return
         
-        # Добавляем personal_id в список возможных полей для обновления
-        allowed_fields = ['onlypays_id', 'status', 'requisites', 'personal_id']
-        
         set_clause = []
         values = []
+        fields = {}
         
         for field, value in kwargs.items():
-            if field in allowed_fields:
+            if field in ORDER_UPDATE_FIELDS:
                 set_clause.append(f"{field} = ?")
                 values.append(value)
+                fields[field] = value
         
         if set_clause:
             values.append(order_id)
             query = f"UPDATE orders SET {', '.join(set_clause)} WHERE id = ?"
             await self.execute_query(query, tuple(values))
+            order_cache.update_order(self.db_path, order_id, fields)
 
-    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
+    async def transition_order_status(self, order_id: int, from_statuses: List[str], to_status: str,
+                                      actor: str = None, details: Dict = None,
+                                      notifications: TransitionNotifications = None, **kwargs):
+        """Атомарная смена статуса заявки (compare-and-set) с записью в order_events.
+        
+        Уведомления notifications попадают в очередь в той же транзакции:
+        падение после коммита не теряет их, откат не рассылает.
+        """
+        async with self.connect() as db:
             db.row_factory = aiosqlite.Row
-            async with db.execute('''
-                SELECT * FROM orders WHERE user_id = ? 
-                ORDER BY created_at DESC LIMIT ?
-            ''', (user_id, limit)) as cursor:
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute('SELECT status FROM orders WHERE id = ?', (order_id,)) as cursor:
+                row = await cursor.fetchone()
+            
+            if not row or row['status'] not in from_statuses:
+                await db.rollback()
+                return None
+            
+            from_status = row['status']
+            set_clause = ['status = ?']
+            values = [to_status]
+            for field, value in kwargs.items():
+                if field in ORDER_UPDATE_FIELDS and field != 'status':
+                    set_clause.append(f"{field} = ?")
+                    values.append(value)
+            if to_status == 'completed':
+                set_clause.append('completed_at = CURRENT_TIMESTAMP')
+            
+            cursor = await db.execute(
+                f"UPDATE orders SET {', '.join(set_clause)} WHERE id = ? AND status = ?",
+                (*values, order_id, from_status)
+            )
+            if cursor.rowcount != 1:
+                await db.rollback()
+                return None
+            
+            await db.execute('''
+                INSERT INTO order_events (order_id, from_status, to_status, actor, details)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (order_id, from_status, to_status, actor,
+                  json.dumps(details, ensure_ascii=False) if details else None))
+            if to_status == 'completed':
+                await self._add_completed_order(db, order_id)
+            elif to_status == 'cancelled':
+                await self._release_loyalty_slot(db, order_id)
+            
+            order = await self._fetch_order(db, order_id, Order.COLUMNS)
+            if notifications:
+                await self._insert_notifications(db, await notifications(order, from_status))
+            await db.commit()
+            order_cache.update_order(self.db_path, order_id, order)
+            return order, from_status
+
+    @staticmethod
+    async def _add_completed_order(db, order_id: int):
+        """Счетчики обменов клиента растут в транзакции смены статуса на completed"""
+        await db.execute('''
+            UPDATE users SET
+                total_operations = COALESCE(total_operations, 0) + 1,
+                total_amount = COALESCE(total_amount, 0) + (SELECT total_amount FROM orders WHERE id = ?)
+            WHERE user_id = (SELECT user_id FROM orders WHERE id = ?)
+        ''', (order_id, order_id))
+
+    @staticmethod
+    async def _release_loyalty_slot(db, order_id: int):
+        """Отмена бесплатной по программе заявки возвращает клиенту зарезервированный обмен"""
+        await db.execute('''
+            UPDATE users SET loyalty_free_used = MAX(COALESCE(loyalty_free_used, 0) - 1, 0)
+            WHERE user_id = (SELECT user_id FROM orders WHERE id = ? AND loyalty_free = 1)
+        ''', (order_id,))
+
+    async def get_order_events(self, order_id: int) -> List[Dict]:
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                'SELECT * FROM order_events WHERE order_id = ? ORDER BY id', (order_id,)
+            ) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Order]:
+        """Последние заявки пользователя без тяжелых колонок; повторные запросы обслуживает order_cache"""
+        cached = order_cache.get(self.db_path, user_id, limit)
+        if cached is not None:
+            return cached
+        
+        fetch = max(limit, order_cache.depth)
+        columns = Order.light_columns()
+        # Смена статуса во время чтения не должна оставить в кэше старую строку
+        generation = order_cache.generation()
+        async with self.connect() as db:
+            async with db.execute(f'''
+                SELECT {', '.join(columns)} FROM orders WHERE user_id = ? 
+                ORDER BY created_at DESC LIMIT ?
+            ''', (user_id, fetch)) as cursor:
+                rows = Order.from_rows(columns, await cursor.fetchall())
+        
+        order_cache.put(self.db_path, user_id, rows, complete=len(rows) < fetch, generation=generation)
+        return rows[:limit]
+
+    @asynccontextmanager
+    async def archive_connection(self):
+        """Соединение с подключенным архивом (схема archive) и представлением all_orders"""
+        async with self.connect() as db:
+            await db.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            await self._init_archive_schema(db)
+            yield db
+
+    async def _init_archive_schema(self, db):
+        # Колонки без типов: архив только хранит то, что пришло из рабочей базы
+        await db.execute('CREATE TABLE IF NOT EXISTS archive.orders (id INTEGER PRIMARY KEY, archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+        await db.execute('CREATE TABLE IF NOT EXISTS archive.order_events (id INTEGER PRIMARY KEY)')
+        for table, columns in (('orders', Order.COLUMNS), ('order_events', ORDER_EVENT_COLUMNS)):
+            async with db.execute(f'PRAGMA archive.table_info({table})') as cursor:
+                existing = {row[1] for row in await cursor.fetchall()}
+            for column in columns:
+                if column not in existing:
+                    await db.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column}')
+        
+        await db.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_personal ON orders (personal_id)')
+        await db.execute('CREATE INDEX IF NOT EXISTS archive.idx_orders_user_created ON orders (user_id, created_at)')
+        await db.execute('CREATE INDEX IF NOT EXISTS archive.idx_order_events_order ON order_events (order_id, id)')
+        
+        # Свой FTS5-индекс архива: перенесенные заявки остаются в поиске
+        async with db.execute("SELECT 1 FROM archive.sqlite_master WHERE name = ?", ORDERS_SEARCH_INDEX[:1]) as cursor:
+            indexed = await cursor.fetchone() is not None
+        if not indexed:
+            try:
+                await create_search_index(db, *ORDERS_SEARCH_INDEX, schema='archive')
+            except aiosqlite.OperationalError as e:
+                logger.warning(f"Archive search unavailable: {e}")
+        
+        # Обычное представление не может ссылаться на другую базу, поэтому TEMP - на время соединения
+        columns = ', '.join(Order.COLUMNS)
+        await db.execute(f'''
+            CREATE TEMP VIEW IF NOT EXISTS all_orders AS
+            SELECT {columns}, 0 AS archived FROM main.orders
+            UNION ALL
+            SELECT {columns}, 1 AS archived FROM archive.orders
+        ''')
+        await db.commit()
+
+    async def archive_orders(self, retention_days: int, batch_size: int = 500, pause: float = 0.05) -> int:
+        """Переносит закрытые заявки старше retention_days (с их order_events) в архив.
+        
+        Каждая пачка - отдельная транзакция по обеим базам, между пачками
+        блокировка записи отдается обработчикам. Возвращает число перенесенных заявок.
+        """
+        columns = ', '.join(Order.COLUMNS)
+        event_columns = ', '.join(ORDER_EVENT_COLUMNS)
+        statuses = ', '.join('?' for _ in ARCHIVABLE_STATUSES)
+        moved = 0
+        
+        async with self.archive_connection() as db:
+            while True:
+                await db.execute('BEGIN IMMEDIATE')
+                async with db.execute(f'''
+                    SELECT id FROM main.orders
+                    WHERE status IN ({statuses}) AND created_at < datetime('now', ?)
+                    ORDER BY id LIMIT ?
+                ''', (*ARCHIVABLE_STATUSES, f'-{int(retention_days)} days', batch_size)) as cursor:
+                    ids = [row[0] for row in await cursor.fetchall()]
+                if not ids:
+                    await db.rollback()
+                    break
+                
+                placeholders = ', '.join('?' for _ in ids)
+                # DELETE вместо OR REPLACE: замена строки не вызывает триггер индекса поиска
+                await db.execute(f'DELETE FROM archive.orders WHERE id IN ({placeholders})', ids)
+                await db.execute(
+                    f'INSERT INTO archive.orders ({columns}) '
+                    f'SELECT {columns} FROM main.orders WHERE id IN ({placeholders})', ids
+                )
+                await db.execute(
+                    f'INSERT OR REPLACE INTO archive.order_events ({event_columns}) '
+                    f'SELECT {event_columns} FROM main.order_events WHERE order_id IN ({placeholders})', ids
+                )
+                await db.execute(f'DELETE FROM main.order_events WHERE order_id IN ({placeholders})', ids)
+                await db.execute(f'DELETE FROM main.orders WHERE id IN ({placeholders})', ids)
+                await db.commit()
+                
+                moved += len(ids)
+                await asyncio.sleep(pause)
+        
+        if moved:
+            order_cache.invalidate(self.db_path)
+            logger.info(f"Archived {moved} orders to {self.archive_path}")
+        return moved
+
+    async def find_order_card(self, order_ref: str):
+        """Заявка по ID или personal_id в рабочей базе или архиве; последняя колонка - archived"""
+        async with self.archive_connection() as db:
+            async with db.execute('''
+                SELECT id, user_id, amount_rub, amount_btc, btc_address, total_amount, status,
+                       created_at, personal_id, payment_type, rate, archived
+                FROM all_orders
+                WHERE id = ? OR personal_id = ?
+                ORDER BY archived
+                LIMIT 1
+            ''', (order_ref, order_ref)) as cursor:
+                return await cursor.fetchone()
+
+    async def incremental_vacuum(self, pages_per_step: int = 1000, pause: float = 0.05) -> Optional[int]:
+        """Возвращает свободные страницы файлу по частям.
+        
+        None - база еще не переведена в auto_vacuum = INCREMENTAL (см. enable_incremental_vacuum).
+        """
+        async with self.connect() as db:
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                if (await cursor.fetchone())[0] != 2:
+                    return None
+            
+            freed = 0
+            while True:
+                async with db.execute('PRAGMA freelist_count') as cursor:
+                    free_pages = (await cursor.fetchone())[0]
+                if not free_pages:
+                    break
+                step = min(free_pages, pages_per_step)
+                async with db.execute(f'PRAGMA incremental_vacuum({step})') as cursor:
+                    await cursor.fetchall()
+                freed += step
+                await asyncio.sleep(pause)
+            return freed
+
+    async def enable_incremental_vacuum(self):
+        """Разовый перевод существующей базы в auto_vacuum = INCREMENTAL (полный VACUUM)"""
+        async with self.connect() as db:
+            await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            await db.execute('VACUUM')
+        logger.info("Database switched to incremental auto_vacuum")
+
+    async def backup_to(self, target_path: str, pages: int = 1000, sleep: float = 0.05,
+                        archive_target_path: str = None):
+        """Онлайн-копия базы через backup API порциями по pages страниц; archive_target_path - копия архива"""
+        # Архив копируется после рабочей базы: заявка, перенесенная между копиями,
+        # окажется в обеих, а не потеряется
+        targets = [('main', target_path)]
+        if archive_target_path:
+            targets.append(('archive', archive_target_path))
+        
+        async with (self.archive_connection() if archive_target_path else self.connect()) as db:
+            for name, path in targets:
+                # Копирует поток aiosqlite, поэтому целевое соединение без привязки к потоку
+                target = sqlite3.connect(path, check_same_thread=False)
+                try:
+                    await db.backup(target, pages=pages, sleep=sleep, name=name)
+                finally:
+                    target.close()
+
+    @staticmethod
+    def _order_filters(statuses: List[str] = None, user_id: int = None, min_amount: float = None,
+                       max_amount: float = None, date_from: str = None, date_to: str = None):
+        """Условия WHERE и параметры для фильтров списка и выгрузки заявок"""
+        conditions = []
+        params = []
+        
+        if statuses:
+            conditions.append(f"status IN ({', '.join('?' * len(statuses))})")
+            params.extend(statuses)
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if min_amount is not None:
+            conditions.append('total_amount >= ?')
+            params.append(min_amount)
+        if max_amount is not None:
+            conditions.append('total_amount <= ?')
+            params.append(max_amount)
+        if date_from:
+            conditions.append('created_at >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append("created_at < DATE(?, '+1 day')")
+            params.append(date_to)
+        return conditions, params
+
+    async def get_orders_page(self, statuses: List[str] = None, direction: str = None,
+                              cursor_id: int = None, limit: int = 10, user_id: int = None,
+                              min_amount: float = None, max_amount: float = None,
+                              date_from: str = None, date_to: str = None):
+        """Страница заявок с keyset-пагинацией по (created_at, id).
+        
+        direction='next' - заявки старше cursor_id, 'prev' - новее.
+        Возвращает (заявки от новых к старым, есть ли еще заявки в направлении листания).
+        """
+        conditions, params = self._order_filters(statuses, user_id, min_amount, max_amount, date_from, date_to)
+        
+        order = 'DESC'
+        if cursor_id is not None and direction in ('next', 'prev'):
+            sign = '<' if direction == 'next' else '>'
+            conditions.append(f"(created_at, id) {sign} (SELECT created_at, id FROM orders WHERE id = ?)")
+            params.append(cursor_id)
+            if direction == 'prev':
+                order = 'ASC'
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        query = f'''
+            SELECT id, user_id, total_amount, status, created_at, personal_id
+            FROM orders {where}
+            ORDER BY created_at {order}, id {order} LIMIT ?
+        '''
+        params.append(limit + 1)
+        
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(query, params) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if order == 'ASC':
+            rows.reverse()
+        return rows, has_more
+
+    async def iter_orders(self, statuses: List[str] = None, user_id: int = None,
+                          min_amount: float = None, max_amount: float = None,
+                          date_from: str = None, date_to: str = None, chunk_size: int = 1000):
+        """Заявки вместе с архивом пачками по chunk_size строк (Order.COLUMNS + archived).
+        
+        Один курсор на всю выгрузку, в памяти только текущая пачка.
+        """
+        conditions, params = self._order_filters(statuses, user_id, min_amount, max_amount, date_from, date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        async with self.archive_connection() as db:
+            async with db.execute(
+                f"SELECT {', '.join(Order.COLUMNS)}, archived FROM all_orders {where} ORDER BY id", params
+            ) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def iter_users(self, chunk_size: int = 1000):
+        """Все пользователи пачками по chunk_size строк (User.COLUMNS)"""
+        async with self.connect() as db:
+            async with db.execute(f"SELECT {', '.join(User.COLUMNS)} FROM users ORDER BY id") as cursor:
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+
     async def get_setting(self, key: str, default: Any = None) -> Any:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             async with db.execute('SELECT value FROM settings WHERE key = ?', (key,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -246,20 +632,196 @@ class Database:
         else:
             value = str(value)
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
             ''', (key, value))
             await db.commit()
 
     async def get_all_users(self) -> List[int]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             async with db.execute('SELECT user_id FROM users WHERE is_blocked = FALSE') as cursor:
                 rows = await cursor.fetchall()
                 return [row[0] for row in rows]
 
+    async def count_users(self) -> Dict[str, int]:
+        """Счетчики пользователей для админки; каждый COUNT читает только индекс"""
+        queries = {
+            'total': 'SELECT COUNT(*) FROM users',
+            'blocked': 'SELECT COUNT(*) FROM users WHERE is_blocked = 1',
+            'active': 'SELECT COUNT(*) FROM users WHERE total_operations > 0',
+            'today': "SELECT COUNT(*) FROM users WHERE registration_date >= DATE('now')",
+            'week': "SELECT COUNT(*) FROM users WHERE registration_date >= DATE('now', '-7 days')",
+            'unreachable': 'SELECT COUNT(*) FROM users WHERE delivery_error IS NOT NULL',
+        }
+        counts = {}
+        async with self.connect() as db:
+            for key, query in queries.items():
+                async with db.execute(query) as cursor:
+                    counts[key] = (await cursor.fetchone())[0]
+        return counts
+
+    async def get_recent_users(self, limit: int = 10) -> List[Dict]:
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('''
+                SELECT user_id, username, first_name, registration_date, total_operations
+                FROM users ORDER BY registration_date DESC LIMIT ?
+            ''', (limit,)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def mark_undeliverable(self, failures: List[Tuple[int, str]]):
+        """Отмечает пачку (user_id, причина) одной транзакцией; такие чаты выпадают из рассылок"""
+        if not failures:
+            return
+        async with self.connect() as db:
+            await db.executemany(
+                'UPDATE users SET delivery_error = ?, delivery_error_at = CURRENT_TIMESTAMP WHERE user_id = ?',
+                [(reason, user_id) for user_id, reason in failures]
+            )
+            await db.commit()
+
+    async def clear_delivery_error(self, user_id: int):
+        async with self.connect() as db:
+            await db.execute(
+                'UPDATE users SET delivery_error = NULL, delivery_error_at = NULL WHERE user_id = ?', (user_id,)
+            )
+            await db.commit()
+
+    @staticmethod
+    def _segment_filters(registered_within_days: int = None, min_operations: int = None,
+                         max_operations: int = None, ordered_within_days: int = None, idle_days: int = None,
+                         referred: bool = None, referred_by: int = None, blocked: Optional[bool] = False,
+                         reachable: Optional[bool] = True):
+        """Условия WHERE и параметры сегмента рассылки; None в blocked/reachable - без этого условия"""
+        conditions = []
+        params = []
+        
+        if blocked is not None:
+            conditions.append('is_blocked = 1' if blocked else 'is_blocked = 0')
+        if reachable is not None:
+            conditions.append('delivery_error IS NULL' if reachable else 'delivery_error IS NOT NULL')
+        if registered_within_days is not None:
+            conditions.append("registration_date >= datetime('now', ?)")
+            params.append(f'-{int(registered_within_days)} days')
+        if min_operations:
+            # Литерал совпадает с условием частичного индекса idx_users_operations
+            conditions.append('total_operations > 0')
+            conditions.append('total_operations >= ?')
+            params.append(min_operations)
+        if max_operations is not None:
+            conditions.append('total_operations <= ?')
+            params.append(max_operations)
+        if ordered_within_days is not None:
+            conditions.append("last_order_at >= datetime('now', ?)")
+            params.append(f'-{int(ordered_within_days)} days')
+        if idle_days is not None:
+            conditions.append("(last_order_at IS NULL OR last_order_at < datetime('now', ?))")
+            params.append(f'-{int(idle_days)} days')
+        if referred is not None:
+            conditions.append('referred_by IS NOT NULL' if referred else 'referred_by IS NULL')
+        if referred_by is not None:
+            conditions.append('referred_by = ?')
+            params.append(referred_by)
+        return conditions, params
+
+    async def count_segment(self, **filters) -> int:
+        conditions, params = self._segment_filters(**filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        async with self.connect() as db:
+            async with db.execute(f'SELECT COUNT(*) FROM users {where}', params) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def iter_segment(self, chunk_size: int = 1000, **filters):
+        """user_id сегмента пачками по chunk_size.
+        
+        Каждая пачка - отдельный короткий запрос по ключу id, поэтому рассылка,
+        которая идет минутами, не держит открытой транзакцию чтения.
+        """
+        conditions, params = self._segment_filters(**filters)
+        conditions.append('id > ?')
+        query = f"SELECT id, user_id FROM users WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        
+        last_id = 0
+        while True:
+            async with self.connect() as db:
+                async with db.execute(query, (*params, last_id, chunk_size)) as cursor:
+                    rows = await cursor.fetchall()
+            if rows:
+                yield [row[1] for row in rows]
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+
+    async def find_user_id_by_username(self, username: str) -> Optional[int]:
+        async with self.connect() as db:
+            async with db.execute(
+                'SELECT user_id FROM users WHERE username = ? COLLATE NOCASE', (username,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def reserve_free_exchange(self, user_id: int, every: int) -> bool:
+        """Резерв бесплатного обмена: проходит, только если заработанных по total_operations
+        обменов больше, чем уже выданных (включая открытые заявки)"""
+        async with self.connect() as db:
+            cursor = await db.execute('''
+                UPDATE users SET loyalty_free_used = COALESCE(loyalty_free_used, 0) + 1
+                WHERE user_id = ? AND (COALESCE(total_operations, 0) + 1) / ? > COALESCE(loyalty_free_used, 0)
+            ''', (user_id, every))
+            await db.commit()
+            return cursor.rowcount == 1
+
+    async def release_free_exchange(self, user_id: int):
+        """Возврат резерва, если заявку так и не удалось создать"""
+        async with self.connect() as db:
+            await db.execute('''
+                UPDATE users SET loyalty_free_used = MAX(COALESCE(loyalty_free_used, 0) - 1, 0)
+                WHERE user_id = ?
+            ''', (user_id,))
+            await db.commit()
+
+    async def rebuild_user_totals(self, batch_size: int = 500, pause: float = 0.05) -> int:
+        """Пересчет счетчиков обменов клиента (REBUILD_USER_TOTALS) по заявкам и архиву пачками по id.
+        
+        Пачка пересчитывается под блокировкой записи, поэтому завершение заявки
+        не попадает между чтением и записью счетчика. Возвращает число строк.
+        """
+        updated = 0
+        async with self.archive_connection() as db:
+            async with db.execute('SELECT MAX(id) FROM users') as cursor:
+                last_id = (await cursor.fetchone())[0] or 0
+            
+            start = 0
+            while start < last_id:
+                await db.execute('BEGIN IMMEDIATE')
+                cursor = await db.execute(
+                    f'{REBUILD_USER_TOTALS} WHERE id > ? AND id <= ?', (start, start + batch_size)
+                )
+                updated += max(cursor.rowcount, 0)
+                await db.commit()
+                start += batch_size
+                await asyncio.sleep(pause)
+        
+        logger.info(f"User totals rebuilt for {updated} users")
+        return updated
+
+    async def purge_expired(self, captcha_days: int = 1, outbox_days: int = 7) -> int:
+        """Удаляет старые сессии капчи и обработанные уведомления; возвращает число строк"""
+        async with self.connect() as db:
+            captcha = await db.execute(
+                "DELETE FROM captcha_sessions WHERE created_at < datetime('now', ?)",
+                (f'-{int(captcha_days)} days',)
+            )
+            outbox = await db.execute(
+                "DELETE FROM notification_outbox WHERE status != 'pending' AND created_at < datetime('now', ?)",
+                (f'-{int(outbox_days)} days',)
+            )
+            await db.commit()
+            return captcha.rowcount + outbox.rowcount
+
     async def create_captcha_session(self, user_id: int, answer: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO captcha_sessions (user_id, answer, attempts)
                 VALUES (?, ?, 0)
@@ -267,89 +829,288 @@ class Database:
             await db.commit()
 
     async def get_captcha_session(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             db.row_factory = aiosqlite.Row
             async with db.execute('SELECT * FROM captcha_sessions WHERE user_id = ?', (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def delete_captcha_session(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute('DELETE FROM captcha_sessions WHERE user_id = ?', (user_id,))
             await db.commit()
 
-    async def update_referral_count(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                async with db.execute(
-                    'SELECT COUNT(*) FROM users WHERE referred_by = ?', 
-                    (user_id,)
-                ) as cursor:
-                    count = (await cursor.fetchone())[0]
-                    logger.info(f"Referral bonus for user {user_id}")
-                
-                await db.execute(
-                    'UPDATE users SET referral_count = ? WHERE user_id = ?',
-                    (count, user_id)
-                )
-                await db.commit()
-                return count
-            except:
-                return 0
+    async def _rebuild_referral_counters(self, db):
+        await db.execute(REBUILD_REFERRAL_COUNTERS)
+        logger.info("Referral counters rebuilt")
+
+    async def rebuild_referral_counters(self):
+        """Полный пересчет referral_count/referral_balance (разовое восстановление)"""
+        async with self.connect() as db:
+            await self._rebuild_referral_counters(db)
+            await db.commit()
 
     async def get_referral_stats(self, user_id: int):
         """Получение статистики рефералов"""
-        try:
-            # Получаем количество рефералов
-            query1 = "SELECT COUNT(*) as count FROM users WHERE referred_by = ?"
-            result1 = await self.execute_query(query1, (user_id,))
-            
-            # execute_query возвращает список, берем первый элемент
-            referral_count = 0
-            if result1 and len(result1) > 0:
-                referral_count = result1[0]['count'] if 'count' in result1[0] else result1[0][0]
+        async with self.connect() as db:
+            async with db.execute(
+                'SELECT referral_count, referral_balance FROM users WHERE user_id = ?',
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        
+        return {
+            'referral_count': row[0] or 0 if row else 0,
+            'referral_balance': row[1] or 0 if row else 0
+        }
+
+    async def add_referral_bonus(self, user_id: int, amount: float, description: str = None,
+                                 kind: str = 'manual', source_user_id: int = None,
+                                 order_id: int = None) -> bool:
+        """Запись в журнал начислений; баланс пользователя обновляет триггер в той же транзакции.
+        
+        Возвращает False, если такое начисление уже проведено.
+        """
+        async with self.connect() as db:
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO referral_bonuses 
+                (user_id, amount, description, kind, source_user_id, order_id, created_at) 
+                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (user_id, amount, description, kind, source_user_id, order_id))
+            await db.commit()
+        
+        self._invalidate_leaderboard()
+        return cursor.rowcount > 0
+
+    async def add_order_referral_bonus(self, order: Dict, percent: float) -> Optional[Dict]:
+        """Процент от завершенной заявки пригласившему клиента.
+        
+        Возвращает {'user_id', 'amount'} начисления или None, если начислять некому
+        или бонус по заявке уже проведен.
+        """
+        async with self.connect() as db:
+            async with db.execute(
+                'SELECT referred_by FROM users WHERE user_id = ?', (order['user_id'],)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row or not row[0]:
+                return None
             
-            # Получаем баланс рефералов (можно добавить таблицу для этого)
-            # Пока возвращаем 0, позже можно добавить логику расчета
-            referral_balance = 0
+            amount = round(order['amount_rub'] * percent / 100, 2)
+            if amount <= 0:
+                return None
             
-            return {
-                'referral_count': referral_count,
-                'referral_balance': referral_balance
-            }
-        except Exception as e:
-            logger.error(f"Get referral stats error: {e}")
-            return {
-                'referral_count': 0,
-                'referral_balance': 0
-            }
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO referral_bonuses
+                (user_id, amount, description, kind, source_user_id, order_id)
+                VALUES (?, ?, ?, 'order', ?, ?)
+            ''', (row[0], amount, f"{percent:g}% от заявки #{order['id']}", order['user_id'], order['id']))
+            await db.commit()
+            if cursor.rowcount <= 0:
+                return None
+        
+        self._invalidate_leaderboard()
+        return {'user_id': row[0], 'amount': amount}
+
+    async def get_referral_ledger(self, user_id: int, limit: int = 10) -> List[Dict]:
+        """Последние начисления пользователя"""
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('''
+                SELECT id, amount, description, kind, source_user_id, order_id, created_at
+                FROM referral_bonuses
+                WHERE user_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (user_id, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_referral_tree(self, user_id: int, max_depth: int = 3) -> List[Dict]:
+        """Рефералы пользователя до max_depth уровней (1 - приглашенные им напрямую)"""
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            # Ограничение глубины заодно защищает от циклов в referred_by
+            async with db.execute('''
+                WITH RECURSIVE tree (user_id, referred_by, depth) AS (
+                    SELECT user_id, referred_by, 1 FROM users WHERE referred_by = ?
+                    UNION ALL
+                    SELECT users.user_id, users.referred_by, tree.depth + 1
+                    FROM users JOIN tree ON users.referred_by = tree.user_id
+                    WHERE tree.depth < ?
+                )
+                SELECT tree.user_id, tree.referred_by, tree.depth,
+                       users.username, users.first_name, users.registration_date
+                FROM tree JOIN users ON users.user_id = tree.user_id
+                ORDER BY tree.depth, tree.user_id
+            ''', (user_id, max_depth)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_referral_levels(self, user_id: int, max_depth: int = 3) -> Dict[int, int]:
+        """Число рефералов на каждом уровне: {уровень: количество}"""
+        async with self.connect() as db:
+            async with db.execute('''
+                WITH RECURSIVE tree (user_id, depth) AS (
+                    SELECT user_id, 1 FROM users WHERE referred_by = ?
+                    UNION ALL
+                    SELECT users.user_id, tree.depth + 1
+                    FROM users JOIN tree ON users.referred_by = tree.user_id
+                    WHERE tree.depth < ?
+                )
+                SELECT depth, COUNT(*) FROM tree GROUP BY depth ORDER BY depth
+            ''', (user_id, max_depth)) as cursor:
+                return dict(await cursor.fetchall())
+
+    async def get_referral_leaderboard(self, limit: int = 10, ttl: float = 300) -> List[Dict]:
+        """Рейтинг по заработанным бонусам, кэшируется на ttl секунд"""
+        cached = self._cached_leaderboard(limit)
+        if cached is not None:
+            return cached
+        
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('''
+                SELECT user_id, username, first_name, referral_count, referral_balance
+                FROM users
+                WHERE referral_balance > 0
+                ORDER BY referral_balance DESC
+                LIMIT ?
+            ''', (limit,)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+        
+        return self._store_leaderboard(limit, rows, ttl)
+
+    @staticmethod
+    async def _insert_notifications(db, rows: Sequence[Tuple]):
+        """Строки (chat_id, text, reply_markup, parse_mode) в очередь уведомлений в транзакции db"""
+        now = time.time()
+        await db.executemany('''
+            INSERT INTO notification_outbox (chat_id, text, reply_markup, parse_mode, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(*row, now) for row in rows])
 
-    async def add_referral_bonus(self, user_id: int, amount: float):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def enqueue_notification(self, chat_id: int, text: str, reply_markup: str = None,
+                                   parse_mode: str = "HTML") -> int:
+        async with self.connect() as db:
+            cursor = await db.execute('''
+                INSERT INTO notification_outbox (chat_id, text, parse_mode, reply_markup, next_attempt_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, text, parse_mode, reply_markup, time.time()))
+            await db.commit()
+            return cursor.lastrowid
+
+    async def get_due_notifications(self, limit: int = 50) -> List[Dict]:
+        """Выбирает и резервирует уведомления к отправке.
+        
+        Выбранные строки откладываются на NOTIFICATION_LEASE секунд одним
+        UPDATE ... RETURNING, поэтому параллельный цикл доставки их не возьмет,
+        а после перезапуска недоставленные уйдут повторно.
+        """
+        now = time.time()
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('''
+                UPDATE notification_outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id LIMIT ?
+                )
+                RETURNING *
+            ''', (now + NOTIFICATION_LEASE, now, limit)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+        return sorted(rows, key=lambda row: row['id'])
+
+    async def get_next_notification_time(self) -> Optional[float]:
+        async with self.connect() as db:
+            async with db.execute(
+                "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending'"
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def mark_notifications_sent(self, notification_ids: List[int]):
+        if not notification_ids:
+            return
+        async with self.connect() as db:
+            await db.executemany(
+                "UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1 WHERE id = ?",
+                [(notification_id,) for notification_id in notification_ids]
+            )
+            await db.commit()
+
+    async def reschedule_notification(self, notification_id: int, delay: float,
+                                      error: str = None, count_attempt: bool = True):
+        async with self.connect() as db:
             await db.execute('''
-                INSERT OR IGNORE INTO referral_bonuses 
-                (user_id, amount, created_at) 
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, amount))
+                UPDATE notification_outbox
+                SET next_attempt_at = ?, last_error = ?, attempts = attempts + ?
+                WHERE id = ?
+            ''', (time.time() + delay, error, 1 if count_attempt else 0, notification_id))
+            await db.commit()
+
+    async def mark_notification_failed(self, notification_id: int, error: str):
+        async with self.connect() as db:
+            await db.execute('''
+                UPDATE notification_outbox
+                SET status = 'failed', last_error = ?, attempts = attempts + 1
+                WHERE id = ?
+            ''', (error, notification_id))
+            await db.commit()
+
+    async def add_scheduled_task(self, kind: str, payload: Dict, run_at: float) -> int:
+        async with self.connect() as db:
+            cursor = await db.execute(
+                'INSERT INTO scheduled_tasks (kind, payload, run_at) VALUES (?, ?, ?)',
+                (kind, json.dumps(payload, ensure_ascii=False), run_at)
+            )
+            await db.commit()
+            return cursor.lastrowid
+
+    async def get_scheduled_tasks(self) -> List[Dict]:
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute('SELECT id, kind, payload, run_at FROM scheduled_tasks') as cursor:
+                rows = await cursor.fetchall()
+                return [
+                    {**dict(row), 'payload': json.loads(row['payload']) if row['payload'] else {}}
+                    for row in rows
+                ]
+
+    async def claim_due_scheduled_tasks(self, now: float) -> List[Dict]:
+        """Забирает (удаляет и возвращает) задачи со сроком до now; каждую получает один процесс"""
+        async with self.connect() as db:
+            db.row_factory = aiosqlite.Row
+            await db.execute('BEGIN IMMEDIATE')
+            async with db.execute(
+                'SELECT id, kind, payload, run_at FROM scheduled_tasks WHERE run_at <= ? ORDER BY run_at, id', (now,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+            await db.executemany('DELETE FROM scheduled_tasks WHERE id = ?', [(row['id'],) for row in rows])
             await db.commit()
+            return [
+                {**dict(row), 'payload': json.loads(row['payload']) if row['payload'] else {}}
+                for row in rows
+            ]
 
     async def execute_query(self, query: str, params: tuple = ()):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             await db.execute(query, params)
             await db.commit()
 
     async def get_statistics(self) -> Dict:
-        async with aiosqlite.connect(self.db_path) as db:
+        # Итоги за все время включают архив, сегодняшние заявки в архив еще не попали
+        async with self.archive_connection() as db:
             async with db.execute('SELECT COUNT(*) FROM users') as cursor:
                 total_users = (await cursor.fetchone())[0]
             
-            async with db.execute('SELECT COUNT(*) FROM orders') as cursor:
+            async with db.execute('SELECT COUNT(*) FROM all_orders') as cursor:
                 total_orders = (await cursor.fetchone())[0]
             
-            async with db.execute('SELECT COUNT(*) FROM orders WHERE status = "finished"') as cursor:
+            async with db.execute(f'SELECT COUNT(*) FROM all_orders WHERE status IN {COMPLETED_STATUSES}') as cursor:
                 completed_orders = (await cursor.fetchone())[0]
             
-            async with db.execute('SELECT SUM(total_amount) FROM orders WHERE status = "finished"') as cursor:
+            async with db.execute(f'SELECT SUM(total_amount) FROM all_orders WHERE status IN {COMPLETED_STATUSES}') as cursor:
                 total_volume = (await cursor.fetchone())[0] or 0
             
             async with db.execute('''
@@ -358,9 +1119,9 @@ class Database:
             ''') as cursor:
                 today_orders = (await cursor.fetchone())[0]
             
-            async with db.execute('''
+            async with db.execute(f'''
                 SELECT SUM(total_amount) FROM orders 
-                WHERE DATE(created_at) = DATE('now') AND status = "finished"
+                WHERE DATE(created_at) = DATE('now') AND status IN {COMPLETED_STATUSES}
             ''') as cursor:
                 today_volume = (await cursor.fetchone())[0] or 0
             
@@ -374,34 +1135,8 @@ class Database:
                 'completion_rate': (completed_orders / total_orders * 100) if total_orders > 0 else 0
             }
 
-    async def is_chat_admin(self, chat_id: int, user_id: int) -> bool:
-        try:
-            admin_chats = [config.ADMIN_CHAT_ID, config.OPERATOR_CHAT_ID]
-            return chat_id in admin_chats and await self.has_admin_rights(user_id)
-        except:
-            return False
-
-    async def has_admin_rights(self, user_id: int) -> bool:
-        if user_id == config.ADMIN_CHAT_ID:
-            return True
-        
-        admin_users = await self.get_setting("admin_users", [])
-        operator_users = await self.get_setting("operator_users", [])
-        
-        return user_id in admin_users or user_id in operator_users
-
-    async def add_admin_chat(self, chat_id: int, chat_title: str = ""):
-        admin_chats = await self.get_setting("admin_chats", [])
-        if chat_id not in admin_chats:
-            admin_chats.append(chat_id)
-            await self.set_setting("admin_chats", admin_chats)
-            await self.set_setting(f"chat_{chat_id}_title", chat_title)
-
-
-
-
     async def get_review(self, review_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connect() as db:
             db.row_factory = aiosqlite.Row
             async with db.execute('SELECT * FROM reviews WHERE id = ?', (review_id,)) as cursor:
                 row = await cursor.fetchone()
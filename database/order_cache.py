@@ -0,0 +1,157 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from database.rows import Order
+from utils.metrics import ORDER_CACHE_REQUESTS
+
+CacheKey = Tuple[str, int]
+
+
+@dataclass
+class _Entry:
+    orders: List[Order]
+    # В списке все заявки пользователя, а не только последние depth
+    complete: bool
+    expires_at: float
+
+
+class OrderHistoryCache:
+    """LRU последних заявок активных пользователей.
+    
+    Общий для всех экземпляров Database (ключ - путь к БД и user_id), поэтому
+    смена статуса из operator.py сразу видна экранам user.py. Записи обновляются
+    слоем БД при создании и изменении заявок; TTL ограничивает устаревание
+    после прямых SQL-запросов в обход Database.
+    
+    ttl <= 0 выключает кэш: так делается для базы, общей для нескольких узлов.
+    
+    Каждое изменение отмечается номером поколения, даже если записи в кэше нет.
+    Чтение из БД берет generation() до запроса и передает его в put(): если
+    за время чтения заявки пользователя менялись, результат в кэш не кладется.
+    """
+
+    def __init__(self, max_users: int = 1000, depth: int = 10, ttl: float = 300.0):
+        self.max_users = max_users
+        self.depth = depth
+        self.ttl = ttl
+        self._entries: 'OrderedDict[CacheKey, _Entry]' = OrderedDict()
+        # (путь к БД, id заявки) -> user_id, чтобы обновлять заявку без запроса к БД
+        self._owners: Dict[CacheKey, int] = {}
+        # Счетчик изменений и поколение последнего изменения пользователя / всей базы
+        self._generation = 0
+        self._changed: 'OrderedDict[CacheKey, int]' = OrderedDict()
+        self._changed_db: Dict[str, int] = {}
+        # Поколение самой новой вытесненной из _changed отметки
+        self._forgotten = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _alive(self, key: CacheKey) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(key)
+            return None
+        return entry
+
+    def _drop(self, key: CacheKey):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for order in entry.orders:
+                self._owners.pop((key[0], order['id']), None)
+
+    def touch(self, db_path: str, user_id: int = None) -> int:
+        """Отметка изменения заявок пользователя (или всей базы, если он неизвестен)"""
+        self._generation += 1
+        if user_id is None:
+            self._changed_db[db_path] = self._generation
+            return self._generation
+        
+        key = (db_path, user_id)
+        self._changed[key] = self._generation
+        self._changed.move_to_end(key)
+        # Забытая отметка делает устаревшими все чтения, начатые до нее
+        while len(self._changed) > self.max_users * 4:
+            _, self._forgotten = self._changed.popitem(last=False)
+        return self._generation
+
+    def generation(self) -> int:
+        """Поколение, которое чтение из БД передает в put()"""
+        return self._generation
+
+    def _changed_since(self, db_path: str, user_id: int, generation: int) -> bool:
+        changed = max(self._changed.get((db_path, user_id), 0), self._changed_db.get(db_path, 0), self._forgotten)
+        return changed > generation
+
+    def has(self, db_path: str, user_id: int) -> bool:
+        return self._alive((db_path, user_id)) is not None
+
+    def get(self, db_path: str, user_id: int, limit: int) -> Optional[List[Order]]:
+        """Копии limit последних заявок или None, если их нужно читать из БД"""
+        key = (db_path, user_id)
+        entry = self._alive(key)
+        if entry is None or (limit > len(entry.orders) and not entry.complete):
+            ORDER_CACHE_REQUESTS.inc(result='miss')
+            return None
+        
+        self._entries.move_to_end(key)
+        ORDER_CACHE_REQUESTS.inc(result='hit')
+        return [order.copy() for order in entry.orders[:limit]]
+
+    def put(self, db_path: str, user_id: int, orders: List[Order], complete: bool, generation: int = None):
+        """Запись результата чтения; generation - значение generation() до запроса к БД"""
+        key = (db_path, user_id)
+        if self.ttl <= 0 or (generation is not None and self._changed_since(db_path, user_id, generation)):
+            return
+        self._drop(key)
+        kept = [order.copy() for order in orders[:self.depth]]
+        self._entries[key] = _Entry(kept, complete and len(orders) <= self.depth, time.monotonic() + self.ttl)
+        for order in kept:
+            self._owners[(db_path, order['id'])] = user_id
+        
+        while len(self._entries) > self.max_users:
+            self._drop(next(iter(self._entries)))
+
+    def add_order(self, db_path: str, order: Order):
+        """Новая заявка становится первой в списке пользователя"""
+        self.touch(db_path, order['user_id'])
+        entry = self._alive((db_path, order['user_id']))
+        # Заявка уже могла попасть в список вместе с чтением, закончившимся после вставки
+        if entry is None or (db_path, order['id']) in self._owners:
+            return
+        
+        entry.orders.insert(0, order.copy())
+        self._owners[(db_path, order['id'])] = order['user_id']
+        while len(entry.orders) > self.depth:
+            removed = entry.orders.pop()
+            self._owners.pop((db_path, removed['id']), None)
+            entry.complete = False
+
+    def update_order(self, db_path: str, order_id: int, fields: Dict):
+        """Обновление полей (или всей строки) заявки, если она в кэше"""
+        user_id = fields.get('user_id', self._owners.get((db_path, order_id)))
+        self.touch(db_path, user_id)
+        entry = self._alive((db_path, user_id)) if user_id is not None else None
+        if entry is None:
+            return
+        
+        for order in entry.orders:
+            if order['id'] == order_id:
+                order.update(fields)
+                break
+
+    def invalidate(self, db_path: str, user_id: int = None):
+        """Сброс записи пользователя или всех пользователей базы"""
+        self.touch(db_path, user_id)
+        if user_id is not None:
+            self._drop((db_path, user_id))
+            return
+        for key in [key for key in self._entries if key[0] == db_path]:
+            self._drop(key)
+
+
+order_cache = OrderHistoryCache()
@@ -0,0 +1,116 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Допустимые переходы статусов заявки
+TRANSITIONS = {
+    'waiting': ('paid_by_client', 'cancelled', 'problem'),
+    'paid_by_client': ('completed', 'problem', 'cancelled'),
+    'problem': ('paid_by_client', 'completed', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+
+
+@dataclass
+class OrderEvent:
+    """Событие смены статуса заявки"""
+    order: Dict
+    from_status: str
+    to_status: str
+    actor: Optional[str] = None
+    details: Dict[str, Any] = field(default_factory=dict)
+
+
+OrderEventHandler = Callable[[OrderEvent], Awaitable[None]]
+
+
+class OrderStateMachine:
+    """Смена статусов заявок через compare-and-set с журналом order_events"""
+
+    def __init__(self, db, outbox=None):
+        self.db = db
+        # Очередь уведомлений (NotificationOutbox) для подписчиков notify
+        self.outbox = outbox
+        self._subscribers: Dict[str, List[OrderEventHandler]] = {}
+        self._notifiers: Dict[str, List[OrderEventHandler]] = {}
+
+    def subscribe(self, to_status: str, handler: OrderEventHandler):
+        self._subscribers.setdefault(to_status, []).append(handler)
+
+    def on(self, to_status: str):
+        """Декоратор для подписки на переход в статус (после коммита)"""
+        def decorator(handler: OrderEventHandler) -> OrderEventHandler:
+            self.subscribe(to_status, handler)
+            return handler
+        return decorator
+
+    def notify(self, to_status: str):
+        """Декоратор для уведомлений о переходе в статус.
+        
+        Обработчик вызывается внутри транзакции смены статуса и только ставит
+        сообщения в outbox.enqueue: они пишутся в очередь той же транзакцией.
+        Обращаться к БД из него нельзя - строка заявки заблокирована.
+        """
+        def decorator(handler: OrderEventHandler) -> OrderEventHandler:
+            self._notifiers.setdefault(to_status, []).append(handler)
+            return handler
+        return decorator
+
+    @staticmethod
+    def can_transition(from_status: str, to_status: str) -> bool:
+        return to_status in TRANSITIONS.get(from_status, ())
+
+    async def transition(self, order_id: int, to_status: str, from_statuses: Iterable[str] = None,
+                         actor: str = None, details: Dict[str, Any] = None,
+                         **fields) -> Optional[Dict]:
+        """Переводит заявку в статус to_status.
+        
+        Возвращает обновленную заявку или None, если переход недопустим
+        или уже выполнен другим обработчиком.
+        """
+        allowed = [status for status, targets in TRANSITIONS.items() if to_status in targets]
+        if from_statuses is not None:
+            allowed = [status for status in allowed if status in from_statuses]
+        if not allowed:
+            raise ValueError(f"Unknown order status transition to {to_status}")
+        
+        notifications = None
+        if self.outbox and self._notifiers.get(to_status):
+            async def notifications(order: Dict, from_status: str):
+                with self.outbox.collect() as rows:
+                    await self._emit(self._notifiers, OrderEvent(order, from_status, to_status, actor, details or {}))
+                return rows
+        
+        result = await self.db.transition_order_status(
+            order_id, allowed, to_status, actor=actor, details=details, notifications=notifications, **fields
+        )
+        if not result:
+            logger.info(f"Order {order_id}: transition to {to_status} rejected", extra={'order_id': order_id})
+            return None
+        
+        order, from_status = result
+        logger.info(
+            f"Order {order_id}: {from_status} -> {to_status} by {actor}",
+            extra={'order_id': order_id, 'user_id': order.get('user_id')}
+        )
+        if notifications:
+            self.outbox.wakeup()
+        await self._emit(self._subscribers, OrderEvent(
+            order=order,
+            from_status=from_status,
+            to_status=to_status,
+            actor=actor,
+            details=details or {}
+        ))
+        return order
+
+    @staticmethod
+    async def _emit(subscribers: Dict[str, List[OrderEventHandler]], event: OrderEvent):
+        for handler in subscribers.get(event.to_status, []):
+            try:
+                await handler(event)
+            except Exception as e:
+                logger.error(f"Order event handler {handler.__name__} error: {e}")
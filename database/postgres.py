@@ -0,0 +1,1240 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from config import config
+from database.order_cache import order_cache
+from database.rows import Order, User
+from database.migrations import LOYALTY_EVERY, REBUILD_REFERRAL_COUNTERS, REBUILD_USER_TOTALS
+from database.storage import (
+    ARCHIVABLE_STATUSES, COMPLETED_STATUSES, NOTIFICATION_LEASE, ORDER_EVENT_COLUMNS, ORDER_UPDATE_FIELDS,
+    Storage, TransitionNotifications,
+)
+from utils.metrics import DB_ERRORS, DB_SECONDS, instrument_methods
+
+logger = logging.getLogger(__name__)
+
+# Время в базе - UTC без зоны, как CURRENT_TIMESTAMP в SQLite
+UTC_NOW = "(now() AT TIME ZONE 'utc')"
+
+# Текстовые колонки заявки: asyncpg не приводит числа к text сам
+ORDER_TEXT_FIELDS = ('onlypays_id', 'status', 'requisites', 'personal_id', 'operator_notes')
+
+# Выражения поиска; индексы GIN построены по тем же выражениям
+USERS_SEARCH_VECTOR = (
+    "to_tsvector('simple', user_id::text || ' ' || coalesce(username, '') || ' ' || "
+    "coalesce(first_name, '') || ' ' || coalesce(last_name, ''))"
+)
+ORDERS_SEARCH_VECTOR = (
+    "to_tsvector('simple', id::text || ' ' || coalesce(personal_id, '') || ' ' || "
+    "coalesce(onlypays_id, '') || ' ' || coalesce(btc_address, '') || ' ' || "
+    "coalesce(requisites, '') || ' ' || coalesce(operator_notes, ''))"
+)
+
+SCHEMA_LOCK_ID = 0x0512B17
+
+# Колонки orders базовой схемы; новые колонки добавляют миграции, они же пересоздают all_orders
+BASELINE_ORDER_COLUMNS = Order.COLUMNS[:Order.COLUMNS.index('received_sum') + 1]
+
+
+def _all_orders_view(columns: Sequence[str]) -> str:
+    return f'''
+    CREATE OR REPLACE VIEW all_orders AS
+    SELECT {', '.join(columns)}, 0 AS archived FROM orders
+    UNION ALL
+    SELECT {', '.join(columns)}, 1 AS archived FROM archive.orders
+    '''
+
+
+BASELINE = (
+    f'''
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT UNIQUE NOT NULL,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        phone_number TEXT,
+        registration_date TIMESTAMP DEFAULT {UTC_NOW},
+        is_blocked BOOLEAN DEFAULT FALSE,
+        referral_code TEXT,
+        referred_by BIGINT,
+        total_operations INTEGER DEFAULT 0,
+        total_amount DOUBLE PRECISION DEFAULT 0,
+        referral_count INTEGER DEFAULT 0,
+        referral_balance DOUBLE PRECISION DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_users_username ON users (lower(username))',
+    'CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_users_referral_balance
+    ON users (referral_balance DESC) WHERE referral_balance > 0
+    ''',
+    f'CREATE INDEX IF NOT EXISTS idx_users_search ON users USING GIN ({USERS_SEARCH_VECTOR})',
+    f'''
+    CREATE TABLE IF NOT EXISTS orders (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        onlypays_id TEXT,
+        amount_rub DOUBLE PRECISION NOT NULL,
+        amount_btc DOUBLE PRECISION,
+        btc_address TEXT NOT NULL,
+        rate DOUBLE PRECISION NOT NULL,
+        total_amount DOUBLE PRECISION NOT NULL,
+        payment_type TEXT NOT NULL,
+        status TEXT DEFAULT 'waiting',
+        created_at TIMESTAMP DEFAULT {UTC_NOW},
+        completed_at TIMESTAMP,
+        requisites TEXT,
+        is_problematic BOOLEAN DEFAULT FALSE,
+        operator_notes TEXT,
+        personal_id TEXT,
+        received_sum DOUBLE PRECISION
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_personal ON orders (personal_id)',
+    f'CREATE INDEX IF NOT EXISTS idx_orders_search ON orders USING GIN ({ORDERS_SEARCH_VECTOR})',
+    '''
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS captcha_sessions (
+        user_id BIGINT PRIMARY KEY,
+        answer TEXT NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT {UTC_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS referral_bonuses (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL REFERENCES users (user_id),
+        amount DOUBLE PRECISION NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT {UTC_NOW},
+        kind TEXT NOT NULL DEFAULT 'manual',
+        source_user_id BIGINT,
+        order_id BIGINT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_referral_bonuses_user ON referral_bonuses (user_id, id)',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS uniq_referral_bonuses_signup
+    ON referral_bonuses (source_user_id) WHERE kind = 'signup'
+    ''',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS uniq_referral_bonuses_order
+    ON referral_bonuses (order_id, user_id) WHERE kind = 'order'
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION referral_bonuses_balance() RETURNS trigger AS $$
+    BEGIN
+        UPDATE users SET referral_balance = referral_balance + NEW.amount WHERE user_id = NEW.user_id;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE TRIGGER referral_bonuses_balance AFTER INSERT ON referral_bonuses
+    FOR EACH ROW EXECUTE FUNCTION referral_bonuses_balance()
+    ''',
+    # Исправления проводятся новой записью (kind = 'adjustment'), а не правкой старой
+    '''
+    CREATE OR REPLACE FUNCTION referral_bonuses_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'referral_bonuses is append-only';
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE TRIGGER referral_bonuses_no_change BEFORE UPDATE OR DELETE ON referral_bonuses
+    FOR EACH ROW EXECUTE FUNCTION referral_bonuses_append_only()
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS order_events (
+        id BIGSERIAL PRIMARY KEY,
+        order_id BIGINT NOT NULL,
+        from_status TEXT,
+        to_status TEXT NOT NULL,
+        actor TEXT,
+        details TEXT,
+        created_at TIMESTAMP DEFAULT {UTC_NOW}
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_order_events_order ON order_events (order_id, id)',
+    f'''
+    CREATE TABLE IF NOT EXISTS notification_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        reply_markup TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at DOUBLE PRECISION NOT NULL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT {UTC_NOW}
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (status, next_attempt_at)',
+    f'''
+    CREATE TABLE IF NOT EXISTS scheduled_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT,
+        run_at DOUBLE PRECISION NOT NULL,
+        created_at TIMESTAMP DEFAULT {UTC_NOW}
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS reviews (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        text TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        status TEXT DEFAULT 'pending'
+    )
+    ''',
+    # Архив закрытых заявок - отдельная схема той же базы
+    'CREATE SCHEMA IF NOT EXISTS archive',
+    f'''
+    CREATE TABLE IF NOT EXISTS archive.orders (
+        LIKE orders,
+        archived_at TIMESTAMP DEFAULT {UTC_NOW},
+        PRIMARY KEY (id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_archive_orders_personal ON archive.orders (personal_id)',
+    'CREATE INDEX IF NOT EXISTS idx_archive_orders_user_created ON archive.orders (user_id, created_at)',
+    'CREATE TABLE IF NOT EXISTS archive.order_events (LIKE order_events, PRIMARY KEY (id))',
+    'CREATE INDEX IF NOT EXISTS idx_archive_order_events_order ON archive.order_events (order_id, id)',
+    _all_orders_view(BASELINE_ORDER_COLUMNS),
+)
+
+USER_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_date)',
+    'CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE total_operations > 0',
+    'CREATE INDEX IF NOT EXISTS idx_users_blocked ON users (user_id) WHERE is_blocked',
+)
+
+# Дата последней заявки для сегментов рассылки; поддерживается триггером
+LAST_ORDER_AT = (
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_order_at TIMESTAMP',
+    'CREATE INDEX IF NOT EXISTS idx_users_last_order ON users (last_order_at)',
+    '''
+    CREATE OR REPLACE FUNCTION orders_last_order_at() RETURNS trigger AS $$
+    BEGIN
+        UPDATE users SET last_order_at = NEW.created_at WHERE user_id = NEW.user_id;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE TRIGGER orders_last_order_at AFTER INSERT ON orders
+    FOR EACH ROW EXECUTE FUNCTION orders_last_order_at()
+    ''',
+    '''
+    UPDATE users SET last_order_at = latest.created_at
+    FROM (SELECT user_id, MAX(created_at) AS created_at FROM all_orders GROUP BY user_id) AS latest
+    WHERE latest.user_id = users.user_id
+    ''',
+)
+
+# Причина, по которой сообщения пользователю не доходят (бот заблокирован и т.п.)
+DELIVERY_ERROR = (
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS delivery_error TEXT',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS delivery_error_at TIMESTAMP',
+    'CREATE INDEX IF NOT EXISTS idx_users_undeliverable ON users (user_id) WHERE delivery_error IS NOT NULL',
+)
+
+# Бесплатные обмены по программе лояльности: признак на заявке и счетчик выданных у клиента.
+# Прошлые бесплатные обмены считаются выданными по завершенным заявкам с архивом:
+# total_operations до rebuild_user_totals мог не вестись
+LOYALTY_FREE = (
+    'ALTER TABLE orders ADD COLUMN IF NOT EXISTS loyalty_free BOOLEAN DEFAULT FALSE',
+    'ALTER TABLE archive.orders ADD COLUMN IF NOT EXISTS loyalty_free BOOLEAN DEFAULT FALSE',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS loyalty_free_used INTEGER DEFAULT 0',
+    f'''
+    UPDATE users SET loyalty_free_used = GREATEST(COALESCE(users.total_operations, 0), completed.count) / {LOYALTY_EVERY}
+    FROM (
+        SELECT user_id, COUNT(*) AS count FROM all_orders
+        WHERE status IN {COMPLETED_STATUSES} GROUP BY user_id
+    ) AS completed
+    WHERE completed.user_id = users.user_id
+    ''',
+    'DROP VIEW IF EXISTS all_orders',
+    _all_orders_view(Order.COLUMNS),
+)
+
+# (версия, описание, DDL); версия хранится в schema_version
+MIGRATIONS = (
+    (1, 'baseline schema', BASELINE),
+    (2, 'admin user indexes', USER_INDEXES),
+    (3, 'users.last_order_at', LAST_ORDER_AT),
+    (4, 'users.delivery_error', DELIVERY_ERROR),
+    (5, 'users.total_operations index', (
+        'DROP INDEX IF EXISTS idx_users_active',
+        'CREATE INDEX IF NOT EXISTS idx_users_operations ON users (total_operations) WHERE total_operations > 0',
+    )),
+    (6, 'loyalty free exchanges', LOYALTY_FREE),
+    # Перенесенные в архив заявки остаются в поиске /search
+    (7, 'archive orders search index', (
+        f'CREATE INDEX IF NOT EXISTS idx_archive_orders_search ON archive.orders USING GIN ({ORDERS_SEARCH_VECTOR})',
+    )),
+)
+
+
+@lru_cache(maxsize=512)
+def _sql(query: str) -> str:
+    """Плейсхолдеры '?' -> $1, $2, ...: запросы пишутся так же, как для SQLite"""
+    counter = iter(range(1, query.count('?') + 1))
+    return re.sub(r'\?', lambda match: f'${next(counter)}', query)
+
+
+def _plain(value: Any) -> Any:
+    # Обработчики работают с датами как со строками SQLite ('2024-01-31 12:00:00')
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _values(row) -> tuple:
+    return tuple(_plain(value) for value in row)
+
+
+def _dict(row) -> Dict:
+    return {key: _plain(value) for key, value in row.items()}
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды ('UPDATE 1', 'INSERT 0 1')"""
+    tail = status.rsplit(' ', 1)[-1]
+    return int(tail) if tail.isdigit() else 0
+
+
+_pools: Dict[str, asyncpg.Pool] = {}
+_pools_lock = asyncio.Lock()
+
+
+async def get_pool(dsn: str) -> asyncpg.Pool:
+    """Пул соединений на процесс, общий для всех экземпляров PostgresDatabase"""
+    pool = _pools.get(dsn)
+    if pool is None:
+        async with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                # asyncpg готовит каждый запрос один раз на соединение и держит его в кэше
+                pool = _pools[dsn] = await asyncpg.create_pool(
+                    dsn,
+                    min_size=config.DB_POOL_MIN_SIZE,
+                    max_size=config.DB_POOL_MAX_SIZE,
+                    statement_cache_size=config.DB_STATEMENT_CACHE_SIZE,
+                )
+    return pool
+
+
+async def close_pools():
+    for pool in _pools.values():
+        await pool.close()
+    _pools.clear()
+
+
+@instrument_methods(DB_SECONDS, DB_ERRORS)
+class PostgresDatabase(Storage):
+    """Хранилище в PostgreSQL (asyncpg): пул соединений, подготовленные запросы.
+    
+    Несколько узлов бота могут работать с одной базой: смена статуса заявки
+    блокирует строку, а очередь уведомлений и архивация разбирают строки
+    через SKIP LOCKED. Встроенных снимков нет (supports_backup = False):
+    бэкап делается pg_dump или средствами сервера БД.
+    """
+    
+    shared = True
+
+    @asynccontextmanager
+    async def acquire(self):
+        pool = await get_pool(self.db_path)
+        async with pool.acquire() as connection:
+            yield connection
+
+    async def init_db(self):
+        """Схема по версиям из MIGRATIONS; узлы, стартующие одновременно, ждут друг друга"""
+        async with self.acquire() as db:
+            async with db.transaction():
+                await db.execute('SELECT pg_advisory_xact_lock($1)', SCHEMA_LOCK_ID)
+                await db.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+                before = await db.fetchval('SELECT MAX(version) FROM schema_version') or 0
+                
+                for version, description, statements in MIGRATIONS:
+                    if version <= before:
+                        continue
+                    logger.info(f"Applying PostgreSQL migration {version}: {description}")
+                    for statement in statements:
+                        await db.execute(statement)
+                    await db.execute('INSERT INTO schema_version (version) VALUES ($1)', version)
+        
+        after = MIGRATIONS[-1][0]
+        if before != after:
+            logger.info(f"Database schema migrated from version {before} to {after}")
+
+    @staticmethod
+    def _ts_query(query: str) -> Optional[str]:
+        """Ввод в префиксный tsquery: каждое слово ищется как начало токена"""
+        tokens = re.findall(r'\w+', query)
+        if not tokens:
+            return None
+        return ' & '.join(f'{token}:*' for token in tokens)
+
+    async def search_users(self, query: str, limit: int = 10) -> List[Dict]:
+        match = self._ts_query(query)
+        if not match:
+            return []
+        
+        async with self.acquire() as db:
+            rows = await db.fetch(_sql(f'''
+                SELECT user_id, username, first_name, last_name, is_blocked
+                FROM users
+                WHERE {USERS_SEARCH_VECTOR} @@ to_tsquery('simple', ?)
+                ORDER BY ts_rank({USERS_SEARCH_VECTOR}, to_tsquery('simple', ?)) DESC
+                LIMIT ?
+            '''), match, match, limit)
+        return [_dict(row) for row in rows]
+
+    async def search_orders(self, query: str, limit: int = 10) -> List[Dict]:
+        """Поиск заявок в рабочих таблицах и архиве (индексы GIN в обеих); archived = 1 у перенесенных"""
+        match = self._ts_query(query)
+        if not match:
+            return []
+        
+        async with self.acquire() as db:
+            rows = await db.fetch(_sql(f'''
+                SELECT id, user_id, total_amount, status, created_at, personal_id, archived
+                FROM all_orders
+                WHERE {ORDERS_SEARCH_VECTOR} @@ to_tsquery('simple', ?)
+                ORDER BY ts_rank({ORDERS_SEARCH_VECTOR}, to_tsquery('simple', ?)) DESC
+                LIMIT ?
+            '''), match, match, limit)
+        return [_dict(row) for row in rows]
+
+    async def add_user(self, user_id: int, username: str = None,
+                       first_name: str = None, last_name: str = None,
+                       referred_by: int = None, signup_bonus: float = 0) -> bool:
+        """Регистрация пользователя; счетчик и бонус пригласившего - в той же транзакции"""
+        if referred_by == user_id:
+            referred_by = None
+        
+        async with self.acquire() as db:
+            try:
+                async with db.transaction():
+                    # Несуществующий пригласивший превращается в NULL
+                    await db.execute(_sql('''
+                        INSERT INTO users (user_id, username, first_name, last_name, referred_by)
+                        VALUES (?, ?, ?, ?, (SELECT user_id FROM users WHERE user_id = ?))
+                    '''), user_id, username, first_name, last_name, referred_by)
+                    if referred_by:
+                        await db.execute(
+                            'UPDATE users SET referral_count = referral_count + 1 WHERE user_id = $1',
+                            referred_by
+                        )
+                    if referred_by and signup_bonus:
+                        await db.execute(_sql('''
+                            INSERT INTO referral_bonuses (user_id, amount, description, kind, source_user_id)
+                            SELECT user_id, ?, ?, 'signup', ? FROM users WHERE user_id = ?
+                        '''), float(signup_bonus), 'Бонус за приглашение', user_id, referred_by)
+            except asyncpg.UniqueViolationError:
+                return False
+        
+        if referred_by and signup_bonus:
+            self._invalidate_leaderboard()
+        return True
+
+    async def get_user(self, user_id: int, fields: Sequence[str] = None) -> Optional[User]:
+        """Пользователь с колонками fields (по умолчанию - все)"""
+        columns = User.select_list(fields)
+        async with self.acquire() as db:
+            row = await db.fetchrow(f"SELECT {', '.join(columns)} FROM users WHERE user_id = $1", user_id)
+        return User.from_row(columns, _values(row)) if row else None
+
+    async def update_user(self, user_id: int, **kwargs):
+        if not kwargs:
+            return
+        
+        fields = ', '.join([f"{key} = ?" for key in kwargs.keys()])
+        async with self.acquire() as db:
+            await db.execute(_sql(f'UPDATE users SET {fields} WHERE user_id = ?'), *kwargs.values(), user_id)
+
+    async def get_all_users(self) -> List[int]:
+        async with self.acquire() as db:
+            rows = await db.fetch('SELECT user_id FROM users WHERE is_blocked = FALSE')
+        return [row[0] for row in rows]
+
+    async def iter_users(self, chunk_size: int = 1000):
+        """Все пользователи пачками по chunk_size строк (User.COLUMNS) через серверный курсор"""
+        async with self.acquire() as db:
+            async with db.transaction():
+                cursor = await db.cursor(f"SELECT {', '.join(User.COLUMNS)} FROM users ORDER BY id")
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield [_values(row) for row in rows]
+
+    async def count_users(self) -> Dict[str, int]:
+        """Счетчики пользователей для админки; каждый COUNT читает только индекс"""
+        queries = {
+            'total': 'SELECT COUNT(*) FROM users',
+            'blocked': 'SELECT COUNT(*) FROM users WHERE is_blocked',
+            'active': 'SELECT COUNT(*) FROM users WHERE total_operations > 0',
+            'today': f"SELECT COUNT(*) FROM users WHERE registration_date >= date_trunc('day', {UTC_NOW})",
+            'week': f"SELECT COUNT(*) FROM users WHERE registration_date >= date_trunc('day', {UTC_NOW}) - interval '7 days'",
+            'unreachable': 'SELECT COUNT(*) FROM users WHERE delivery_error IS NOT NULL',
+        }
+        async with self.acquire() as db:
+            return {key: await db.fetchval(query) for key, query in queries.items()}
+
+    async def get_recent_users(self, limit: int = 10) -> List[Dict]:
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                SELECT user_id, username, first_name, registration_date, total_operations
+                FROM users ORDER BY registration_date DESC LIMIT $1
+            ''', limit)
+        return [_dict(row) for row in rows]
+
+    async def mark_undeliverable(self, failures: List[Tuple[int, str]]):
+        """Отмечает пачку (user_id, причина) одной транзакцией; такие чаты выпадают из рассылок"""
+        if not failures:
+            return
+        async with self.acquire() as db:
+            await db.executemany(
+                f'UPDATE users SET delivery_error = $1, delivery_error_at = {UTC_NOW} WHERE user_id = $2',
+                [(reason, user_id) for user_id, reason in failures]
+            )
+
+    async def clear_delivery_error(self, user_id: int):
+        async with self.acquire() as db:
+            await db.execute(
+                'UPDATE users SET delivery_error = NULL, delivery_error_at = NULL WHERE user_id = $1', user_id
+            )
+
+    @staticmethod
+    def _segment_filters(registered_within_days: int = None, min_operations: int = None,
+                         max_operations: int = None, ordered_within_days: int = None, idle_days: int = None,
+                         referred: bool = None, referred_by: int = None, blocked: Optional[bool] = False,
+                         reachable: Optional[bool] = True):
+        """Условия WHERE и параметры сегмента рассылки; None в blocked/reachable - без этого условия"""
+        conditions = []
+        params = []
+        
+        if blocked is not None:
+            conditions.append('is_blocked' if blocked else 'NOT is_blocked')
+        if reachable is not None:
+            conditions.append('delivery_error IS NULL' if reachable else 'delivery_error IS NOT NULL')
+        if registered_within_days is not None:
+            conditions.append(f'registration_date >= {UTC_NOW} - make_interval(days => ?)')
+            params.append(int(registered_within_days))
+        if min_operations:
+            # Литерал совпадает с условием частичного индекса idx_users_operations
+            conditions.append('total_operations > 0')
+            conditions.append('total_operations >= ?')
+            params.append(min_operations)
+        if max_operations is not None:
+            conditions.append('total_operations <= ?')
+            params.append(max_operations)
+        if ordered_within_days is not None:
+            conditions.append(f'last_order_at >= {UTC_NOW} - make_interval(days => ?)')
+            params.append(int(ordered_within_days))
+        if idle_days is not None:
+            conditions.append(f'(last_order_at IS NULL OR last_order_at < {UTC_NOW} - make_interval(days => ?))')
+            params.append(int(idle_days))
+        if referred is not None:
+            conditions.append('referred_by IS NOT NULL' if referred else 'referred_by IS NULL')
+        if referred_by is not None:
+            conditions.append('referred_by = ?')
+            params.append(referred_by)
+        return conditions, params
+
+    async def count_segment(self, **filters) -> int:
+        conditions, params = self._segment_filters(**filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        async with self.acquire() as db:
+            return await db.fetchval(_sql(f'SELECT COUNT(*) FROM users {where}'), *params)
+
+    async def iter_segment(self, chunk_size: int = 1000, **filters):
+        """user_id сегмента пачками по ключу id; соединение возвращается в пул между пачками"""
+        conditions, params = self._segment_filters(**filters)
+        conditions.append('id > ?')
+        query = _sql(f"SELECT id, user_id FROM users WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?")
+        
+        last_id = 0
+        while True:
+            async with self.acquire() as db:
+                rows = await db.fetch(query, *params, last_id, chunk_size)
+            if rows:
+                yield [row[1] for row in rows]
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+
+    async def find_user_id_by_username(self, username: str) -> Optional[int]:
+        async with self.acquire() as db:
+            return await db.fetchval('SELECT user_id FROM users WHERE lower(username) = lower($1)', username)
+
+    async def reserve_free_exchange(self, user_id: int, every: int) -> bool:
+        """Резерв бесплатного обмена: проходит, только если заработанных по total_operations
+        обменов больше, чем уже выданных (включая открытые заявки)"""
+        async with self.acquire() as db:
+            status = await db.execute('''
+                UPDATE users SET loyalty_free_used = COALESCE(loyalty_free_used, 0) + 1
+                WHERE user_id = $1 AND (COALESCE(total_operations, 0) + 1) / $2 > COALESCE(loyalty_free_used, 0)
+            ''', user_id, every)
+        return _rowcount(status) == 1
+
+    async def release_free_exchange(self, user_id: int):
+        """Возврат резерва, если заявку так и не удалось создать"""
+        async with self.acquire() as db:
+            await db.execute('''
+                UPDATE users SET loyalty_free_used = GREATEST(COALESCE(loyalty_free_used, 0) - 1, 0)
+                WHERE user_id = $1
+            ''', user_id)
+
+    async def create_order(self, user_id: int, amount_rub: float, amount_btc: float,
+                           btc_address: str, rate: float, total_amount: float, payment_type: str,
+                           loyalty_free: bool = False) -> int:
+        async with self.acquire() as db:
+            order_id = await db.fetchval(_sql('''
+                INSERT INTO orders (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type,
+                                    loyalty_free)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            '''), user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type, loyalty_free)
+            
+            # Строку перечитываем только для пользователя, чья история уже в кэше
+            order_cache.touch(self.db_path, user_id)
+            if order_cache.has(self.db_path, user_id):
+                order = await self._fetch_order(db, order_id, Order.light_columns())
+                if order:
+                    order_cache.add_order(self.db_path, order)
+        return order_id
+
+    @staticmethod
+    async def _fetch_order(db, order_id: int, columns: Sequence[str]) -> Optional[Order]:
+        row = await db.fetchrow(f"SELECT {', '.join(columns)} FROM orders WHERE id = $1", order_id)
+        return Order.from_row(columns, _values(row)) if row else None
+
+    async def get_order(self, order_id: int, fields: Sequence[str] = None) -> Optional[Order]:
+        """Заявка с колонками fields; по умолчанию без requisites/operator_notes"""
+        columns = Order.select_list(fields)
+        async with self.acquire() as db:
+            return await self._fetch_order(db, order_id, columns)
+
+    async def load_order_fields(self, order: Order, *fields: str) -> Order:
+        """Догружает невыбранные колонки заявки (по умолчанию - тяжелые текстовые)"""
+        missing = order.missing(Order.select_list(fields or Order.HEAVY))
+        if missing:
+            async with self.acquire() as db:
+                loaded = await self._fetch_order(db, order['id'], missing)
+            if loaded:
+                order.update(loaded)
+        return order
+
+    @staticmethod
+    def _order_value(field: str, value: Any) -> Any:
+        return str(value) if field in ORDER_TEXT_FIELDS and value is not None else value
+
+    async def update_order(self, order_id: int, **kwargs):
+        """Обновление заказа"""
+        fields = {
+            field: self._order_value(field, value)
+            for field, value in kwargs.items() if field in ORDER_UPDATE_FIELDS
+        }
+        if not fields:
+            return
+        
+        set_clause = ', '.join(f"{field} = ?" for field in fields)
+        async with self.acquire() as db:
+            await db.execute(_sql(f"UPDATE orders SET {set_clause} WHERE id = ?"), *fields.values(), order_id)
+        order_cache.update_order(self.db_path, order_id, fields)
+
+    async def transition_order_status(self, order_id: int, from_statuses: List[str], to_status: str,
+                                      actor: str = None, details: Dict = None,
+                                      notifications: TransitionNotifications = None, **kwargs):
+        """Атомарная смена статуса заявки (строка блокируется до конца транзакции) с записью в order_events.
+        
+        Уведомления notifications попадают в очередь в той же транзакции.
+        """
+        async with self.acquire() as db:
+            async with db.transaction():
+                from_status = await db.fetchval('SELECT status FROM orders WHERE id = $1 FOR UPDATE', order_id)
+                if from_status not in from_statuses:
+                    return None
+                
+                set_clause = ['status = ?']
+                values = [to_status]
+                for field, value in kwargs.items():
+                    if field in ORDER_UPDATE_FIELDS and field != 'status':
+                        set_clause.append(f"{field} = ?")
+                        values.append(self._order_value(field, value))
+                if to_status == 'completed':
+                    set_clause.append(f'completed_at = {UTC_NOW}')
+                
+                await db.execute(_sql(f"UPDATE orders SET {', '.join(set_clause)} WHERE id = ?"), *values, order_id)
+                await db.execute(_sql('''
+                    INSERT INTO order_events (order_id, from_status, to_status, actor, details)
+                    VALUES (?, ?, ?, ?, ?)
+                '''), order_id, from_status, to_status, actor,
+                    json.dumps(details, ensure_ascii=False) if details else None)
+                if to_status == 'completed':
+                    # Счетчики обменов клиента растут в той же транзакции
+                    await db.execute('''
+                        UPDATE users SET
+                            total_operations = COALESCE(users.total_operations, 0) + 1,
+                            total_amount = COALESCE(users.total_amount, 0) + orders.total_amount
+                        FROM orders WHERE orders.id = $1 AND users.user_id = orders.user_id
+                    ''', order_id)
+                elif to_status == 'cancelled':
+                    # Отмена бесплатной по программе заявки возвращает зарезервированный обмен
+                    await db.execute('''
+                        UPDATE users SET loyalty_free_used = GREATEST(COALESCE(users.loyalty_free_used, 0) - 1, 0)
+                        FROM orders
+                        WHERE orders.id = $1 AND orders.loyalty_free AND users.user_id = orders.user_id
+                    ''', order_id)
+                
+                order = await self._fetch_order(db, order_id, Order.COLUMNS)
+                if notifications:
+                    now = time.time()
+                    await db.executemany('''
+                        INSERT INTO notification_outbox (chat_id, text, reply_markup, parse_mode, next_attempt_at)
+                        VALUES ($1, $2, $3, $4, $5)
+                    ''', [(*row, now) for row in await notifications(order, from_status)])
+        order_cache.update_order(self.db_path, order_id, order)
+        return order, from_status
+
+    async def get_order_events(self, order_id: int) -> List[Dict]:
+        async with self.acquire() as db:
+            rows = await db.fetch('SELECT * FROM order_events WHERE order_id = $1 ORDER BY id', order_id)
+        return [_dict(row) for row in rows]
+
+    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Order]:
+        """Последние заявки пользователя без тяжелых колонок; повторные запросы обслуживает order_cache"""
+        cached = order_cache.get(self.db_path, user_id, limit)
+        if cached is not None:
+            return cached
+        
+        fetch = max(limit, order_cache.depth)
+        columns = Order.light_columns()
+        # Смена статуса во время чтения не должна оставить в кэше старую строку
+        generation = order_cache.generation()
+        async with self.acquire() as db:
+            rows = await db.fetch(f'''
+                SELECT {', '.join(columns)} FROM orders WHERE user_id = $1
+                ORDER BY created_at DESC LIMIT $2
+            ''', user_id, fetch)
+        orders = Order.from_rows(columns, (_values(row) for row in rows))
+        
+        order_cache.put(self.db_path, user_id, orders, complete=len(orders) < fetch, generation=generation)
+        return orders[:limit]
+
+    async def archive_orders(self, retention_days: int, batch_size: int = 500, pause: float = 0.05) -> int:
+        """Переносит закрытые заявки старше retention_days (с их order_events) в схему archive.
+        
+        Каждая пачка - отдельная транзакция; строки, которые уже переносит
+        другой узел, пропускаются. Возвращает число перенесенных заявок.
+        """
+        columns = ', '.join(Order.COLUMNS)
+        event_columns = ', '.join(ORDER_EVENT_COLUMNS)
+        moved = 0
+        
+        async with self.acquire() as db:
+            while True:
+                async with db.transaction():
+                    ids = [row[0] for row in await db.fetch(f'''
+                        SELECT id FROM orders
+                        WHERE status = ANY($1::text[]) AND created_at < {UTC_NOW} - make_interval(days => $2)
+                        ORDER BY id LIMIT $3
+                        FOR UPDATE SKIP LOCKED
+                    ''', list(ARCHIVABLE_STATUSES), int(retention_days), batch_size)]
+                    if not ids:
+                        break
+                    
+                    await db.execute(f'''
+                        INSERT INTO archive.orders ({columns})
+                        SELECT {columns} FROM orders WHERE id = ANY($1::bigint[])
+                        ON CONFLICT (id) DO NOTHING
+                    ''', ids)
+                    await db.execute(f'''
+                        INSERT INTO archive.order_events ({event_columns})
+                        SELECT {event_columns} FROM order_events WHERE order_id = ANY($1::bigint[])
+                        ON CONFLICT (id) DO NOTHING
+                    ''', ids)
+                    await db.execute('DELETE FROM order_events WHERE order_id = ANY($1::bigint[])', ids)
+                    await db.execute('DELETE FROM orders WHERE id = ANY($1::bigint[])', ids)
+                
+                moved += len(ids)
+                await asyncio.sleep(pause)
+        
+        if moved:
+            order_cache.invalidate(self.db_path)
+            logger.info(f"Archived {moved} orders to schema archive")
+        return moved
+
+    async def find_order_card(self, order_ref: str):
+        """Заявка по ID или personal_id в рабочих таблицах или архиве; последняя колонка - archived"""
+        order_ref = str(order_ref)
+        async with self.acquire() as db:
+            row = await db.fetchrow('''
+                SELECT id, user_id, amount_rub, amount_btc, btc_address, total_amount, status,
+                       created_at, personal_id, payment_type, rate, archived
+                FROM all_orders
+                WHERE personal_id = $1 OR id = $2
+                ORDER BY archived
+                LIMIT 1
+            ''', order_ref, int(order_ref) if order_ref.isdigit() else None)
+        return _values(row) if row else None
+
+    async def incremental_vacuum(self, pages_per_step: int = 1000, pause: float = 0.05) -> Optional[int]:
+        """Место освобождает autovacuum PostgreSQL; для совместимости с SQLite всегда None"""
+        return None
+
+    async def enable_incremental_vacuum(self):
+        """В PostgreSQL не требуется"""
+
+    async def rebuild_user_totals(self, batch_size: int = 500, pause: float = 0.05) -> int:
+        """Пересчет счетчиков обменов клиента (REBUILD_USER_TOTALS) по заявкам и архиву пачками по id.
+        
+        Строки пачки блокируются до пересчета: завершение заявки ждет коммита
+        пачки, а UPDATE видит все уже завершенные. Возвращает число строк.
+        """
+        updated = 0
+        async with self.acquire() as db:
+            last_id = await db.fetchval('SELECT MAX(id) FROM users') or 0
+        
+        start = 0
+        while start < last_id:
+            async with self.acquire() as db:
+                async with db.transaction():
+                    await db.execute(
+                        'SELECT 1 FROM users WHERE id > $1 AND id <= $2 FOR UPDATE', start, start + batch_size
+                    )
+                    status = await db.execute(
+                        _sql(f'{REBUILD_USER_TOTALS} WHERE id > ? AND id <= ?'), start, start + batch_size
+                    )
+            updated += _rowcount(status)
+            start += batch_size
+            await asyncio.sleep(pause)
+        
+        logger.info(f"User totals rebuilt for {updated} users")
+        return updated
+
+    async def purge_expired(self, captcha_days: int = 1, outbox_days: int = 7) -> int:
+        """Удаляет старые сессии капчи и обработанные уведомления; возвращает число строк"""
+        async with self.acquire() as db:
+            captcha = await db.execute(
+                f'DELETE FROM captcha_sessions WHERE created_at < {UTC_NOW} - make_interval(days => $1)',
+                int(captcha_days)
+            )
+            outbox = await db.execute(
+                f"DELETE FROM notification_outbox WHERE status != 'pending' "
+                f"AND created_at < {UTC_NOW} - make_interval(days => $1)",
+                int(outbox_days)
+            )
+        return _rowcount(captcha) + _rowcount(outbox)
+
+    async def execute_query(self, query: str, params: tuple = ()):
+        async with self.acquire() as db:
+            await db.execute(_sql(query), *params)
+
+    @staticmethod
+    def _order_filters(statuses: List[str] = None, user_id: int = None, min_amount: float = None,
+                       max_amount: float = None, date_from: str = None, date_to: str = None):
+        """Условия WHERE и параметры для фильтров списка и выгрузки заявок"""
+        conditions = []
+        params = []
+        
+        if statuses:
+            conditions.append('status = ANY(?::text[])')
+            params.append(list(statuses))
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            params.append(user_id)
+        if min_amount is not None:
+            conditions.append('total_amount >= ?')
+            params.append(min_amount)
+        if max_amount is not None:
+            conditions.append('total_amount <= ?')
+            params.append(max_amount)
+        if date_from:
+            conditions.append('created_at >= ?::text::timestamp')
+            params.append(date_from)
+        if date_to:
+            conditions.append('created_at < ?::text::date + 1')
+            params.append(date_to)
+        return conditions, params
+
+    async def get_orders_page(self, statuses: List[str] = None, direction: str = None,
+                              cursor_id: int = None, limit: int = 10, user_id: int = None,
+                              min_amount: float = None, max_amount: float = None,
+                              date_from: str = None, date_to: str = None):
+        """Страница заявок с keyset-пагинацией по (created_at, id), как у SQLite"""
+        conditions, params = self._order_filters(statuses, user_id, min_amount, max_amount, date_from, date_to)
+        
+        order = 'DESC'
+        if cursor_id is not None and direction in ('next', 'prev'):
+            sign = '<' if direction == 'next' else '>'
+            conditions.append(f"(created_at, id) {sign} (SELECT created_at, id FROM orders WHERE id = ?)")
+            params.append(cursor_id)
+            if direction == 'prev':
+                order = 'ASC'
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        params.append(limit + 1)
+        async with self.acquire() as db:
+            rows = await db.fetch(_sql(f'''
+                SELECT id, user_id, total_amount, status, created_at, personal_id
+                FROM orders {where}
+                ORDER BY created_at {order}, id {order} LIMIT ?
+            '''), *params)
+        rows = [_dict(row) for row in rows]
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if order == 'ASC':
+            rows.reverse()
+        return rows, has_more
+
+    async def iter_orders(self, statuses: List[str] = None, user_id: int = None,
+                          min_amount: float = None, max_amount: float = None,
+                          date_from: str = None, date_to: str = None, chunk_size: int = 1000):
+        """Заявки вместе с архивом пачками по chunk_size строк через серверный курсор"""
+        conditions, params = self._order_filters(statuses, user_id, min_amount, max_amount, date_from, date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        async with self.acquire() as db:
+            async with db.transaction():
+                cursor = await db.cursor(
+                    _sql(f"SELECT {', '.join(Order.COLUMNS)}, archived FROM all_orders {where} ORDER BY id"), *params
+                )
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    yield [_values(row) for row in rows]
+
+    async def get_statistics(self) -> Dict:
+        # Итоги за все время включают архив, сегодняшние заявки в архив еще не попали
+        async with self.acquire() as db:
+            total_users = await db.fetchval('SELECT COUNT(*) FROM users')
+            total_orders, completed_orders, total_volume = await db.fetchrow(f'''
+                SELECT COUNT(*),
+                       COUNT(*) FILTER (WHERE status IN {COMPLETED_STATUSES}),
+                       COALESCE(SUM(total_amount) FILTER (WHERE status IN {COMPLETED_STATUSES}), 0)
+                FROM all_orders
+            ''')
+            today_orders, today_volume = await db.fetchrow(f'''
+                SELECT COUNT(*),
+                       COALESCE(SUM(total_amount) FILTER (WHERE status IN {COMPLETED_STATUSES}), 0)
+                FROM orders
+                WHERE created_at >= date_trunc('day', {UTC_NOW})
+            ''')
+        
+        return {
+            'total_users': total_users,
+            'total_orders': total_orders,
+            'completed_orders': completed_orders,
+            'total_volume': total_volume,
+            'today_orders': today_orders,
+            'today_volume': today_volume,
+            'completion_rate': (completed_orders / total_orders * 100) if total_orders > 0 else 0
+        }
+
+    async def save_review(self, user_id: int, text: str):
+        async with self.acquire() as db:
+            return await db.fetchval(
+                'INSERT INTO reviews (user_id, text, created_at, status) VALUES ($1, $2, $3, $4) RETURNING id',
+                user_id, text, datetime.now().isoformat(), 'pending'
+            )
+
+    async def get_last_review_time(self, user_id: int):
+        async with self.acquire() as db:
+            created_at = await db.fetchval(
+                'SELECT created_at FROM reviews WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1', user_id
+            )
+        return datetime.fromisoformat(created_at) if created_at else None
+
+    async def update_review_status(self, review_id: int, status: str):
+        async with self.acquire() as db:
+            await db.execute('UPDATE reviews SET status = $1 WHERE id = $2', status, review_id)
+
+    async def get_review(self, review_id: int) -> Optional[Dict]:
+        async with self.acquire() as db:
+            row = await db.fetchrow('SELECT * FROM reviews WHERE id = $1', review_id)
+        return _dict(row) if row else None
+
+    async def get_setting(self, key: str, default: Any = None) -> Any:
+        async with self.acquire() as db:
+            value = await db.fetchval('SELECT value FROM settings WHERE key = $1', key)
+        if value is None:
+            return default
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    async def set_setting(self, key: str, value: Any):
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        else:
+            value = str(value)
+        
+        async with self.acquire() as db:
+            await db.execute('''
+                INSERT INTO settings (key, value) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            ''', key, value)
+
+    async def create_captcha_session(self, user_id: int, answer: str):
+        async with self.acquire() as db:
+            await db.execute(f'''
+                INSERT INTO captcha_sessions (user_id, answer, attempts) VALUES ($1, $2, 0)
+                ON CONFLICT (user_id) DO UPDATE
+                SET answer = EXCLUDED.answer, attempts = 0, created_at = {UTC_NOW}
+            ''', user_id, answer)
+
+    async def get_captcha_session(self, user_id: int) -> Optional[Dict]:
+        async with self.acquire() as db:
+            row = await db.fetchrow('SELECT * FROM captcha_sessions WHERE user_id = $1', user_id)
+        return _dict(row) if row else None
+
+    async def delete_captcha_session(self, user_id: int):
+        async with self.acquire() as db:
+            await db.execute('DELETE FROM captcha_sessions WHERE user_id = $1', user_id)
+
+    async def rebuild_referral_counters(self):
+        """Полный пересчет referral_count/referral_balance (разовое восстановление)"""
+        async with self.acquire() as db:
+            await db.execute(REBUILD_REFERRAL_COUNTERS)
+        logger.info("Referral counters rebuilt")
+
+    async def get_referral_stats(self, user_id: int):
+        """Получение статистики рефералов"""
+        async with self.acquire() as db:
+            row = await db.fetchrow(
+                'SELECT referral_count, referral_balance FROM users WHERE user_id = $1', user_id
+            )
+        
+        return {
+            'referral_count': row[0] or 0 if row else 0,
+            'referral_balance': row[1] or 0 if row else 0
+        }
+
+    async def add_referral_bonus(self, user_id: int, amount: float, description: str = None,
+                                 kind: str = 'manual', source_user_id: int = None,
+                                 order_id: int = None) -> bool:
+        """Запись в журнал начислений; баланс пользователя обновляет триггер.
+        
+        Возвращает False, если такое начисление уже проведено.
+        """
+        async with self.acquire() as db:
+            status = await db.execute('''
+                INSERT INTO referral_bonuses (user_id, amount, description, kind, source_user_id, order_id)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT DO NOTHING
+            ''', user_id, amount, description, kind, source_user_id, order_id)
+        
+        self._invalidate_leaderboard()
+        return _rowcount(status) > 0
+
+    async def add_order_referral_bonus(self, order: Dict, percent: float) -> Optional[Dict]:
+        """Процент от завершенной заявки пригласившему клиента.
+        
+        Возвращает {'user_id', 'amount'} начисления или None, если начислять некому
+        или бонус по заявке уже проведен.
+        """
+        async with self.acquire() as db:
+            referrer = await db.fetchval('SELECT referred_by FROM users WHERE user_id = $1', order['user_id'])
+            if not referrer:
+                return None
+            
+            amount = round(order['amount_rub'] * percent / 100, 2)
+            if amount <= 0:
+                return None
+            
+            status = await db.execute('''
+                INSERT INTO referral_bonuses (user_id, amount, description, kind, source_user_id, order_id)
+                VALUES ($1, $2, $3, 'order', $4, $5)
+                ON CONFLICT DO NOTHING
+            ''', referrer, amount, f"{percent:g}% от заявки #{order['id']}", order['user_id'], order['id'])
+            if _rowcount(status) <= 0:
+                return None
+        
+        self._invalidate_leaderboard()
+        return {'user_id': referrer, 'amount': amount}
+
+    async def get_referral_ledger(self, user_id: int, limit: int = 10) -> List[Dict]:
+        """Последние начисления пользователя"""
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                SELECT id, amount, description, kind, source_user_id, order_id, created_at
+                FROM referral_bonuses
+                WHERE user_id = $1
+                ORDER BY id DESC
+                LIMIT $2
+            ''', user_id, limit)
+        return [_dict(row) for row in rows]
+
+    async def get_referral_tree(self, user_id: int, max_depth: int = 3) -> List[Dict]:
+        """Рефералы пользователя до max_depth уровней (1 - приглашенные им напрямую)"""
+        async with self.acquire() as db:
+            # Ограничение глубины заодно защищает от циклов в referred_by
+            rows = await db.fetch('''
+                WITH RECURSIVE tree (user_id, referred_by, depth) AS (
+                    SELECT user_id, referred_by, 1 FROM users WHERE referred_by = $1
+                    UNION ALL
+                    SELECT users.user_id, users.referred_by, tree.depth + 1
+                    FROM users JOIN tree ON users.referred_by = tree.user_id
+                    WHERE tree.depth < $2
+                )
+                SELECT tree.user_id, tree.referred_by, tree.depth,
+                       users.username, users.first_name, users.registration_date
+                FROM tree JOIN users ON users.user_id = tree.user_id
+                ORDER BY tree.depth, tree.user_id
+            ''', user_id, max_depth)
+        return [_dict(row) for row in rows]
+
+    async def get_referral_levels(self, user_id: int, max_depth: int = 3) -> Dict[int, int]:
+        """Число рефералов на каждом уровне: {уровень: количество}"""
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                WITH RECURSIVE tree (user_id, depth) AS (
+                    SELECT user_id, 1 FROM users WHERE referred_by = $1
+                    UNION ALL
+                    SELECT users.user_id, tree.depth + 1
+                    FROM users JOIN tree ON users.referred_by = tree.user_id
+                    WHERE tree.depth < $2
+                )
+                SELECT depth, COUNT(*) FROM tree GROUP BY depth ORDER BY depth
+            ''', user_id, max_depth)
+        return {row[0]: row[1] for row in rows}
+
+    async def get_referral_leaderboard(self, limit: int = 10, ttl: float = 300) -> List[Dict]:
+        """Рейтинг по заработанным бонусам, кэшируется на ttl секунд"""
+        cached = self._cached_leaderboard(limit)
+        if cached is not None:
+            return cached
+        
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                SELECT user_id, username, first_name, referral_count, referral_balance
+                FROM users
+                WHERE referral_balance > 0
+                ORDER BY referral_balance DESC
+                LIMIT $1
+            ''', limit)
+        return self._store_leaderboard(limit, [_dict(row) for row in rows], ttl)
+
+    async def enqueue_notification(self, chat_id: int, text: str, reply_markup: str = None,
+                                   parse_mode: str = "HTML") -> int:
+        async with self.acquire() as db:
+            return await db.fetchval('''
+                INSERT INTO notification_outbox (chat_id, text, parse_mode, reply_markup, next_attempt_at)
+                VALUES ($1, $2, $3, $4, $5)
+                RETURNING id
+            ''', chat_id, text, parse_mode, reply_markup, time.time())
+
+    async def get_due_notifications(self, limit: int = 50) -> List[Dict]:
+        """Выбирает и резервирует уведомления к отправке.
+        
+        Выбранные строки откладываются на NOTIFICATION_LEASE секунд, поэтому
+        другие узлы их не возьмут, а при падении узла отправка повторится.
+        """
+        now = time.time()
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                UPDATE notification_outbox SET next_attempt_at = $1
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= $2
+                    ORDER BY next_attempt_at, id LIMIT $3
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            ''', now + NOTIFICATION_LEASE, now, limit)
+        return sorted((_dict(row) for row in rows), key=lambda row: row['id'])
+
+    async def get_next_notification_time(self) -> Optional[float]:
+        async with self.acquire() as db:
+            return await db.fetchval(
+                "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending'"
+            )
+
+    async def mark_notifications_sent(self, notification_ids: List[int]):
+        if not notification_ids:
+            return
+        async with self.acquire() as db:
+            await db.execute('''
+                UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1
+                WHERE id = ANY($1::bigint[])
+            ''', notification_ids)
+
+    async def reschedule_notification(self, notification_id: int, delay: float,
+                                      error: str = None, count_attempt: bool = True):
+        async with self.acquire() as db:
+            await db.execute('''
+                UPDATE notification_outbox
+                SET next_attempt_at = $1, last_error = $2, attempts = attempts + $3
+                WHERE id = $4
+            ''', time.time() + delay, error, 1 if count_attempt else 0, notification_id)
+
+    async def mark_notification_failed(self, notification_id: int, error: str):
+        async with self.acquire() as db:
+            await db.execute('''
+                UPDATE notification_outbox
+                SET status = 'failed', last_error = $1, attempts = attempts + 1
+                WHERE id = $2
+            ''', error, notification_id)
+
+    async def add_scheduled_task(self, kind: str, payload: Dict, run_at: float) -> int:
+        async with self.acquire() as db:
+            return await db.fetchval(
+                'INSERT INTO scheduled_tasks (kind, payload, run_at) VALUES ($1, $2, $3) RETURNING id',
+                kind, json.dumps(payload, ensure_ascii=False), run_at
+            )
+
+    async def get_scheduled_tasks(self) -> List[Dict]:
+        async with self.acquire() as db:
+            rows = await db.fetch('SELECT id, kind, payload, run_at FROM scheduled_tasks')
+        return [
+            {**dict(row), 'payload': json.loads(row['payload']) if row['payload'] else {}}
+            for row in rows
+        ]
+
+    async def claim_due_scheduled_tasks(self, now: float) -> List[Dict]:
+        """Забирает (удаляет и возвращает) задачи со сроком до now; строку получает один узел"""
+        async with self.acquire() as db:
+            rows = await db.fetch('''
+                DELETE FROM scheduled_tasks
+                WHERE id IN (
+                    SELECT id FROM scheduled_tasks
+                    WHERE run_at <= $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, kind, payload, run_at
+            ''', now)
+        return sorted((
+            {**dict(row), 'payload': json.loads(row['payload']) if row['payload'] else {}}
+            for row in rows
+        ), key=lambda task: (task['run_at'], task['id']))
@@ -0,0 +1,191 @@
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# План запроса снимаем только для операторов, которые умеют EXPLAIN QUERY PLAN с теми же параметрами
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+
+def normalize_sql(sql: str) -> str:
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+@dataclass
+class QueryStats:
+    sql: str
+    calls: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    rows: int = 0
+    plan: List[str] = field(default_factory=list)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+class QueryProfiler:
+    """Статистика по каждому уникальному SQL: время, строки, план; лог медленных запросов"""
+
+    def __init__(self, enabled: bool = False, slow_threshold_ms: float = 100.0):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.stats: Dict[str, QueryStats] = {}
+
+    def reset(self):
+        self.stats.clear()
+
+    def top(self, limit: int = 10) -> List[QueryStats]:
+        return sorted(self.stats.values(), key=lambda stats: stats.total_time, reverse=True)[:limit]
+
+    def needs_plan(self, sql: str) -> bool:
+        stats = self.stats.get(sql)
+        return (stats is None or not stats.plan) and sql.upper().startswith(EXPLAINABLE)
+
+    def record(self, sql: str, elapsed: float, rows: int = 0, plan: List[str] = None):
+        rows = max(rows, 0)
+        stats = self.stats.get(sql)
+        if stats is None:
+            stats = self.stats[sql] = QueryStats(sql)
+        stats.calls += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        stats.rows += rows
+        if plan:
+            stats.plan = plan
+        
+        if elapsed >= self.slow_threshold:
+            logger.warning(f"Slow query {elapsed * 1000:.1f} ms, {rows} rows: {sql}")
+
+
+class ProfiledCursor:
+    """Курсор, считающий прочитанные строки и время выборки"""
+
+    def __init__(self, cursor: aiosqlite.Cursor, profiler: QueryProfiler, sql: str):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._sql = sql
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    async def _fetch(self, method, *args):
+        started = time.perf_counter()
+        result = await method(*args)
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        stats = self._profiler.stats.get(self._sql)
+        if stats:
+            stats.total_time += time.perf_counter() - started
+            stats.rows += rows
+        return result
+
+    async def fetchone(self):
+        return await self._fetch(self._cursor.fetchone)
+
+    async def fetchall(self):
+        return await self._fetch(self._cursor.fetchall)
+
+    async def fetchmany(self, size: int = None):
+        if size is None:
+            return await self._fetch(self._cursor.fetchmany)
+        return await self._fetch(self._cursor.fetchmany, size)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            rows = await self.fetchmany(self._cursor.arraysize or 100)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._cursor.close()
+
+
+class _ProfiledResult:
+    """Как aiosqlite Result: можно await, можно async with"""
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._cursor: Optional[ProfiledCursor] = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self) -> ProfiledCursor:
+        self._cursor = await self._coro
+        return self._cursor
+
+    async def __aexit__(self, *exc_info):
+        if self._cursor:
+            await self._cursor.close()
+
+
+class ProfiledConnection:
+    """Обертка над aiosqlite.Connection, замеряющая execute/executemany"""
+
+    def __init__(self, connection: aiosqlite.Connection, profiler: QueryProfiler):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_profiler', profiler)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name: str, value: Any):
+        # row_factory и прочие настройки уходят в настоящее соединение
+        setattr(self._connection, name, value)
+
+    async def _explain(self, sql: str, parameters) -> List[str]:
+        try:
+            async with self._connection.execute(f'EXPLAIN QUERY PLAN {sql}', parameters) as cursor:
+                return [row[-1] for row in await cursor.fetchall()]
+        except Exception:
+            return []
+
+    async def _execute(self, sql: str, parameters) -> ProfiledCursor:
+        key = normalize_sql(sql)
+        plan = await self._explain(sql, parameters) if self._profiler.needs_plan(key) else None
+        started = time.perf_counter()
+        cursor = await self._connection.execute(sql, parameters)
+        elapsed = time.perf_counter() - started
+        # Для INSERT/UPDATE/DELETE учитываем затронутые строки, для SELECT - считает курсор
+        self._profiler.record(key, elapsed, cursor.rowcount, plan)
+        return ProfiledCursor(cursor, self._profiler, key)
+
+    def execute(self, sql: str, parameters=None) -> _ProfiledResult:
+        return _ProfiledResult(self._execute(sql, parameters))
+
+    async def executemany(self, sql: str, parameters):
+        started = time.perf_counter()
+        cursor = await self._connection.executemany(sql, parameters)
+        self._profiler.record(normalize_sql(sql), time.perf_counter() - started, cursor.rowcount)
+        return cursor
+
+
+profiler = QueryProfiler()
+
+
+@asynccontextmanager
+async def connect(db_path: str, timeout: float = 5.0):
+    """Соединение с БД; при включенном профилировании - с замером запросов.
+    
+    timeout - busy_timeout SQLite: сколько ждать чужую блокировку записи.
+    """
+    async with aiosqlite.connect(db_path, timeout=timeout) as connection:
+        if profiler.enabled:
+            yield ProfiledConnection(connection, profiler)
+        else:
+            yield connection
@@ -0,0 +1,131 @@
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+ORDER_COLUMNS = (
+    'id', 'user_id', 'onlypays_id', 'amount_rub', 'amount_btc', 'btc_address', 'rate',
+    'total_amount', 'payment_type', 'status', 'created_at', 'completed_at', 'requisites',
+    'is_problematic', 'operator_notes', 'personal_id', 'received_sum', 'loyalty_free',
+)
+
+USER_COLUMNS = (
+    'id', 'user_id', 'username', 'first_name', 'last_name', 'phone_number', 'registration_date',
+    'is_blocked', 'referral_code', 'referred_by', 'total_operations', 'total_amount',
+    'referral_count', 'referral_balance', 'last_order_at', 'delivery_error', 'delivery_error_at',
+    'loyalty_free_used',
+)
+
+
+class FieldNotLoaded(KeyError):
+    """Колонка есть в таблице, но не была выбрана запросом"""
+
+
+class Record:
+    """Строка БД без dict на каждый объект.
+    
+    Значения лежат в __slots__, доступ - и как к атрибутам, и как к словарю
+    (record['status'], record.get('personal_id', default), dict(record)),
+    поэтому обработчики работают с записями так же, как раньше со словарями.
+    record[...] для невыбранной колонки не подменяет значение, а вызывает
+    FieldNotLoaded - иначе отсутствующие реквизиты молча превратились бы в 'N/A'.
+    get() ведет себя как dict.get: для невыбранной колонки возвращает default.
+    """
+    
+    __slots__ = ()
+    COLUMNS: Tuple[str, ...] = ()
+    # Длинные текстовые колонки, которые по умолчанию не выбираются
+    HEAVY: Tuple[str, ...] = ()
+
+    @classmethod
+    def light_columns(cls) -> Tuple[str, ...]:
+        return tuple(column for column in cls.COLUMNS if column not in cls.HEAVY)
+
+    @classmethod
+    def select_list(cls, fields: Sequence[str] = None) -> Tuple[str, ...]:
+        """Проверенный список колонок для SELECT (по умолчанию - без тяжелых)"""
+        if fields is None:
+            return cls.light_columns()
+        unknown = [field for field in fields if field not in cls.COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown {cls.__name__} columns: {', '.join(unknown)}")
+        return tuple(fields)
+
+    @classmethod
+    def from_row(cls, names: Sequence[str], row: Sequence[Any]):
+        record = cls.__new__(cls)
+        for name, value in zip(names, row):
+            setattr(record, name, value)
+        return record
+
+    @classmethod
+    def from_rows(cls, names: Sequence[str], rows: Iterable[Sequence[Any]]) -> List:
+        return [cls.from_row(names, row) for row in rows]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self.__slots__ and hasattr(self, name)
+
+    def missing(self, names: Iterable[str]) -> List[str]:
+        return [name for name in names if not self.is_loaded(name)]
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise FieldNotLoaded(f"{type(self).__name__}.{key} not loaded") from None
+
+    def __setitem__(self, key: str, value: Any):
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return self.is_loaded(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if not self.is_loaded(key):
+            return default
+        return getattr(self, key)
+
+    def keys(self) -> List[str]:
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, Record):
+            return type(self) is type(other) and self.items() == other.items()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def update(self, values: Dict[str, Any]):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def copy(self):
+        record = type(self).__new__(type(self))
+        record.update(self)
+        return record
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={value!r}' for name, value in self.items())
+        return f'{type(self).__name__}({fields})'
+
+
+class Order(Record):
+    __slots__ = ORDER_COLUMNS
+    COLUMNS = ORDER_COLUMNS
+    HEAVY = ('requisites', 'operator_notes')
+
+
+class User(Record):
+    __slots__ = USER_COLUMNS
+    COLUMNS = USER_COLUMNS
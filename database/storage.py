@@ -0,0 +1,330 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import config
+from utils.metrics import DB_ERRORS, DB_SECONDS, instrument_methods
+from database.order_cache import order_cache
+from database.rows import Order, User
+
+# Поля заявки, доступные для обновления (включая personal_id)
+ORDER_UPDATE_FIELDS = ('onlypays_id', 'status', 'requisites', 'personal_id', 'operator_notes', 'received_sum')
+
+# Закрытые заявки, которые переносятся в архив по истечении срока хранения
+ARCHIVABLE_STATUSES = ('completed', 'cancelled')
+ORDER_EVENT_COLUMNS = ('id', 'order_id', 'from_status', 'to_status', 'actor', 'details', 'created_at')
+
+# Завершенные заявки в статистике; 'finished' - статус старых версий бота
+COMPLETED_STATUSES = "('completed', 'finished')"
+
+# Выданные get_due_notifications уведомления откладываются на это время (секунды):
+# их не возьмет другой цикл доставки, а после падения процесса они уйдут повторно
+NOTIFICATION_LEASE = 60
+
+# Уведомления о смене статуса, которые пишутся в ее транзакции:
+# (заявка, прежний статус) -> строки (chat_id, text, reply_markup, parse_mode)
+TransitionNotifications = Callable[[Order, str], Awaitable[Sequence[Tuple[int, str, Optional[str], str]]]]
+
+POSTGRES_SCHEMES = ('postgres://', 'postgresql://')
+SQLITE_SCHEME = 'sqlite:///'
+
+# Рейтинг рефереров, общий для всех экземпляров хранилища в процессе:
+# (путь или URL базы, limit) -> (время истечения, строки рейтинга)
+_leaderboard_cache: Dict[Tuple[str, int], tuple] = {}
+
+
+@instrument_methods(DB_SECONDS, DB_ERRORS)
+class Storage(ABC):
+    """Интерфейс хранилища бота.
+    
+    Обработчики работают только с этими методами, поэтому реализация
+    выбирается по DATABASE_URL (см. create_database): файл SQLite или
+    PostgreSQL, общий для нескольких экземпляров бота. Кэши (история заявок,
+    рейтинг рефереров) живут в процессе и ограничены TTL.
+    """
+    
+    # Снимки базы средствами бота (/backup и плановый backup_db): только у
+    # хранилищ с методом backup_to, см. utils.backup.create_backup
+    supports_backup = False
+    # База общая для нескольких процессов бота: их записи не видны кэшам этого процесса
+    shared = False
+
+    def __init__(self, db_path: str):
+        # Ключ кэшей order_cache и рейтинга рефереров: путь к файлу или URL базы
+        self.db_path = db_path
+
+    async def get_commission_percentage(self):
+        return await self.get_setting("commission_percentage", float(os.getenv('COMMISSION_PERCENT', '20.0')))
+
+    def invalidate_order_cache(self, user_id: int = None):
+        """Сброс кэша истории заявок после изменений в обход Database"""
+        order_cache.invalidate(self.db_path, user_id)
+
+    def _cached_leaderboard(self, limit: int) -> Optional[List[Dict]]:
+        cached = _leaderboard_cache.get((self.db_path, limit))
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def _store_leaderboard(self, limit: int, rows: List[Dict], ttl: float) -> List[Dict]:
+        _leaderboard_cache[(self.db_path, limit)] = (time.monotonic() + ttl, rows)
+        return rows
+
+    def _invalidate_leaderboard(self):
+        """Сброс рейтинга этой базы во всех экземплярах хранилища"""
+        for key in [key for key in _leaderboard_cache if key[0] == self.db_path]:
+            del _leaderboard_cache[key]
+
+    async def is_chat_admin(self, chat_id: int, user_id: int) -> bool:
+        try:
+            admin_chats = [config.ADMIN_CHAT_ID, config.OPERATOR_CHAT_ID]
+            return chat_id in admin_chats and await self.has_admin_rights(user_id)
+        except:
+            return False
+
+    async def has_admin_rights(self, user_id: int) -> bool:
+        if user_id == config.ADMIN_CHAT_ID:
+            return True
+        
+        admin_users = await self.get_setting("admin_users", [])
+        operator_users = await self.get_setting("operator_users", [])
+        
+        return user_id in admin_users or user_id in operator_users
+
+    async def add_admin_chat(self, chat_id: int, chat_title: str = ""):
+        admin_chats = await self.get_setting("admin_chats", [])
+        if chat_id not in admin_chats:
+            admin_chats.append(chat_id)
+            await self.set_setting("admin_chats", admin_chats)
+            await self.set_setting(f"chat_{chat_id}_title", chat_title)
+    
+    # Схема и обслуживание
+
+    @abstractmethod
+    async def init_db(self): ...
+
+    @abstractmethod
+    async def archive_orders(self, retention_days: int, batch_size: int = 500, pause: float = 0.05) -> int: ...
+
+    @abstractmethod
+    async def incremental_vacuum(self, pages_per_step: int = 1000, pause: float = 0.05) -> Optional[int]: ...
+
+    @abstractmethod
+    async def enable_incremental_vacuum(self): ...
+
+    @abstractmethod
+    async def rebuild_user_totals(self, batch_size: int = 500, pause: float = 0.05) -> int: ...
+
+    @abstractmethod
+    async def purge_expired(self, captcha_days: int = 1, outbox_days: int = 7) -> int: ...
+
+    @abstractmethod
+    async def execute_query(self, query: str, params: tuple = ()): ...
+    
+    # Пользователи
+
+    @abstractmethod
+    async def search_users(self, query: str, limit: int = 10) -> List[Dict]: ...
+
+    @abstractmethod
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                       referred_by: int = None, signup_bonus: float = 0) -> bool: ...
+
+    @abstractmethod
+    async def get_user(self, user_id: int, fields: Sequence[str] = None) -> Optional[User]: ...
+
+    @abstractmethod
+    async def update_user(self, user_id: int, **kwargs): ...
+
+    @abstractmethod
+    async def get_all_users(self) -> List[int]: ...
+
+    @abstractmethod
+    def iter_users(self, chunk_size: int = 1000) -> AsyncIterator[List[tuple]]: ...
+
+    @abstractmethod
+    async def count_users(self) -> Dict[str, int]: ...
+
+    @abstractmethod
+    async def get_recent_users(self, limit: int = 10) -> List[Dict]: ...
+
+    @abstractmethod
+    async def mark_undeliverable(self, failures: List[Tuple[int, str]]): ...
+
+    @abstractmethod
+    async def clear_delivery_error(self, user_id: int): ...
+
+    @abstractmethod
+    async def count_segment(self, **filters) -> int: ...
+
+    @abstractmethod
+    def iter_segment(self, chunk_size: int = 1000, **filters) -> AsyncIterator[List[int]]: ...
+
+    @abstractmethod
+    async def find_user_id_by_username(self, username: str) -> Optional[int]: ...
+
+    @abstractmethod
+    async def reserve_free_exchange(self, user_id: int, every: int) -> bool: ...
+
+    @abstractmethod
+    async def release_free_exchange(self, user_id: int): ...
+    
+    # Заявки
+
+    @abstractmethod
+    async def search_orders(self, query: str, limit: int = 10) -> List[Dict]: ...
+
+    @abstractmethod
+    async def create_order(self, user_id: int, amount_rub: float, amount_btc: float,
+                           btc_address: str, rate: float, total_amount: float, payment_type: str,
+                           loyalty_free: bool = False) -> int: ...
+
+    @abstractmethod
+    async def get_order(self, order_id: int, fields: Sequence[str] = None) -> Optional[Order]: ...
+
+    @abstractmethod
+    async def load_order_fields(self, order: Order, *fields: str) -> Order: ...
+
+    @abstractmethod
+    async def update_order(self, order_id: int, **kwargs): ...
+
+    @abstractmethod
+    async def transition_order_status(self, order_id: int, from_statuses: List[str], to_status: str,
+                                      actor: str = None, details: Dict = None,
+                                      notifications: TransitionNotifications = None,
+                                      **kwargs) -> Optional[Tuple[Order, str]]: ...
+
+    @abstractmethod
+    async def get_order_events(self, order_id: int) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Order]: ...
+
+    @abstractmethod
+    async def find_order_card(self, order_ref: str): ...
+
+    @abstractmethod
+    async def get_orders_page(self, statuses: List[str] = None, direction: str = None,
+                              cursor_id: int = None, limit: int = 10, user_id: int = None,
+                              min_amount: float = None, max_amount: float = None,
+                              date_from: str = None, date_to: str = None): ...
+
+    @abstractmethod
+    def iter_orders(self, statuses: List[str] = None, user_id: int = None,
+                    min_amount: float = None, max_amount: float = None,
+                    date_from: str = None, date_to: str = None,
+                    chunk_size: int = 1000) -> AsyncIterator[List[tuple]]: ...
+
+    @abstractmethod
+    async def get_statistics(self) -> Dict: ...
+    
+    # Отзывы
+
+    @abstractmethod
+    async def save_review(self, user_id: int, text: str): ...
+
+    @abstractmethod
+    async def get_last_review_time(self, user_id: int): ...
+
+    @abstractmethod
+    async def update_review_status(self, review_id: int, status: str): ...
+
+    @abstractmethod
+    async def get_review(self, review_id: int) -> Optional[Dict]: ...
+    
+    # Настройки и капча
+
+    @abstractmethod
+    async def get_setting(self, key: str, default: Any = None) -> Any: ...
+
+    @abstractmethod
+    async def set_setting(self, key: str, value: Any): ...
+
+    @abstractmethod
+    async def create_captcha_session(self, user_id: int, answer: str): ...
+
+    @abstractmethod
+    async def get_captcha_session(self, user_id: int) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def delete_captcha_session(self, user_id: int): ...
+    
+    # Рефералы
+
+    @abstractmethod
+    async def rebuild_referral_counters(self): ...
+
+    @abstractmethod
+    async def get_referral_stats(self, user_id: int): ...
+
+    @abstractmethod
+    async def add_referral_bonus(self, user_id: int, amount: float, description: str = None,
+                                 kind: str = 'manual', source_user_id: int = None,
+                                 order_id: int = None) -> bool: ...
+
+    @abstractmethod
+    async def add_order_referral_bonus(self, order: Dict, percent: float) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def get_referral_ledger(self, user_id: int, limit: int = 10) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_referral_tree(self, user_id: int, max_depth: int = 3) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_referral_levels(self, user_id: int, max_depth: int = 3) -> Dict[int, int]: ...
+
+    @abstractmethod
+    async def get_referral_leaderboard(self, limit: int = 10, ttl: float = 300) -> List[Dict]: ...
+    
+    # Очередь уведомлений и отложенные задачи
+
+    @abstractmethod
+    async def enqueue_notification(self, chat_id: int, text: str, reply_markup: str = None,
+                                   parse_mode: str = "HTML") -> int: ...
+
+    @abstractmethod
+    async def get_due_notifications(self, limit: int = 50) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_next_notification_time(self) -> Optional[float]: ...
+
+    @abstractmethod
+    async def mark_notifications_sent(self, notification_ids: List[int]): ...
+
+    @abstractmethod
+    async def reschedule_notification(self, notification_id: int, delay: float,
+                                      error: str = None, count_attempt: bool = True): ...
+
+    @abstractmethod
+    async def mark_notification_failed(self, notification_id: int, error: str): ...
+
+    @abstractmethod
+    async def add_scheduled_task(self, kind: str, payload: Dict, run_at: float) -> int: ...
+
+    @abstractmethod
+    async def get_scheduled_tasks(self) -> List[Dict]: ...
+
+    @abstractmethod
+    async def claim_due_scheduled_tasks(self, now: float) -> List[Dict]: ...
+
+
+def create_database(url: str) -> Storage:
+    """Хранилище по DATABASE_URL: postgres://... - PostgreSQL, иначе путь к файлу SQLite"""
+    if url.startswith(POSTGRES_SCHEMES):
+        # asyncpg нужен только этой реализации
+        from database.postgres import PostgresDatabase
+        return PostgresDatabase(url)
+    
+    from database.models import Database
+    if url.startswith(SQLITE_SCHEME):
+        url = url[len(SQLITE_SCHEME):]
+    return Database(url)
+
+
+async def close_databases(url: str):
+    """Закрытие пулов соединений; у SQLite соединение открывается на каждый запрос"""
+    if url.startswith(POSTGRES_SCHEMES):
+        from database.postgres import close_pools
+        await close_pools()
@@ -1,28 +1,42 @@
+import asyncio
+import html
 import logging
-from datetime import datetime, timedelta
-import aiosqlite
+from datetime import datetime
 import os
+from typing import List
 import psutil
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, BufferedInputFile, FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ChatType
-from database.models import Database
+from aiogram.exceptions import TelegramRetryAfter
+from database.storage import create_database
+from database.rows import Order, User
+from database.profiler import profiler
+from handlers.operator import scheduler
 from keyboards.reply import ReplyKeyboards
 from config import config
+from utils.metrics import (
+    API_SECONDS, DB_SECONDS, HANDLER_ERRORS, HANDLER_SECONDS, HANDLERS_IN_FLIGHT, UPDATES_TOTAL
+)
+from utils.logs import list_log_files, resolve_log_path, tail_lines, grep_lines, gzip_lines
+from utils.backup import create_backup, list_backup_sets
+from utils.export import export_csv_gz
+from utils.delivery import UNDELIVERABLE, classify_delivery_error
 
 logger = logging.getLogger(__name__)
 router = Router()
-db = Database(config.DATABASE_URL)
+db = create_database(config.DATABASE_URL)
 
 class AdminStates(StatesGroup):
     admin_mode = State()
     waiting_for_welcome_message = State()
     waiting_for_percentage = State()
     waiting_for_broadcast_message = State()
+    waiting_for_segment_filters = State()
     waiting_for_limits = State()
     waiting_for_user_id = State()
     waiting_for_message_to_user = State()
@@ -174,18 +188,292 @@ def create_system_panel():
 def create_broadcast_panel():
     builder = InlineKeyboardBuilder()
     builder.row(
-        InlineKeyboardButton(text="📤 Отправить всем", callback_data="admin_broadcast_all"),
-        InlineKeyboardButton(text="👥 Активным", callback_data="admin_broadcast_active")
+        InlineKeyboardButton(text="📤 Отправить всем", callback_data="admin_bc_all"),
+        InlineKeyboardButton(text="👥 С операциями", callback_data="admin_bc_active")
     )
     builder.row(
-        InlineKeyboardButton(text="🆕 Новым (за неделю)", callback_data="admin_broadcast_new"),
-        InlineKeyboardButton(text="🎯 С операциями", callback_data="admin_broadcast_traders")
+        InlineKeyboardButton(text="🆕 Новым (за неделю)", callback_data="admin_bc_new"),
+        InlineKeyboardButton(text="💤 Без заявок 30 дней", callback_data="admin_bc_dormant")
+    )
+    builder.row(
+        InlineKeyboardButton(text="🤝 Приглашенным", callback_data="admin_bc_referred"),
+        InlineKeyboardButton(text="🧩 Свой сегмент", callback_data="admin_bc_custom")
     )
     builder.row(
         InlineKeyboardButton(text="◶️ Назад", callback_data="admin_main_panel")
     )
     return builder
 
+def format_latency(seconds: float) -> str:
+    return "&gt;10 с" if seconds == float("inf") else f"{seconds * 1000:.0f} мс"
+
+def format_metrics_summary(top: int = 5) -> str:
+    """Самые медленные обработчики, запросы к БД и внешние API по среднему времени"""
+    updates = int(sum(UPDATES_TOTAL.values.values()))
+    in_flight = int(sum(HANDLERS_IN_FLIGHT.values.values()))
+    errors = int(sum(HANDLER_ERRORS.values.values()))
+    text = (
+        f"\n\n📈 <b>Метрики</b>\n"
+        f"📨 Апдейтов: {updates} | ⚙️ В работе: {in_flight} | ❌ Ошибок: {errors}\n"
+    )
+    
+    sections = (
+        ("🧩 Обработчики", HANDLER_SECONDS, lambda key: f"{key[0].split('.')[-1]}.{key[1]}"),
+        ("🗄 База данных", DB_SECONDS, lambda key: key[0]),
+        ("🌐 Внешние API", API_SECONDS, lambda key: f"{key[0]}.{key[1]}"),
+    )
+    for title, histogram, label in sections:
+        rows = sorted(histogram.summary(), key=lambda row: row[2], reverse=True)[:top]
+        if not rows:
+            continue
+        text += f"\n{title} (среднее / p95 / вызовов):\n"
+        for key, count, average, p95 in rows:
+            text += f"• {html.escape(label(key))}: {format_latency(average)} / {format_latency(p95)} / {count}\n"
+    return text
+
+async def archive_and_vacuum(convert: bool = True) -> int:
+    """Перенос старых закрытых заявок в архив и возврат освободившегося места"""
+    archived = await db.archive_orders(config.ORDER_RETENTION_DAYS, config.ARCHIVE_BATCH_SIZE)
+    freed = await db.incremental_vacuum()
+    if freed is None and convert:
+        # Старая база без auto_vacuum: один полный VACUUM, дальше только инкрементальный
+        await db.enable_incremental_vacuum()
+    return archived
+
+@scheduler.task("archive_orders")
+async def archive_orders_task(payload: dict):
+    try:
+        archived = await archive_and_vacuum(convert=False)
+        logger.info(f"Scheduled archiving: {archived} orders moved")
+    finally:
+        await scheduler.schedule(config.ARCHIVE_INTERVAL_HOURS * 3600, "archive_orders")
+
+async def make_backup() -> List[str]:
+    return await create_backup(db, config.BACKUP_DIR, config.BACKUP_KEEP, config.BACKUP_PAGES_PER_STEP)
+
+@scheduler.task("backup_db")
+async def backup_task(payload: dict):
+    # Задача могла остаться в очереди от SQLite-конфигурации
+    if not db.supports_backup:
+        logger.info("Scheduled backup skipped: storage has no built-in backups")
+        return
+    try:
+        await make_backup()
+    finally:
+        await scheduler.schedule(config.BACKUP_INTERVAL_HOURS * 3600, "backup_db")
+
+@scheduler.task("rebuild_user_totals")
+async def rebuild_user_totals_task(payload: dict):
+    updated = await db.rebuild_user_totals(config.ARCHIVE_BATCH_SIZE)
+    await db.set_setting("user_totals_rebuilt", True)
+    logger.info(f"User totals backfilled for {updated} users")
+
+async def schedule_maintenance():
+    """Ставит периодические архивацию и бэкап, если их нет среди восстановленных задач"""
+    periodic = [("archive_orders", config.ARCHIVE_INTERVAL_HOURS)]
+    if db.supports_backup:
+        periodic.append(("backup_db", config.BACKUP_INTERVAL_HOURS))
+    for kind, hours in periodic:
+        if hours and not scheduler.has_pending(kind):
+            await scheduler.schedule(hours * 3600, kind)
+    
+    # Разовое заполнение счетчиков обменов, которые раньше не обновлялись
+    if not await db.get_setting("user_totals_rebuilt", False) and not scheduler.has_pending("rebuild_user_totals"):
+        await scheduler.schedule(0, "rebuild_user_totals")
+
+ORDER_SCREENS = {
+    "recent": (None, "📋 <b>Последние заявки</b>"),
+    "pending": (["waiting", "paid_by_client"], "⏳ <b>Ожидающие заявки</b>"),
+    "completed": (["completed"], "✅ <b>Завершенные заявки</b>"),
+    "cancelled": (["cancelled"], "❌ <b>Отмененные заявки</b>"),
+    "problem": (["problem"], "⚠️ <b>Проблемные заявки</b>"),
+}
+
+ORDER_STATUS_EMOJI = {
+    "waiting": "⏳", "paid_by_client": "💰", "completed": "✅",
+    "finished": "✅", "cancelled": "❌", "problem": "⚠️"
+}
+
+ORDERS_PAGE_SIZE = 10
+
+def parse_order_filters(args: list) -> dict:
+    """Разбор фильтров вида user=123 min=1000 max=5000 from=2024-01-01 to=2024-01-31"""
+    keys = {"user": "user_id", "min": "min_amount", "max": "max_amount", "from": "date_from", "to": "date_to"}
+    filters = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if key not in keys or not value:
+            raise ValueError(f"Неизвестный фильтр: {arg}")
+        if key == "user":
+            filters[keys[key]] = int(value)
+        elif key in ("min", "max"):
+            filters[keys[key]] = float(value)
+        else:
+            datetime.strptime(value, "%Y-%m-%d")
+            filters[keys[key]] = value
+    return filters
+
+def format_order_filters(filters: dict) -> str:
+    labels = {"user_id": "пользователь", "min_amount": "от", "max_amount": "до",
+              "date_from": "с", "date_to": "по"}
+    return ", ".join(f"{labels[key]} {value}" for key, value in filters.items())
+
+# Сегменты рассылки: хранится фильтр, получатели выбираются из базы в момент отправки
+BROADCAST_SEGMENTS = {
+    "all": ({}, "всем пользователям"),
+    "active": ({"min_operations": 1}, "пользователям с операциями"),
+    "new": ({"registered_within_days": 7}, "новым пользователям (за неделю)"),
+    "dormant": ({"min_operations": 1, "idle_days": 30}, "клиентам без заявок 30 дней"),
+    "referred": ({"referred": True}, "приглашенным пользователям"),
+}
+
+SEGMENT_FILTERS_HELP = (
+    "Условия через пробел:\n"
+    "<code>reg=7</code> - зарегистрированы за 7 дней\n"
+    "<code>ops=1</code>, <code>ops=1-5</code> - число операций\n"
+    "<code>ordered=30</code> - была заявка за 30 дней\n"
+    "<code>idle=30</code> - нет заявок 30 дней\n"
+    "<code>ref=any</code>, <code>ref=none</code>, <code>ref=123</code> - по реферальной ссылке\n"
+    "<code>blocked=yes|no|any</code> - заблокированные (по умолчанию no)\n"
+    "<code>reachable=yes|no|any</code> - доступные для сообщений (по умолчанию yes)"
+)
+
+DELIVERY_ERROR_LABELS = {
+    "blocked": "🚫 Заблокировали бота",
+    "deactivated": "👻 Удалили аккаунт",
+    "chat_not_found": "❓ Чат не найден",
+    "forbidden": "⛔ Доступ запрещен",
+    "flood": "⏳ Лимит Telegram",
+    "error": "❌ Другие ошибки",
+}
+
+# Сколько раз повторять отправку после ответа Telegram "Too Many Requests"
+BROADCAST_FLOOD_RETRIES = 3
+
+def parse_segment_filters(args: list) -> dict:
+    """Разбор условий сегмента вида reg=7 ops=1-5 idle=30 ref=any blocked=no"""
+    days = {"reg": "registered_within_days", "ordered": "ordered_within_days", "idle": "idle_days"}
+    filters = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if not value:
+            raise ValueError(f"Неизвестное условие: {arg}")
+        if key in days:
+            filters[days[key]] = int(value)
+        elif key == "ops":
+            low, _, high = value.partition("-")
+            if low:
+                filters["min_operations"] = int(low)
+            if high:
+                filters["max_operations"] = int(high)
+        elif key == "ref":
+            if value in ("any", "none"):
+                filters["referred"] = value == "any"
+            else:
+                filters["referred_by"] = int(value)
+        elif key in ("blocked", "reachable") and value in ("yes", "no", "any"):
+            filters[key] = {"yes": True, "no": False, "any": None}[value]
+        else:
+            raise ValueError(f"Неизвестное условие: {arg}")
+    return filters
+
+def format_segment_filters(filters: dict) -> str:
+    labels = {
+        "registered_within_days": "регистрация за {} дн.", "min_operations": "операций от {}",
+        "max_operations": "операций до {}", "ordered_within_days": "заявка за {} дн.",
+        "idle_days": "нет заявок {} дн.", "referred_by": "реферер {}",
+    }
+    parts = [labels[key].format(value) for key, value in filters.items() if key in labels]
+    if "referred" in filters:
+        parts.append("по реферальной ссылке" if filters["referred"] else "без реферера")
+    if "blocked" in filters:
+        parts.append({True: "только заблокированные", False: "без заблокированных", None: "включая заблокированных"}[filters["blocked"]])
+    if "reachable" in filters:
+        parts.append({True: "доступные", False: "только недоступные", None: "включая недоступных"}[filters["reachable"]])
+    return ", ".join(parts) or "все незаблокированные"
+
+async def build_broadcast_preview(filters: dict, title: str):
+    """Экран перед рассылкой: условия сегмента и число получателей (COUNT по индексам)"""
+    total = await db.count_segment(**filters)
+    text = (
+        f"📤 <b>Рассылка {title}</b>\n\n"
+        f"🎯 Условия: {format_segment_filters(filters)}\n"
+        f"👥 Получателей: {total}\n\n"
+        "Отправьте сообщение для рассылки:"
+    )
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="❌ Отменить", callback_data="admin_broadcast_menu"))
+    return text, builder
+
+async def build_orders_page(screen: str, filters: dict, direction: str = None, cursor_id: int = None):
+    statuses, title = ORDER_SCREENS.get(screen, ORDER_SCREENS["recent"])
+    orders, has_more = await db.get_orders_page(
+        statuses, direction, cursor_id, ORDERS_PAGE_SIZE, **filters
+    )
+    
+    text = f"{title}\n"
+    if filters:
+        text += f"🔎 Фильтр: {format_order_filters(filters)}\n"
+    text += "\n"
+    
+    if orders:
+        for order in orders:
+            status_emoji = ORDER_STATUS_EMOJI.get(order['status'], "❓")
+            display_id = order['personal_id'] or order['id']
+            text += f"{status_emoji} #{display_id} | {order['total_amount']:,.0f}₽ | {order['user_id']}\n{order['created_at'][:16]}\n\n"
+    else:
+        text += "❌ Заявки не найдены"
+    
+    # Есть ли страницы новее/старше текущей
+    has_newer = direction == "next" or (direction == "prev" and has_more)
+    has_older = (direction != "prev" and has_more) or direction == "prev"
+    
+    builder = InlineKeyboardBuilder()
+    nav = []
+    if orders and has_newer:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"admin_ob_{screen}_prev_{orders[0]['id']}"))
+    if orders and has_older:
+        nav.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"admin_ob_{screen}_next_{orders[-1]['id']}"))
+    if nav:
+        builder.row(*nav)
+    if filters:
+        builder.row(InlineKeyboardButton(text="🧹 Сбросить фильтр", callback_data=f"admin_ob_reset_{screen}"))
+    builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
+    return text, builder.as_markup()
+
+async def show_orders_page(callback: CallbackQuery, state: FSMContext, screen: str,
+                           direction: str = None, cursor_id: int = None):
+    try:
+        data = await state.get_data()
+        text, markup = await build_orders_page(screen, data.get("order_filters", {}), direction, cursor_id)
+        await callback.message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
+
+@router.message(Command("orders"))
+async def orders_command(message: Message, state: FSMContext):
+    if not await is_admin_in_chat(message.from_user.id, message.chat.id):
+        return
+    
+    args = message.text.split()[1:]
+    screen = "recent"
+    if args and args[0] in ORDER_SCREENS:
+        screen = args.pop(0)
+    
+    try:
+        filters = parse_order_filters(args)
+    except ValueError as e:
+        await message.answer(
+            f"❌ {e}\n\n"
+            "Использование: /orders [recent|pending|completed|cancelled|problem] "
+            "[user=ID] [min=сумма] [max=сумма] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"
+        )
+        return
+    
+    await state.update_data(order_filters=filters)
+    text, markup = await build_orders_page(screen, filters)
+    await message.answer(text, reply_markup=markup, parse_mode="HTML")
+
 @router.message(Command("admin"))
 async def admin_panel_handler(message: Message, state: FSMContext):
     if not await is_admin_in_chat(message.from_user.id, message.chat.id):
@@ -288,19 +576,14 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "users_menu":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT COUNT(*) FROM users') as cursor:
-                        total_users = (await cursor.fetchone())[0]
-                    async with database.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1') as cursor:
-                        blocked_users = (await cursor.fetchone())[0]
-                    async with database.execute('SELECT COUNT(*) FROM users WHERE total_operations > 0') as cursor:
-                        active_users = (await cursor.fetchone())[0]
+                counts = await db.count_users()
                 
                 text = (
                     f"👥 <b>Управление пользователями</b>\n\n"
-                    f"📊 Всего: {total_users}\n"
-                    f"⚡ Активных: {active_users}\n"
-                    f"🚫 Заблокированных: {blocked_users}"
+                    f"📊 Всего: {counts['total']}\n"
+                    f"⚡ Активных: {counts['active']}\n"
+                    f"🚫 Заблокированных: {counts['blocked']}\n"
+                    f"📵 Недоступных: {counts['unreachable']}"
                 )
             except:
                 text = "👥 <b>Управление пользователями</b>\n\n❌ Ошибка загрузки статистики"
@@ -360,6 +643,7 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
                     f"🕐 Время работы: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
                     f"🔄 Обновлено: {datetime.now().strftime('%H:%M:%S')}"
                 )
+                text += format_metrics_summary()
                 
                 builder = InlineKeyboardBuilder()
                 builder.row(
@@ -372,17 +656,15 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "view_logs":
             try:
-                log_files = []
-                for file in os.listdir('.'):
-                    if file.endswith('.log'):
-                        log_files.append(file)
+                log_files = list_log_files(config.LOG_DIR)
                 
                 if log_files:
                     text = "📋 <b>Доступные лог-файлы:</b>\n\n"
-                    for log_file in log_files:
-                        size = os.path.getsize(log_file) / 1024
-                        text += f"📄 {log_file} ({size:.1f} KB)\n"
-                    text += "\n💡 Используйте команду /get_log filename для просмотра"
+                    for log_file, size in log_files:
+                        text += f"📄 {log_file} ({size / 1024:.1f} KB)\n"
+                    text += (
+                        "\n💡 /get_log filename [lines=N] [order=ID] [user=ID] [level=ERROR] [file]"
+                    )
                 else:
                     text = "📋 <b>Логи</b>\n\n❌ Лог-файлы не найдены"
                 
@@ -394,198 +676,52 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "cleanup_db":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    await database.execute('DELETE FROM orders WHERE status = "cancelled" AND created_at < datetime("now", "-30 days")')
-                    await database.execute('DELETE FROM captcha_sessions WHERE created_at < datetime("now", "-1 day")')
-                    await database.execute('VACUUM')
-                    await database.commit()
+                await db.purge_expired()
+                archived = await archive_and_vacuum()
                 
-                await callback.answer("✅ База данных очищена", show_alert=True)
+                await callback.answer(f"✅ База данных очищена, в архив: {archived}", show_alert=True)
                 await admin_callback_handler(callback.model_copy(update={"data": "admin_system_menu"}), state)
             except Exception as e:
                 await callback.answer(f"❌ Ошибка очистки БД: {e}", show_alert=True)
 
-        elif action == "recent_orders":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, status, created_at, personal_id
-                        FROM orders ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
-                        orders = await cursor.fetchall()
-                
-                if orders:
-                    text = "📋 <b>Последние 10 заявок:</b>\n\n"
-                    for order in orders:
-                        order_id, user_id, amount, status, created_at, personal_id = order
-                        status_emoji = {"waiting": "⏳", "finished": "✅", "cancelled": "❌", "paid_by_client": "💰"}.get(status, "❓")
-                        display_id = personal_id or order_id
-                        text += f"{status_emoji} #{display_id} | {amount:,.0f}₽ | {user_id}\n{created_at[:16]}\n\n"
-                else:
-                    text = "📋 <b>Заявки</b>\n\n❌ Заявки не найдены"
-                
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
-                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
+        elif action in ("recent_orders", "pending_orders", "completed_orders",
+                        "cancelled_orders", "problem_orders"):
+            await show_orders_page(callback, state, action.replace("_orders", ""))
 
-        elif action == "pending_orders":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status IN ("waiting", "paid_by_client") ORDER BY created_at DESC
-                    ''') as cursor:
-                        orders = await cursor.fetchall()
-                
-                if orders:
-                    text = f"⏳ <b>Ожидающие заявки ({len(orders)}):</b>\n\n"
-                    for order in orders[:10]:
-                        order_id, user_id, amount, created_at, personal_id = order
-                        display_id = personal_id or order_id
-                        text += f"📋 #{display_id} | {amount:,.0f}₽ | {user_id}\n{created_at[:16]}\n\n"
-                    
-                    if len(orders) > 10:
-                        text += f"... и еще {len(orders) - 10} заявок"
-                else:
-                    text = "⏳ <b>Ожидающие заявки</b>\n\n✅ Нет ожидающих заявок"
-                
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
-                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
-
-        elif action == "completed_orders":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "completed" ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
-                        orders = await cursor.fetchall()
-                
-                if orders:
-                    text = "✅ <b>Завершенные заявки (последние 10):</b>\n\n"
-                    for order in orders:
-                        order_id, user_id, amount, created_at, personal_id = order
-                        display_id = personal_id or order_id
-                        text += f"✅ #{display_id} | {amount:,.0f}₽ | {user_id}\n{created_at[:16]}\n\n"
-                else:
-                    text = "✅ <b>Завершенные заявки</b>\n\n❌ Завершенных заявок нет"
-                
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
-                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
-
-        elif action == "cancelled_orders":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "cancelled" ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
-                        orders = await cursor.fetchall()
-                
-                if orders:
-                    text = "❌ <b>Отмененные заявки (последние 10):</b>\n\n"
-                    for order in orders:
-                        order_id, user_id, amount, created_at, personal_id = order
-                        display_id = personal_id or order_id
-                        text += f"❌ #{display_id} | {amount:,.0f}₽ | {user_id}\n{created_at[:16]}\n\n"
-                else:
-                    text = "❌ <b>Отмененные заявки</b>\n\n✅ Отмененных заявок нет"
-                
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
-                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
-
-        elif action == "problem_orders":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "problem" ORDER BY created_at DESC
-                    ''') as cursor:
-                        orders = await cursor.fetchall()
-                
-                if orders:
-                    text = f"⚠️ <b>Проблемные заявки ({len(orders)}):</b>\n\n"
-                    for order in orders:
-                        order_id, user_id, amount, created_at, personal_id = order
-                        display_id = personal_id or order_id
-                        text += f"⚠️ #{display_id} | {amount:,.0f}₽ | {user_id}\n{created_at[:16]}\n\n"
-                else:
-                    text = "⚠️ <b>Проблемные заявки</b>\n\n✅ Проблемных заявок нет"
-                
-                builder = InlineKeyboardBuilder()
-                builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_orders_menu"))
-                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
+        elif action.startswith("ob_"):
+            # Листание заявок: ob_<экран>_<next|prev>_<id> или ob_reset_<экран>
+            parts = action.split("_")
+            if parts[1] == "reset":
+                await state.update_data(order_filters={})
+                await show_orders_page(callback, state, parts[2])
+            else:
+                await show_orders_page(callback, state, parts[1], parts[2], int(parts[3]))
 
         elif action == "find_order":
             await callback.message.edit_text(
                 "🔍 <b>Поиск заявки</b>\n\n"
-                "Введите ID заявки:",
+                "Введите ID заявки, BTC адрес, реквизиты или OnlyPays ID:",
                 parse_mode="HTML"
             )
             await state.update_data(action="find_order")
             await state.set_state(AdminStates.waiting_for_order_id)
 
-        elif action == "broadcast_active":
-            try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE total_operations > 0') as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
-                
-                await callback.message.edit_text(
-                    f"📤 <b>Рассылка активным пользователям</b>\n\n"
-                    f"Найдено активных пользователей: {len(users)}\n\n"
-                    "Отправьте сообщение для рассылки:",
-                    parse_mode="HTML"
-                )
-                await state.update_data(action="broadcast_active", target_users=users)
-                await state.set_state(AdminStates.waiting_for_broadcast_message)
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
-
-        elif action == "broadcast_new":
-            try:
-                week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE registration_date > ?', (week_ago,)) as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
-                
-                await callback.message.edit_text(
-                    f"📤 <b>Рассылка новым пользователям</b>\n\n"
-                    f"Найдено новых пользователей (за неделю): {len(users)}\n\n"
-                    "Отправьте сообщение для рассылки:",
-                    parse_mode="HTML"
-                )
-                await state.update_data(action="broadcast_new", target_users=users)
-                await state.set_state(AdminStates.waiting_for_broadcast_message)
-            except Exception as e:
-                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
-
-        elif action == "broadcast_traders":
+        elif action == "bc_custom":
+            builder = InlineKeyboardBuilder()
+            builder.row(InlineKeyboardButton(text="❌ Отменить", callback_data="admin_broadcast_menu"))
+            await callback.message.edit_text(
+                f"🧩 <b>Свой сегмент</b>\n\n{SEGMENT_FILTERS_HELP}",
+                reply_markup=builder.as_markup(),
+                parse_mode="HTML"
+            )
+            await state.set_state(AdminStates.waiting_for_segment_filters)
+        
+        elif action.startswith("bc_") and action[3:] in BROADCAST_SEGMENTS:
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE total_operations >= 1') as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
-                
-                await callback.message.edit_text(
-                    f"📤 <b>Рассылка пользователям с операциями</b>\n\n"
-                    f"Найдено пользователей с операциями: {len(users)}\n\n"
-                    "Отправьте сообщение для рассылки:",
-                    parse_mode="HTML"
-                )
-                await state.update_data(action="broadcast_traders", target_users=users)
+                filters, title = BROADCAST_SEGMENTS[action[3:]]
+                text, builder = await build_broadcast_preview(filters, title)
+                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+                await state.update_data(action="broadcast", segment=filters)
                 await state.set_state(AdminStates.waiting_for_broadcast_message)
             except Exception as e:
                 await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
@@ -593,7 +729,7 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
         elif action in ["toggle_captcha", "change_percentage", "change_limits", "change_welcome",
                         "find_user", "message_user", "block_user", "unblock_user",
                         "add_admin", "remove_admin", "add_operator", "remove_operator",
-                        "staff_list", "broadcast_all", "user_stats", "recent_users"]:
+                        "staff_list", "user_stats", "recent_users"]:
             await handle_settings_and_management(callback, state, action)
 
         else:
@@ -694,24 +830,6 @@ async def handle_settings_and_management(callback: CallbackQuery, state: FSMCont
     elif action == "staff_list":
         await show_staff_list(callback)
     
-    elif action == "broadcast_all":
-        users = await db.get_all_users()
-        
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text="❌ Отменить", callback_data="admin_broadcast_menu")
-        )
-        
-        await callback.message.edit_text(
-            f"📤 <b>Рассылка всем пользователям</b>\n\n"
-            f"Найдено пользователей: {len(users)}\n\n"
-            f"Отправьте сообщение для рассылки:",
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
-        )
-        await state.update_data(action="broadcast_all", target_users=users)
-        await state.set_state(AdminStates.waiting_for_broadcast_message)
-    
     elif action == "user_stats":
         await show_detailed_user_stats(callback)
     
@@ -764,27 +882,18 @@ async def show_staff_list(callback: CallbackQuery):
 
 async def show_detailed_user_stats(callback: CallbackQuery):
     try:
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute('SELECT COUNT(*) FROM users') as cursor:
-                total_users = (await cursor.fetchone())[0]
-            async with database.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1') as cursor:
-                blocked_users = (await cursor.fetchone())[0]
-            async with database.execute('SELECT COUNT(*) FROM users WHERE DATE(registration_date) = DATE("now")') as cursor:
-                today_registrations = (await cursor.fetchone())[0]
-            async with database.execute('SELECT COUNT(*) FROM users WHERE total_operations > 0') as cursor:
-                active_users = (await cursor.fetchone())[0]
-            async with database.execute('SELECT COUNT(*) FROM users WHERE DATE(registration_date) >= DATE("now", "-7 days")') as cursor:
-                week_registrations = (await cursor.fetchone())[0]
-                
-        activity_rate = (active_users/total_users*100) if total_users > 0 else 0
+        counts = await db.count_users()
+        total_users = counts['total']
+        activity_rate = (counts['active']/total_users*100) if total_users > 0 else 0
         
         text = (
             f"📊 <b>Детальная статистика пользователей</b>\n\n"
             f"👥 Всего пользователей: {total_users}\n"
-            f"🚫 Заблокированных: {blocked_users}\n"
-            f"⚡ Активных: {active_users}\n"
-            f"📅 Регистраций сегодня: {today_registrations}\n"
-            f"📅 Регистраций за неделю: {week_registrations}\n"
+            f"🚫 Заблокированных: {counts['blocked']}\n"
+            f"📵 Недоступных (бот заблокирован, аккаунт удален): {counts['unreachable']}\n"
+            f"⚡ Активных: {counts['active']}\n"
+            f"📅 Регистраций сегодня: {counts['today']}\n"
+            f"📅 Регистраций за неделю: {counts['week']}\n"
             f"📈 Процент активности: {activity_rate:.1f}%"
         )
         
@@ -799,19 +908,17 @@ async def show_detailed_user_stats(callback: CallbackQuery):
 
 async def show_recent_users(callback: CallbackQuery):
     try:
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute('''
-                SELECT user_id, username, first_name, registration_date, total_operations
-                FROM users ORDER BY registration_date DESC LIMIT 10
-            ''') as cursor:
-                rows = await cursor.fetchall()
+        rows = await db.get_recent_users(10)
         
         if not rows:
             text = "❌ Пользователи не найдены"
         else:
             text = f"👥 <b>Последние 10 пользователей:</b>\n\n"
-            for user_id, username, first_name, reg_date, operations in rows:
-                text += f"🆔 {user_id} | @{username or 'нет'}\n{first_name} | {reg_date[:16]} | {operations or 0} операций\n\n"
+            for row in rows:
+                text += (
+                    f"🆔 {row['user_id']} | @{row['username'] or 'нет'}\n"
+                    f"{row['first_name']} | {(row['registration_date'] or '')[:16]} | {row['total_operations'] or 0} операций\n\n"
+                )
         
         builder = InlineKeyboardBuilder()
         builder.row(InlineKeyboardButton(text="◶️ Назад", callback_data="admin_users_menu"))
@@ -873,26 +980,81 @@ async def process_welcome_change(message: Message, state: FSMContext):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
+async def fetch_order_card(order_id):
+    return await db.find_order_card(order_id)
+
+def format_order_matches(orders: list) -> str:
+    text = ""
+    for order in orders:
+        status_emoji = ORDER_STATUS_EMOJI.get(order['status'], "❓")
+        display_id = order['personal_id'] or order['id']
+        archived = " | 🗄 архив" if order.get('archived') else ""
+        text += f"{status_emoji} #{display_id} | {order['total_amount']:,.0f}₽ | {order['user_id']} | {order['created_at'][:16]}{archived}\n"
+    return text
+
+@router.message(Command("search"))
+async def search_command(message: Message):
+    if not await is_admin_in_chat(message.from_user.id, message.chat.id):
+        return
+    
+    query = message.text.partition(" ")[2].strip()
+    if not query:
+        await message.answer(
+            "❌ Использование: /search текст\n\n"
+            "Ищет по началу слов: username, имя, ID пользователя, номер заявки, "
+            "OnlyPays ID, BTC адрес, реквизиты и заметки оператора."
+        )
+        return
+    
+    try:
+        users = await db.search_users(query, 10)
+        orders = await db.search_orders(query, 10)
+        
+        if not users and not orders:
+            await message.answer("❌ Ничего не найдено")
+            return
+        
+        text = f"🔍 <b>Поиск:</b> {html.escape(query)}\n\n"
+        if users:
+            text += "👥 <b>Пользователи:</b>\n"
+            for user in users:
+                name = html.escape(" ".join(filter(None, [user['first_name'], user['last_name']])) or "—")
+                username = f" @{html.escape(user['username'])}" if user['username'] else ""
+                blocked = " 🚫" if user['is_blocked'] else ""
+                text += f"<code>{user['user_id']}</code> {name}{username}{blocked}\n"
+            text += "\n"
+        if orders:
+            text += "📋 <b>Заявки:</b>\n" + format_order_matches(orders)
+        
+        await message.answer(text, parse_mode="HTML")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка поиска: {e}")
+
 @router.message(AdminStates.waiting_for_order_id)
 async def process_order_search(message: Message, state: FSMContext):
     try:
         order_id = message.text.strip()
+        order = await fetch_order_card(order_id)
         
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute('''
-                SELECT id, user_id, amount_rub, amount_btc, btc_address, total_amount, status, 
-                       created_at, personal_id, payment_type, rate
-                FROM orders 
-                WHERE id = ? OR personal_id = ?
-            ''', (order_id, order_id)) as cursor:
-                order = await cursor.fetchone()
+        if not order:
+            # Не точный ID — ищем по адресу, реквизитам, OnlyPays ID и заметкам
+            matches = await db.search_orders(order_id, 10)
+            if len(matches) == 1:
+                order = await fetch_order_card(matches[0]['id'])
+            elif matches:
+                await message.answer(
+                    "🔍 <b>Найдено несколько заявок:</b>\n\n" + format_order_matches(matches) +
+                    "\nВведите ID нужной заявки:",
+                    parse_mode="HTML"
+                )
+                return
         
         if not order:
             await message.answer("❌ Заявка не найдена")
             return
         
         (internal_id, user_id, amount_rub, amount_btc, btc_address, total_amount, 
-         status, created_at, personal_id, payment_type, rate) = order
+         status, created_at, personal_id, payment_type, rate, archived) = order
         
         display_id = personal_id or internal_id
         status_text = {
@@ -917,7 +1079,9 @@ async def process_order_search(message: Message, state: FSMContext):
             f"💱 Курс: {rate:,.0f} ₽\n"
             f"📱 Тип оплаты: {payment_type or 'Не указан'}\n"
             f"📊 Статус: {status_text}\n"
-            f"📅 Создана: {created_at}\n\n"
+            f"📅 Создана: {created_at}\n"
+            + ("📦 Заявка в архиве\n" if archived else "") +
+            "\n"
             f"₿ <b>Bitcoin адрес:</b>\n<code>{btc_address}</code>"
         )
         
@@ -1142,38 +1306,77 @@ async def process_block_reason(message: Message, state: FSMContext):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
+@router.message(AdminStates.waiting_for_segment_filters)
+async def process_segment_filters(message: Message, state: FSMContext):
+    try:
+        filters = parse_segment_filters((message.text or "").split())
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{SEGMENT_FILTERS_HELP}", parse_mode="HTML")
+        return
+    
+    try:
+        text, builder = await build_broadcast_preview(filters, "сегменту")
+        await message.answer(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+        await state.update_data(action="broadcast", segment=filters)
+        await state.set_state(AdminStates.waiting_for_broadcast_message)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {e}")
+
+async def send_broadcast_copy(message: Message, user_id: int):
+    """Копия сообщения рассылки; None при успехе, иначе класс ошибки доставки"""
+    for _ in range(BROADCAST_FLOOD_RETRIES + 1):
+        try:
+            await message.bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=message.chat.id,
+                message_id=message.message_id
+            )
+            return None
+        except TelegramRetryAfter as e:
+            logger.warning(f"Broadcast flood control, retry after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            reason = classify_delivery_error(e)
+            if reason in UNDELIVERABLE:
+                logger.info(f"Broadcast to {user_id} undeliverable: {reason}", extra={'chat_id': user_id})
+            else:
+                logger.error(f"Failed to send broadcast to {user_id}: {e}", extra={'chat_id': user_id})
+            return reason
+    return "flood"
+
 @router.message(AdminStates.waiting_for_broadcast_message)
 async def process_broadcast_message(message: Message, state: FSMContext):
     data = await state.get_data()
-    action = data.get("action")
-    target_users = data.get("target_users", [])
-    
-    if not target_users and action == "broadcast_all":
-        target_users = await db.get_all_users()
+    filters = data.get("segment", {})
     
     try:
-        sent_count = failed_count = 0
+        sent_count = 0
+        errors = {}
         
-        await message.answer(f"📤 Начинаю рассылку для {len(target_users)} пользователей...")
+        total = await db.count_segment(**filters)
+        await message.answer(f"📤 Начинаю рассылку для {total} пользователей...")
         
-        for user_id in target_users:
-            try:
-                await message.bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id
-                )
-                sent_count += 1
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Failed to send broadcast to {user_id}: {e}")
+        # Получатели читаются пачками во время отправки, а не хранятся списком в состоянии
+        async for user_ids in db.iter_segment(**filters):
+            undeliverable = []
+            for user_id in user_ids:
+                reason = await send_broadcast_copy(message, user_id)
+                if reason is None:
+                    sent_count += 1
+                    continue
+                errors[reason] = errors.get(reason, 0) + 1
+                if reason in UNDELIVERABLE:
+                    undeliverable.append((user_id, reason))
+            # Недоступные чаты отмечаются раз в пачку и в следующие рассылки не попадут
+            await db.mark_undeliverable(undeliverable)
         
-        await message.answer(
-            f"✅ <b>Рассылка завершена!</b>\n\n"
-            f"📤 Отправлено: {sent_count}\n"
-            f"❌ Ошибок: {failed_count}",
-            parse_mode="HTML"
-        )
+        text = f"✅ <b>Рассылка завершена!</b>\n\n📤 Отправлено: {sent_count}\n"
+        for reason, label in DELIVERY_ERROR_LABELS.items():
+            if errors.get(reason):
+                text += f"{label}: {errors[reason]}\n"
+        if any(reason in UNDELIVERABLE for reason in errors):
+            text += "\n📵 Недоступные чаты исключены из следующих рассылок"
+        await message.answer(text, parse_mode="HTML")
         
         builder = create_main_admin_panel()
         await message.answer("👑 <b>Панель администратора</b>", reply_markup=builder.as_markup(), parse_mode="HTML")
@@ -1183,42 +1386,255 @@ async def process_broadcast_message(message: Message, state: FSMContext):
 
 async def find_user_by_username(username: str) -> int:
     try:
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute(
-                'SELECT user_id FROM users WHERE username = ? COLLATE NOCASE',
-                (username,)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else None
+        return await db.find_user_id_by_username(username)
     except:
         return None
 
+LOG_FILTER_KEYS = {"order": "order_id", "user": "user_id", "level": "level", "text": "text"}
+
+def read_log_slice(path: str, count: int, filters: dict) -> list:
+    if filters or path.endswith('.gz'):
+        return grep_lines(path, count, **filters)
+    return tail_lines(path, count)
+
+@router.message(Command("db_profile"))
+async def db_profile_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    parts = message.text.split()
+    command = parts[1].lower() if len(parts) > 1 else ""
+    
+    if command == "on":
+        profiler.enabled = True
+        await message.answer(
+            f"✅ Профилирование запросов включено (медленные: от {profiler.slow_threshold * 1000:.0f} мс)"
+        )
+        return
+    if command == "off":
+        profiler.enabled = False
+        await message.answer("⏸ Профилирование запросов выключено")
+        return
+    if command == "reset":
+        profiler.reset()
+        await message.answer("🧹 Статистика запросов сброшена")
+        return
+    if command and not command.isdigit():
+        await message.answer("❌ Использование: /db_profile [N] | on | off | reset")
+        return
+    
+    top = profiler.top(int(command) if command else 10)
+    status = "включено" if profiler.enabled else "выключено"
+    if not top:
+        await message.answer(f"📊 Профилирование {status}, запросов пока нет.\n\nВключить: /db_profile on")
+        return
+    
+    text = f"📊 <b>Топ запросов по суммарному времени</b> (профилирование {status})\n\n"
+    for index, stats in enumerate(top, 1):
+        sql = stats.sql if len(stats.sql) <= 200 else stats.sql[:200] + "…"
+        text += (
+            f"<b>{index}.</b> {stats.total_time * 1000:.0f} мс всего | {stats.calls} вызовов | "
+            f"сред. {stats.avg_time * 1000:.1f} мс | макс. {stats.max_time * 1000:.1f} мс | "
+            f"строк {stats.rows}\n<code>{html.escape(sql)}</code>\n"
+        )
+        if stats.plan:
+            text += "🗺 " + html.escape("; ".join(stats.plan)) + "\n"
+        text += "\n"
+    
+    if len(text) > 4000:
+        text = text[:4000] + "…"
+        text = text[:text.rfind("\n\n")]
+    await message.answer(text, parse_mode="HTML")
+
+@router.message(Command("rebuild_referrals"))
+async def rebuild_referrals_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    await db.rebuild_referral_counters()
+    await message.answer("✅ Реферальные счетчики и балансы пересчитаны")
+
+@router.message(Command("rebuild_totals"))
+async def rebuild_totals_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    updated = await db.rebuild_user_totals(config.ARCHIVE_BATCH_SIZE)
+    await db.set_setting("user_totals_rebuilt", True)
+    await message.answer(f"✅ Счетчики обменов пересчитаны: {updated} пользователей")
+
+@router.message(Command("referral_top"))
+async def referral_top_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    leaders = await db.get_referral_leaderboard(ttl=config.REFERRAL_LEADERBOARD_TTL)
+    if not leaders:
+        await message.answer("👥 Реферальных начислений пока нет")
+        return
+    
+    text = "🏆 <b>Топ рефереров</b>\n\n"
+    for index, leader in enumerate(leaders, 1):
+        name = f"@{leader['username']}" if leader['username'] else (leader['first_name'] or "—")
+        text += (
+            f"<b>{index}.</b> {html.escape(name)} (<code>{leader['user_id']}</code>) — "
+            f"{leader['referral_balance']:.2f} ₽, друзей: {leader['referral_count']}\n"
+        )
+    await message.answer(text, parse_mode="HTML")
+
+# Лимит Bot API на отправку документа
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+# Без встроенных снимков (PostgreSQL) команды /backup нет
+@router.message(Command("backup"), F.func(lambda message: db.supports_backup))
+async def backup_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    if message.text.split()[1:2] == ["list"]:
+        backups = list_backup_sets(config.BACKUP_DIR, config.DATABASE_URL)
+        if not backups:
+            await message.answer("🗄 Снимков базы пока нет")
+            return
+        text = "🗄 <b>Снимки базы</b>\n\n" + "".join(
+            f"• <b>{snapshot}</b>\n" + "".join(
+                f"  <code>{name}</code> — {size / 1024 / 1024:.1f} МБ\n" for name, size in files
+            )
+            for snapshot, files in reversed(backups)
+        )
+        await message.answer(text, parse_mode="HTML")
+        return
+    
+    status = await message.answer("⏳ Создаю снимок базы...")
+    try:
+        paths = await make_backup()
+    except Exception as e:
+        await status.edit_text(f"❌ Ошибка бэкапа: {e}")
+        return
+    
+    await status.delete()
+    for path in paths:
+        size = os.path.getsize(path)
+        name = os.path.basename(path)
+        if size > MAX_DOCUMENT_SIZE:
+            await message.answer(f"✅ Снимок {name} ({size / 1024 / 1024:.1f} МБ) слишком большой для отправки, сохранен на сервере")
+            continue
+        await message.answer_document(FSInputFile(path, filename=name), caption=f"🗄 Снимок базы: {name}")
+
+@router.message(Command("export"))
+async def export_command(message: Message):
+    if not await is_admin_extended(message.from_user.id):
+        return
+    
+    usage = (
+        "❌ Использование:\n"
+        "/export orders [pending|completed|cancelled|problem] [user=ID] [min=N] [max=N] "
+        "[from=2024-01-01] [to=2024-01-31]\n"
+        "/export users"
+    )
+    args = message.text.split()[1:]
+    if not args or args[0] not in ("orders", "users"):
+        await message.answer(usage)
+        return
+    
+    kind = args.pop(0)
+    try:
+        if kind == "orders":
+            screen = args.pop(0) if args and args[0] in ORDER_SCREENS else "recent"
+            statuses, _ = ORDER_SCREENS[screen]
+            filters = parse_order_filters(args)
+            header = (*Order.COLUMNS, "archived")
+            chunks = db.iter_orders(statuses, **filters)
+        elif args:
+            await message.answer(usage)
+            return
+        else:
+            header = User.COLUMNS
+            chunks = db.iter_users()
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{usage}")
+        return
+    
+    status = await message.answer("⏳ Готовлю выгрузку...")
+    path = None
+    try:
+        path, total = await export_csv_gz(header, chunks, prefix=kind)
+        size = os.path.getsize(path)
+        if size > MAX_DOCUMENT_SIZE:
+            await status.edit_text(f"❌ Выгрузка ({size / 1024 / 1024:.1f} МБ) больше лимита Telegram, сузьте фильтр")
+            return
+        
+        filename = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv.gz"
+        await status.delete()
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"📤 {kind}: {total} строк")
+    except Exception as e:
+        await status.edit_text(f"❌ Ошибка выгрузки: {e}")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
 @router.message(Command("get_log"))
 async def get_log_command(message: Message):
     if not await is_admin_extended(message.from_user.id):
         return
     
+    usage = (
+        "❌ Использование: /get_log filename.log [lines=N] [order=ID] [user=ID] "
+        "[level=ERROR] [text=строка] [file]"
+    )
+    
     try:
         parts = message.text.split()
-        if len(parts) != 2:
-            await message.answer("❌ Использование: /get_log filename.log")
+        if len(parts) < 2:
+            await message.answer(usage)
             return
         
         filename = parts[1]
-        if not filename.endswith('.log'):
-            filename += '.log'
+        count = 50
+        as_file = False
+        filters = {}
+        for arg in parts[2:]:
+            key, _, value = arg.partition("=")
+            if arg == "file":
+                as_file = True
+            elif key == "lines" and value.isdigit():
+                count = int(value)
+            elif key in ("order", "user") and value.isdigit():
+                filters[LOG_FILTER_KEYS[key]] = int(value)
+            elif key in ("level", "text") and value:
+                filters[LOG_FILTER_KEYS[key]] = value
+            else:
+                await message.answer(usage)
+                return
         
-        if not os.path.exists(filename):
+        path = resolve_log_path(filename, config.LOG_DIR)
+        if not path:
             await message.answer("❌ Файл не найден")
             return
+        filename = os.path.basename(path)
         
-        with open(filename, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # Документом можно отдать больше строк, чем помещается в сообщение
+        count = min(count, 100000 if as_file else 500)
+        lines = await asyncio.to_thread(read_log_slice, path, count, filters)
+        if not lines:
+            await message.answer("❌ Совпадений не найдено")
+            return
         
-        if len(content) > 4000:
+        content = "\n".join(lines)
+        if as_file or len(content) > 4000:
+            data = await asyncio.to_thread(gzip_lines, lines)
+            await message.answer_document(
+                BufferedInputFile(data, filename=f"{filename}.slice.gz"),
+                caption=f"📋 {filename}: {len(lines)} строк"
+            )
+            if as_file:
+                return
             content = "...\n" + content[-4000:]
         
-        await message.answer(f"📋 <b>Лог файл: {filename}</b>\n\n<code>{content}</code>", parse_mode="HTML")
+        await message.answer(
+            f"📋 <b>Лог файл: {filename}</b>\n\n<code>{html.escape(content)}</code>",
+            parse_mode="HTML"
+        )
         
     except Exception as e:
         await message.answer(f"❌ Ошибка чтения лога: {e}")
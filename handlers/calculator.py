@@ -6,7 +6,8 @@ from aiogram.fsm.state import State, StatesGroup
 from keyboards.reply import ReplyKeyboards
 from keyboards.inline import InlineKeyboards
 from utils.bitcoin import BitcoinAPI
-from database.models import Database
+from database.storage import create_database
+from handlers.operator import loyalty
 from config import config
 
 
@@ -21,7 +22,7 @@ router = Router()
 class CalculatorStates(StatesGroup):
     waiting_for_amount = State()
 
-db = Database(config.DATABASE_URL)
+db = create_database(config.DATABASE_URL)
 
 @router.message(F.text == "Калькулятор валют")
 async def calculator_main_handler(message: Message, state: FSMContext):
@@ -159,8 +160,8 @@ async def calculate_and_show_result(callback: CallbackQuery, state: FSMContext,
         btc_amount = amount
         rub_amount = btc_amount * btc_rate
     
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Новая логика расчета с единой комиссией
+    # Единая комиссия, кроме бесплатных обменов программы лояльности
+    COMMISSION_PERCENT, loyalty_free = await loyalty.commission_for(callback.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     
     if from_currency.upper() == 'RUB':
@@ -174,6 +175,7 @@ async def calculate_and_show_result(callback: CallbackQuery, state: FSMContext,
         f"🧮 <b>Результат расчета</b>\n\n"
         f"💱 <b>{from_currency.upper()} → {to_currency.upper()}</b>\n\n"
         f"📊 {from_formatted} = <b>{to_formatted}</b>\n\n"
+        f"{loyalty.note if loyalty_free else ''}"
         f"💸 <b>Итого к оплате: {total_amount:,.0f} ₽</b>"
     )
     
@@ -209,8 +211,8 @@ async def calculate_and_show_result_for_message(message: Message, state: FSMCont
         btc_amount = amount
         rub_amount = btc_amount * btc_rate
     
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Новая логика расчета с единой комиссией
+    # Единая комиссия, кроме бесплатных обменов программы лояльности
+    COMMISSION_PERCENT, loyalty_free = await loyalty.commission_for(message.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     
     if from_currency.upper() == 'RUB':
@@ -224,6 +226,7 @@ async def calculate_and_show_result_for_message(message: Message, state: FSMCont
         f"🧮 <b>Результат расчета</b>\n\n"
         f"💱 <b>{from_currency.upper()} → {to_currency.upper()}</b>\n\n"
         f"📊 {from_formatted} = <b>{to_formatted}</b>\n\n"
+        f"{loyalty.note if loyalty_free else ''}"
         f"💸 <b>Итого к оплате: {total_amount:,.0f} ₽</b>"
     )
     
@@ -6,9 +6,13 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from database.models import Database
+from database.storage import create_database
+from database.order_state import OrderStateMachine, OrderEvent
 from keyboards.inline import Keyboards
 from keyboards.reply import ReplyKeyboards
+from utils.loyalty import LoyaltyProgram
+from utils.notifications import NotificationOutbox
+from utils.scheduler import TaskScheduler
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -18,7 +22,11 @@ class OperatorStates(StatesGroup):
     waiting_for_note = State()
 
 # Инициализация базы данных
-db = Database(config.DATABASE_URL)
+db = create_database(config.DATABASE_URL)
+outbox = NotificationOutbox(db)
+order_sm = OrderStateMachine(db, outbox)
+scheduler = TaskScheduler(db)
+loyalty = LoyaltyProgram(db, config.LOYALTY_FREE_EVERY, config.LOYALTY_FREE_MAX_AMOUNT, config.LOYALTY_CACHE_TTL)
 
 # Список операторов (ID пользователей)
 OPERATORS = [
@@ -41,7 +49,7 @@ def can_handle_orders(user_id: int, chat_id: int) -> bool:
     """Может ли пользователь обрабатывать заявки в этом чате"""
     return (is_operator(user_id) or is_admin(user_id)) and is_operator_chat(chat_id)
 
-async def notify_operators_paid_order(bot, order: dict, received_sum: float = None):
+async def notify_operators_paid_order(order: dict, received_sum: float = None):
     """Уведомление операторов об оплаченной заявке"""
     try:
         display_id = order.get('personal_id', order['id'])
@@ -86,18 +94,17 @@ async def notify_operators_paid_order(bot, order: dict, received_sum: float = No
             )
         )
         
-        # Отправляем в операторский чат
-        await bot.send_message(
+        # Ставим в очередь для операторского чата
+        await outbox.enqueue(
             config.OPERATOR_CHAT_ID,
             text,
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
+            reply_markup=builder.as_markup()
         )
         
     except Exception as e:
         logger.error(f"Notify operators paid order error: {e}")
 
-async def notify_operators_error_order(bot, order: dict, error_message: str):
+async def notify_operators_error_order(order: dict, error_message: str):
     """Уведомление операторов об ошибке в заявке"""
     try:
         display_id = order.get('personal_id', order['id'])
@@ -130,17 +137,16 @@ async def notify_operators_error_order(bot, order: dict, error_message: str):
             )
         )
         
-        await bot.send_message(
+        await outbox.enqueue(
             config.OPERATOR_CHAT_ID,
             text,
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
+            reply_markup=builder.as_markup()
         )
         
     except Exception as e:
         logger.error(f"Notify operators error order error: {e}")
 
-async def notify_client_payment_received(bot, order: dict):
+async def notify_client_payment_received(order: dict):
     """Уведомление клиента о получении платежа"""
     try:
         display_id = order.get('personal_id', order['id'])
@@ -155,17 +161,16 @@ async def notify_client_payment_received(bot, order: dict):
             f"📱 Вы получите уведомление о завершении."
         )
         
-        await bot.send_message(
+        await outbox.enqueue(
             order['user_id'],
             text,
-            parse_mode="HTML",
             reply_markup=ReplyKeyboards.main_menu()
         )
         
     except Exception as e:
         logger.error(f"Notify client payment received error: {e}")
 
-async def notify_client_order_cancelled(bot, order: dict):
+async def notify_client_order_cancelled(order: dict):
     """Уведомление клиента об отмене заявки"""
     try:
         display_id = order.get('personal_id', order['id'])
@@ -178,17 +183,16 @@ async def notify_client_order_cancelled(bot, order: dict):
             f"Создайте новую заявку для обмена."
         )
         
-        await bot.send_message(
+        await outbox.enqueue(
             order['user_id'],
             text,
-            parse_mode="HTML",
             reply_markup=ReplyKeyboards.main_menu()
         )
         
     except Exception as e:
         logger.error(f"Notify client order cancelled error: {e}")
 
-async def notify_client_order_completed(bot, order: dict):
+async def notify_client_order_completed(order: dict):
     """Уведомление клиента о завершении заявки"""
     try:
         display_id = order.get('personal_id', order['id'])
@@ -203,18 +207,90 @@ async def notify_client_order_completed(bot, order: dict):
             f"Спасибо за использование {config.EXCHANGE_NAME}!"
         )
         
-        await bot.send_message(
+        await outbox.enqueue(
             order['user_id'],
             text,
-            parse_mode="HTML",
             reply_markup=ReplyKeyboards.main_menu()
         )
         
     except Exception as e:
         logger.error(f"Notify client order completed error: {e}")
 
+# Уведомления о смене статусов заявок: пишутся в очередь в транзакции перехода
+@order_sm.notify('paid_by_client')
+async def on_order_paid(event: OrderEvent):
+    received_sum = event.details.get('received_sum')
+    await notify_operators_paid_order(event.order, received_sum)
+    await notify_client_payment_received(event.order)
+
+@order_sm.notify('cancelled')
+async def on_order_cancelled(event: OrderEvent):
+    # Клиент, отменивший заявку сам или не дождавшийся реквизитов, уже получил ответ в чате
+    if event.actor != 'client' and event.details.get('reason') != 'onlypays_create_failed':
+        await notify_client_order_cancelled(event.order)
+
+@order_sm.notify('completed')
+async def on_order_completed(event: OrderEvent):
+    await notify_client_order_completed(event.order)
+
+@order_sm.on('completed')
+@order_sm.on('cancelled')
+async def on_order_completed_loyalty(event: OrderEvent):
+    # total_operations вырос или резерв бесплатного обмена вернулся в транзакции смены статуса
+    loyalty.invalidate(event.order['user_id'])
+
+@order_sm.on('completed')
+async def on_order_completed_referral(event: OrderEvent):
+    if config.REFERRAL_PERCENT <= 0:
+        return
+    bonus = await db.add_order_referral_bonus(event.order, config.REFERRAL_PERCENT)
+    if not bonus:
+        return
+    
+    logger.info(
+        f"Referral bonus {bonus['amount']} RUB for order {event.order['id']}",
+        extra={'order_id': event.order['id'], 'user_id': bonus['user_id']}
+    )
+    await outbox.enqueue(
+        bonus['user_id'],
+        f"💰 Вам начислен реферальный бонус {bonus['amount']:.2f} ₽ за сделку приглашенного друга!"
+    )
+
+async def alert_rejected_payment(order_id: int, received_sum):
+    """Оплата пришла, но заявку нельзя перевести в paid_by_client.
+    
+    Повтор уведомления по уже оплаченной заявке - норма. Если же заявка
+    отменена (оператор не отменяет ее в OnlyPays) или неизвестна, деньги
+    клиента получены, и без операторов платеж потеряется.
+    """
+    order = await db.get_order(order_id)
+    if order and order['status'] in ('paid_by_client', 'completed', 'finished'):
+        logger.info(f"Webhook finished for order {order_id} skipped: already processed")
+        return
+    
+    logger.warning(
+        f"Payment for order {order_id} received in status {order['status'] if order else 'not found'}",
+        extra={'order_id': order_id}
+    )
+    if order:
+        await notify_operators_error_order(
+            order, f"OnlyPays сообщил об оплате ({received_sum} ₽), но заявка в статусе '{order['status']}'"
+        )
+        return
+    
+    try:
+        await outbox.enqueue(
+            config.OPERATOR_CHAT_ID,
+            f"⚠️ <b>ОПЛАТА БЕЗ ЗАЯВКИ</b>\n\n"
+            f"🆔 Заявка: #{order_id} не найдена\n"
+            f"💵 Получено: {received_sum} ₽\n\n"
+            f"🔧 <b>Требуется вмешательство!</b>"
+        )
+    except Exception as e:
+        logger.error(f"Notify operators unknown payment error: {e}")
+
 # Webhook обработчик для OnlyPays
-async def process_onlypays_webhook(webhook_data: dict, bot):
+async def process_onlypays_webhook(webhook_data: dict):
     """Обработка webhook от OnlyPays"""
     try:
         order_id = webhook_data.get('personal_id')  # Наш внутренний ID заявки
@@ -226,35 +302,34 @@ async def process_onlypays_webhook(webhook_data: dict, bot):
             logger.error(f"Webhook without personal_id: {webhook_data}")
             return
         
-        # Получаем заявку из БД
-        order = await db.get_order(int(order_id))
-        if not order:
-            logger.error(f"Order not found: {order_id}")
-            return
+        details = {'onlypays_id': onlypays_id, 'received_sum': received_sum}
         
         if status == 'finished':
-            # Заявка оплачена клиентом
-            await db.update_order(
-                order['id'], 
-                status='paid_by_client',
+            # Заявка оплачена клиентом; повторный webhook отклоняется машиной состояний
+            order = await order_sm.transition(
+                int(order_id), 'paid_by_client',
+                actor='onlypays', details=details,
                 received_sum=received_sum
             )
-            
-            # Уведомляем операторов
-            await notify_operators_paid_order(bot, order, received_sum)
-            
-            # Уведомляем клиента
-            await notify_client_payment_received(bot, order)
-            
+        
         elif status == 'cancelled':
-            # Заявка отменена
-            await db.update_order(order['id'], status='cancelled')
-            
-            # Уведомляем клиента об отмене
-            await notify_client_order_cancelled(bot, order)
+            # Отмена от OnlyPays допустима только для неоплаченной заявки
+            order = await order_sm.transition(
+                int(order_id), 'cancelled', from_statuses=('waiting',),
+                actor='onlypays', details=details
+            )
+        else:
+            return
+        
+        if not order and status == 'finished':
+            await alert_rejected_payment(int(order_id), received_sum)
+        elif not order:
+            logger.info(f"Webhook {status} for order {order_id} skipped: already processed or not found")
             
     except Exception as e:
+        # Ошибку отдаем вызывающему: webhook ответит не 2xx, и OnlyPays повторит уведомление
         logger.error(f"Webhook processing error: {e}")
+        raise
 
 # Обработчики для операторов (ТОЛЬКО для работы с заявками)
 @router.callback_query(F.data.startswith("op_sent_"))
@@ -267,20 +342,17 @@ async def operator_sent_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     
     try:
-        # Обновляем статус заявки
-        await db.update_order(order_id, status='completed')
-        
-        # Получаем заявку
-        order = await db.get_order(order_id)
+        # Обновляем статус заявки, клиента уведомляет подписчик on_order_completed
+        order = await order_sm.transition(
+            order_id, 'completed',
+            actor=f"operator:{callback.from_user.id}"
+        )
         if not order:
-            await callback.answer("Заявка не найдена")
+            await callback.answer("Заявка не найдена или уже обработана", show_alert=True)
             return
         
         display_id = order.get('personal_id', order_id)
         
-        # Уведомляем клиента о завершении
-        await notify_client_order_completed(callback.bot, order)
-        
         # Обновляем сообщение оператора
         await callback.message.edit_text(
             f"✅ <b>ЗАЯВКА ЗАВЕРШЕНА</b>\n\n"
@@ -308,10 +380,15 @@ async def operator_problem_handler(callback: CallbackQuery):
     
     try:
         # Обновляем статус заявки
-        await db.update_order(order_id, status='problem')
+        order = await order_sm.transition(
+            order_id, 'problem',
+            actor=f"operator:{callback.from_user.id}"
+        )
+        if not order:
+            await callback.answer("Заявка не найдена или уже обработана", show_alert=True)
+            return
         
-        order = await db.get_order(order_id)
-        display_id = order.get('personal_id', order_id) if order else order_id
+        display_id = order.get('personal_id', order_id)
         
         # Уведомляем в админский чат
         admin_text = (
@@ -322,11 +399,7 @@ async def operator_problem_handler(callback: CallbackQuery):
             f"❗ Требуется вмешательство администратора"
         )
         
-        await callback.bot.send_message(
-            config.ADMIN_CHAT_ID,
-            admin_text,
-            parse_mode="HTML"
-        )
+        await outbox.enqueue(config.ADMIN_CHAT_ID, admin_text)
         
         # Обновляем сообщение
         await callback.message.edit_text(
@@ -383,6 +456,7 @@ async def operator_details_handler(callback: CallbackQuery):
         if not order:
             await callback.answer("Заявка не найдена")
             return
+        await db.load_order_fields(order, 'requisites')
         
         display_id = order.get('personal_id', order_id)
         
@@ -424,13 +498,16 @@ async def operator_cancel_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     
     try:
-        await db.update_order(order_id, status='cancelled')
-        
-        order = await db.get_order(order_id)
-        if order:
-            await notify_client_order_cancelled(callback.bot, order)
+        # Клиента уведомляет подписчик on_order_cancelled
+        order = await order_sm.transition(
+            order_id, 'cancelled',
+            actor=f"operator:{callback.from_user.id}"
+        )
+        if not order:
+            await callback.answer("Заявка не найдена или уже закрыта", show_alert=True)
+            return
         
-        display_id = order.get('personal_id', order_id) if order else order_id
+        display_id = order.get('personal_id', order_id)
         
         await callback.message.edit_text(
             f"❌ <b>ЗАЯВКА ОТМЕНЕНА</b>\n\n"
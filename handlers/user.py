@@ -1,26 +1,23 @@
 import logging
 import aiohttp
 import asyncio
+import time
 from datetime import datetime
+from typing import Optional
 from aiogram import Router, F
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database.models import Database
+from database.storage import create_database
 from keyboards.reply import ReplyKeyboards
 from keyboards.inline import InlineKeyboards
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from utils.bitcoin import BitcoinAPI
 from utils.captcha import CaptchaGenerator
 from config import config
-from handlers.operator import (
-    process_onlypays_webhook,
-    notify_operators_paid_order,
-    notify_operators_error_order,
-    notify_client_payment_received,
-    notify_client_order_cancelled
-)
+from utils.metrics import API_ERRORS, API_SECONDS
+from handlers.operator import process_onlypays_webhook, order_sm, outbox, scheduler, loyalty
 
 
 
@@ -34,11 +31,36 @@ logger = logging.getLogger(__name__)
 router = Router()
 
 class OnlyPaysAPI:
-    def __init__(self, api_id: str, secret_key: str, payment_key: str = None):
+    def __init__(self, api_id: str, secret_key: str, payment_key: str = None,
+                 base_url: str = "https://onlypays.net"):
         self.api_id = api_id
         self.secret_key = secret_key
         self.payment_key = payment_key
-        self.base_url = "https://onlypays.net"
+        self.base_url = base_url.rstrip("/")
+    
+    async def _post(self, method: str, url: str, data: dict, **context):
+        """POST-запрос к OnlyPays: тело ответа пишется только в DEBUG, в INFO - статус и задержка"""
+        started = time.monotonic()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, json=data) as response:
+                    status = response.status
+                    result = await response.json()
+        except Exception as e:
+            API_SECONDS.observe(time.monotonic() - started, api="onlypays", method=method)
+            API_ERRORS.inc(api="onlypays", method=method)
+            logger.error(f"OnlyPays {method} error: {e}", extra=context)
+            return {"success": False, "error": str(e)}
+        
+        elapsed = time.monotonic() - started
+        API_SECONDS.observe(elapsed, api="onlypays", method=method)
+        latency_ms = round(elapsed * 1000, 1)
+        logger.info(
+            f"OnlyPays {method}: HTTP {status}",
+            extra={**context, "latency_ms": latency_ms}
+        )
+        logger.debug(f"OnlyPays {method} response: {result}", extra=context)
+        return result
     
     async def create_order(self, amount: int, payment_type: str, personal_id: str = None, trans: bool = False):
         url = f"{self.base_url}/get_requisite"
@@ -55,15 +77,7 @@ class OnlyPaysAPI:
         if trans:
             data["trans"] = True
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays create_order response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays create_order error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("create_order", url, data, personal_id=personal_id)
     
     async def get_order_status(self, order_id: str):
         url = f"{self.base_url}/get_status"
@@ -73,15 +87,7 @@ class OnlyPaysAPI:
             "id": order_id
         }
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays get_status response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays get_status error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("get_status", url, data, onlypays_id=order_id)
     
     async def cancel_order(self, order_id: str):
         url = f"{self.base_url}/cancel_order"
@@ -91,15 +97,7 @@ class OnlyPaysAPI:
             "id": order_id
         }
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays cancel_order response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays cancel_order error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("cancel_order", url, data, onlypays_id=order_id)
     
     async def get_balance(self):
         if not self.payment_key:
@@ -111,15 +109,7 @@ class OnlyPaysAPI:
             "payment_key": self.payment_key
         }
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays get_balance response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays get_balance error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("get_balance", url, data)
     
     async def create_payout(self, payout_type: str, amount: int, requisite: str, bank: str, personal_id: str = None):
         if not self.payment_key:
@@ -138,15 +128,7 @@ class OnlyPaysAPI:
         if personal_id:
             data["personal_id"] = personal_id
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays create_payout response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays create_payout error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("create_payout", url, data, personal_id=personal_id)
     
     async def get_payout_status(self, payout_id: str):
         if not self.payment_key:
@@ -159,211 +141,18 @@ class OnlyPaysAPI:
             "id": payout_id
         }
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays payout_status response: {result}")
-                    return result
-        except Exception as e:
-            logger.error(f"OnlyPays payout_status error: {e}")
-            return {"success": False, "error": str(e)}
+        return await self._post("payout_status", url, data, onlypays_id=payout_id)
 
 onlypays_api = OnlyPaysAPI(
     api_id=config.ONLYPAYS_API_ID,
     secret_key=config.ONLYPAYS_SECRET_KEY,
-    payment_key=getattr(config, 'ONLYPAYS_PAYMENT_KEY', None)
+    payment_key=getattr(config, 'ONLYPAYS_PAYMENT_KEY', None),
+    base_url=config.ONLYPAYS_BASE_URL
 )
 
 
 
 
-async def process_onlypays_webhook(webhook_data: dict):
-    """Обработка webhook от OnlyPays"""
-    try:
-        order_id = webhook_data.get('personal_id')  # Наш внутренний ID заявки
-        onlypays_id = webhook_data.get('id')
-        status = webhook_data.get('status')
-        received_sum = webhook_data.get('received_sum')
-        
-        if not order_id:
-            logger.error(f"Webhook without personal_id: {webhook_data}")
-            return
-        
-        # Получаем заявку из БД
-        order = await db.get_order(int(order_id))
-        if not order:
-            logger.error(f"Order not found: {order_id}")
-            return
-        
-        if status == 'finished':
-            # Заявка оплачена клиентом
-            await db.update_order(
-                order['id'], 
-                status='paid_by_client',
-                received_sum=received_sum
-            )
-            
-            # Уведомляем операторов
-            await notify_operators_paid_order(order, received_sum)
-            
-            # Уведомляем клиента
-            await notify_client_payment_received(order)
-            
-        elif status == 'cancelled':
-            # Заявка отменена
-            await db.update_order(order['id'], status='cancelled')
-            
-            # Можно уведомить клиента об отмене
-            await notify_client_order_cancelled(order)
-            
-    except Exception as e:
-        logger.error(f"Webhook processing error: {e}")
-
-async def notify_operators_paid_order(order: dict, received_sum: float):
-    """Уведомление операторов об оплаченной заявке"""
-    try:
-        display_id = order.get('personal_id', order['id'])
-        
-        text = (
-            f"💰 <b>ЗАЯВКА ОПЛАЧЕНА</b>\n\n"
-            f"🆔 Заявка: #{display_id}\n"
-            f"👤 Клиент: {order.get('user_id', 'N/A')}\n"
-            f"💵 Получено: {received_sum:,.0f} ₽\n"
-            f"💰 Сумма заявки: {order['total_amount']:,.0f} ₽\n"
-            f"₿ К отправке: {order['amount_btc']:.8f} BTC\n"
-            f"📍 Адрес: <code>{order['btc_address']}</code>\n\n"
-            f"⏰ Время: {order['created_at']}\n\n"
-            f"🎯 <b>Требуется отправка Bitcoin!</b>"
-        )
-        
-        # Кнопки для операторов
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(
-                text="✅ Отправил Bitcoin", 
-                callback_data=f"op_sent_{order['id']}"
-            )
-        )
-        builder.row(
-            InlineKeyboardButton(
-                text="⚠️ Проблема", 
-                callback_data=f"op_problem_{order['id']}"
-            ),
-            InlineKeyboardButton(
-                text="📝 Заметка", 
-                callback_data=f"op_note_{order['id']}"
-            )
-        )
-        
-        # Отправляем в операторский чат
-        from main import bot  # Импортируем бот из главного файла
-        await bot.send_message(
-            config.OPERATOR_CHAT_ID,
-            text,
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
-        )
-        
-    except Exception as e:
-        logger.error(f"Notify operators error: {e}")
-
-async def notify_operators_error_order(order: dict, error_message: str):
-    """Уведомление операторов об ошибке в заявке"""
-    try:
-        display_id = order.get('personal_id', order['id'])
-        
-        text = (
-            f"⚠️ <b>ОШИБКА В ЗАЯВКЕ</b>\n\n"
-            f"🆔 Заявка: #{display_id}\n"
-            f"👤 Клиент: {order.get('user_id', 'N/A')}\n"
-            f"💰 Сумма: {order['total_amount']:,.0f} ₽\n"
-            f"❌ Ошибка: {error_message}\n\n"
-            f"⏰ Время: {order['created_at']}\n\n"
-            f"🔧 <b>Требуется вмешательство!</b>"
-        )
-        
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(
-                text="🔧 Обработать", 
-                callback_data=f"op_handle_{order['id']}"
-            ),
-            InlineKeyboardButton(
-                text="❌ Отменить", 
-                callback_data=f"op_cancel_{order['id']}"
-            )
-        )
-        
-        from main import bot
-        await bot.send_message(
-            config.OPERATOR_CHAT_ID,
-            text,
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
-        )
-        
-    except Exception as e:
-        logger.error(f"Notify operators error: {e}")
-
-async def notify_client_payment_received(order: dict):
-    """Уведомление клиента о получении платежа"""
-    try:
-        display_id = order.get('personal_id', order['id'])
-        
-        text = (
-            f"✅ <b>Платеж получен!</b>\n\n"
-            f"🆔 Заявка: #{display_id}\n"
-            f"💰 Сумма: {order['total_amount']:,.0f} ₽\n"
-            f"₿ К получению: {order['amount_btc']:.8f} BTC\n\n"
-            f"🔄 <b>Обрабатываем заявку...</b>\n"
-            f"Bitcoin будет отправлен на ваш адрес в течение 1 часа.\n\n"
-            f"📱 Вы получите уведомление о завершении."
-        )
-        
-        from main import bot
-        await bot.send_message(
-            order['user_id'],
-            text,
-            parse_mode="HTML",
-            reply_markup=ReplyKeyboards.main_menu()
-        )
-        
-    except Exception as e:
-        logger.error(f"Notify client error: {e}")
-
-async def notify_client_order_cancelled(order: dict):
-    """Уведомление клиента об отмене заявки"""
-    try:
-        display_id = order.get('personal_id', order['id'])
-        
-        text = (
-            f"❌ <b>Заявка отменена</b>\n\n"
-            f"🆔 Заявка: #{display_id}\n"
-            f"💰 Сумма: {order['total_amount']:,.0f} ₽\n\n"
-            f"Причина: Превышено время ожидания оплаты\n\n"
-            f"Создайте новую заявку для обмена."
-        )
-        
-        from main import bot
-        await bot.send_message(
-            order['user_id'],
-            text,
-            parse_mode="HTML",
-            reply_markup=ReplyKeyboards.main_menu()
-        )
-        
-    except Exception as e:
-        logger.error(f"Notify client cancelled error: {e}")
-
-
-
-
-
-
-
-
-
 class ExchangeStates(StatesGroup):
     waiting_for_amount = State()
     waiting_for_btc_address = State()
@@ -373,9 +162,25 @@ class ExchangeStates(StatesGroup):
     waiting_for_card_details = State()
     waiting_for_note = State() 
 
-db = Database(config.DATABASE_URL)
+db = create_database(config.DATABASE_URL)
+
+@scheduler.task("main_menu")
+async def send_main_menu_followup(payload: dict):
+    """Отложенная отправка главного меню после экрана заявки"""
+    await outbox.enqueue(
+        payload['chat_id'],
+        "🎯 Главное меню:",
+        reply_markup=ReplyKeyboards.main_menu()
+    )
 
 async def show_main_menu(message_or_callback, is_callback=False):
+    # Блок бонусов только при включенной программе лояльности
+    bonuses = ""
+    if config.LOYALTY_FREE_EVERY > 0:
+        bonuses = (
+            f"🎁 БОНУСЫ\n"
+            f"💎 Каждый {config.LOYALTY_FREE_EVERY} обмен до {config.LOYALTY_FREE_MAX_AMOUNT:,.0f}₽ в боте БЕЗ КОМИССИИ\n\n"
+        )
     default_welcome = (
         f"🎉 Приветствуем вас, дорогие друзья 🎉\n"
         f"💰 {config.EXCHANGE_NAME} 💰\n\n"
@@ -393,8 +198,7 @@ async def show_main_menu(message_or_callback, is_callback=False):
         f"📢 НОВОСТНОЙ КАНАЛ ➖ {config.NEWS_CHANNEL}\n"
         f"📝 КАНАЛ ОТЗЫВЫ ➖ {config.REVIEWS_CHANNEL}\n\n"
         f"━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"🎁 БОНУСЫ\n"
-        f"💎 Каждый 10 обмен до 6000₽ в боте БЕЗ КОМИССИИ\n\n"
+        f"{bonuses}"
         f"Выберите действие в меню:"
     )
     
@@ -409,12 +213,26 @@ async def show_main_menu(message_or_callback, is_callback=False):
     else:
         await message_or_callback.answer(welcome_msg, reply_markup=ReplyKeyboards.main_menu())
 
+def parse_referral_payload(args: Optional[str]) -> Optional[int]:
+    """ID пригласившего из ссылки вида /start r-<id>"""
+    if not args or not args.startswith('r-'):
+        return None
+    referrer = args[2:]
+    return int(referrer) if referrer.isdigit() else None
+
 @router.message(CommandStart())
-async def start_handler(message: Message, state: FSMContext):
+async def start_handler(message: Message, state: FSMContext, command: CommandObject = None):
     await state.clear()
     
-    user = await db.get_user(message.from_user.id)
+    user = await db.get_user(message.from_user.id, fields=('user_id', 'delivery_error'))
+    if user and user['delivery_error']:
+        # Пользователь снова пишет боту - возвращаем его в рассылки
+        await db.clear_delivery_error(message.from_user.id)
     if not user:
+        referral_user_id = parse_referral_payload(command.args if command else None)
+        if referral_user_id == message.from_user.id:
+            referral_user_id = None
+        
         captcha_enabled = await db.get_setting("captcha_enabled", config.CAPTCHA_ENABLED)
         if captcha_enabled:
             image_buffer, answer = CaptchaGenerator.generate_image_captcha()
@@ -431,13 +249,17 @@ async def start_handler(message: Message, state: FSMContext):
                 reply_markup=ReplyKeyboards.back_to_main()
             )
             await state.set_state(ExchangeStates.waiting_for_captcha)
+            if referral_user_id:
+                await state.update_data(referral_user_id=referral_user_id)
             return
         else:
             await db.add_user(
                 message.from_user.id,
                 message.from_user.username,
                 message.from_user.first_name,
-                message.from_user.last_name
+                message.from_user.last_name,
+                referred_by=referral_user_id,
+                signup_bonus=config.REFERRAL_SIGNUP_BONUS
             )
     
     await show_main_menu(message)
@@ -460,26 +282,28 @@ async def captcha_handler(message: Message, state: FSMContext):
     if user_answer == correct_answer:
         await db.delete_captcha_session(message.from_user.id)
         
-        await db.add_user(
+        data = await state.get_data()
+        referral_user_id = data.get('referral_user_id')
+        if referral_user_id == message.from_user.id:
+            referral_user_id = None
+        
+        # Счетчик пригласившего увеличивается в той же транзакции, что и регистрация
+        registered = await db.add_user(
             message.from_user.id,
             message.from_user.username,
             message.from_user.first_name,
-            message.from_user.last_name
+            message.from_user.last_name,
+            referred_by=referral_user_id,
+            signup_bonus=config.REFERRAL_SIGNUP_BONUS
         )
         
-        data = await state.get_data()
-        referral_user_id = data.get('referral_user_id')
-        
-        if referral_user_id and referral_user_id != message.from_user.id:
-            await db.update_user(message.from_user.id, referred_by=referral_user_id)
-            await db.update_referral_count(referral_user_id)
-            
+        if registered and referral_user_id:
+            bonus_line = "\n💰 Вам начислен бонус за приглашение!" if config.REFERRAL_SIGNUP_BONUS > 0 else ""
             try:
                 await message.bot.send_message(
                     referral_user_id,
                     f"🎉 По вашей ссылке зарегистрировался новый пользователь!\n"
-                    f"👤 {message.from_user.first_name}\n"
-                    f"💰 Вам начислен бонус за приглашение!"
+                    f"👤 {message.from_user.first_name}{bonus_line}"
                 )
             except:
                 pass
@@ -718,8 +542,8 @@ async def process_amount_and_show_calculation(callback: CallbackQuery, state: FS
         crypto_amount = amount
         rub_amount = crypto_amount * btc_rate
     
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Новая логика расчета с единой комиссией
+    # Единая комиссия, кроме бесплатных обменов программы лояльности
+    COMMISSION_PERCENT, loyalty_free = await loyalty.commission_for(callback.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     
     await state.update_data(
@@ -738,6 +562,7 @@ async def process_amount_and_show_calculation(callback: CallbackQuery, state: FS
         f"💱 Курс: {btc_rate:,.0f} ₽\n"
         f"💰 Сумма: {rub_amount:,.0f} ₽\n"
         f"₿ Получите: {crypto_amount:.8f} BTC\n\n"
+        f"{loyalty.note if loyalty_free else ''}"
         f"💸 <b>Итого: {total_amount:,.0f} ₽</b>\n\n"
         f"Выберите способ {'оплаты' if direction == 'rub_to_crypto' else 'получения'}:"
     )
@@ -761,8 +586,8 @@ async def process_amount_and_show_calculation_for_message(message: Message, stat
     else:
         crypto_amount = amount
         rub_amount = crypto_amount * btc_rate
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Новая логика расчета с единой комиссией
+    # Единая комиссия, кроме бесплатных обменов программы лояльности
+    COMMISSION_PERCENT, loyalty_free = await loyalty.commission_for(message.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     
     await state.update_data(
@@ -781,6 +606,7 @@ async def process_amount_and_show_calculation_for_message(message: Message, stat
         f"💱 Курс: {btc_rate:,.0f} ₽\n"
         f"💰 Сумма: {rub_amount:,.0f} ₽\n"
         f"₿ Получите: {crypto_amount:.8f} BTC\n\n"
+        f"{loyalty.note if loyalty_free else ''}"
         f"💸 <b>Итого: {total_amount:,.0f} ₽</b>\n\n"
         f"Выберите способ {'оплаты' if direction == 'rub_to_crypto' else 'получения'}:"
     )
@@ -870,8 +696,8 @@ async def btc_address_handler(message: Message, state: FSMContext):
         btc_amount = data['btc_amount']
         rub_amount = btc_amount * btc_rate
     
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Новая логика расчета с единой комиссией
+    # Единая комиссия, кроме бесплатных обменов программы лояльности
+    COMMISSION_PERCENT, loyalty_free = await loyalty.commission_for(message.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     
     text = (
@@ -879,6 +705,7 @@ async def btc_address_handler(message: Message, state: FSMContext):
         f"💱 Курс BTC: {btc_rate:,.0f} ₽\n"
         f"💰 Сумма к обмену: {rub_amount:,.0f} ₽\n"
         f"₿ Получите Bitcoin: {btc_amount:.8f} BTC\n\n"
+        f"{loyalty.note if loyalty_free else ''}"
         f"💸 <b>К оплате: {total_amount:,.0f} ₽</b>\n\n"
         f"₿ Bitcoin адрес:\n<code>{btc_address}</code>\n\n"
         f"Выберите способ оплаты:"
@@ -923,16 +750,28 @@ async def address_input_handler(message: Message, state: FSMContext):
 
 async def create_exchange_order(user_id: int, state: FSMContext) -> int:
     data = await state.get_data()
+    # Комиссия фиксируется при создании: бесплатный обмен резервируется за заявкой,
+    # итог пересчитывается, чтобы подтверждение совпало с резервом
+    rub_amount = data["rub_amount"]
+    COMMISSION_PERCENT, loyalty_free = await loyalty.reserve(user_id, rub_amount)
+    total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
+    await state.update_data(total_amount=total_amount, loyalty_free=loyalty_free)
     
-    order_id = await db.create_order(
-        user_id=user_id,
-        amount_rub=data["rub_amount"],
-        amount_btc=data["crypto_amount"],
-        btc_address=data["address"],
-        rate=data["rate"],
-        total_amount=data["total_amount"],
-        payment_type=data["payment_type"]
-    )
+    try:
+        order_id = await db.create_order(
+            user_id=user_id,
+            amount_rub=rub_amount,
+            amount_btc=data["crypto_amount"],
+            btc_address=data["address"],
+            rate=data["rate"],
+            total_amount=total_amount,
+            payment_type=data["payment_type"],
+            loyalty_free=loyalty_free
+        )
+    except Exception:
+        if loyalty_free:
+            await loyalty.release(user_id)
+        raise
     
     return order_id
 
@@ -952,6 +791,7 @@ async def show_order_confirmation(message: Message, state: FSMContext, order_id:
         f"📋 <b>{operation_text} Bitcoin</b>\n"
         f"💰 Сумма: {data['rub_amount']:,.0f} ₽\n"
         f"₿ Количество: {data['crypto_amount']:.8f} BTC\n"
+        f"{loyalty.note if data.get('loyalty_free') else ''}"
         f"💸 К {'оплате' if data['direction'] == 'rub_to_crypto' else 'получению'}: {data['total_amount']:,.0f} ₽\n\n"
         f"📝 Адрес/Реквизиты:\n<code>{data['address']}</code>\n\n"
         f"Подтвердите создание заявки:"
@@ -982,6 +822,10 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
             await callback.message.edit_text("❌ Заявка не найдена")
             return
         
+        if order['status'] != 'waiting':
+            await callback.message.edit_text("❌ Заявка уже обработана или отменена")
+            return
+        
         # Используем personal_id для отображения
         display_id = order.get('personal_id', order_id)
         
@@ -998,12 +842,7 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
                     "Попробуйте позже или обратитесь в поддержку."
                 )
                 
-                await asyncio.sleep(3)
-                await callback.bot.send_message(
-                    callback.message.chat.id,
-                    "🎯 Главное меню:",
-                    reply_markup=ReplyKeyboards.main_menu()
-                )
+                await scheduler.schedule(3, "main_menu", {"chat_id": callback.message.chat.id})
                 return
             
             payment_data = api_response['data']
@@ -1026,7 +865,6 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
                 order_id,
                 onlypays_id=api_response['data']['id'],
                 requisites=requisites_text,
-                status='waiting',
                 personal_id=api_response['data']['id']  # Добавляем эту строку
             )
             
@@ -1048,19 +886,20 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
                 f"Время обработки: 5-15 минут."
             )
     else:
-        await db.update_order(order_id, status='cancelled')
-        order = await db.get_order(order_id)
-        display_id = order.get('personal_id', order_id) if order else order_id
-        text = f"❌ Заявка #{display_id} отменена."
+        order = await order_sm.transition(
+            order_id, 'cancelled', from_statuses=('waiting',), actor='client'
+        )
+        if order:
+            display_id = order.get('personal_id', order_id)
+            text = f"❌ Заявка #{display_id} отменена."
+        else:
+            order = await db.get_order(order_id)
+            display_id = order.get('personal_id', order_id) if order else order_id
+            text = f"❌ Заявку #{display_id} уже нельзя отменить."
     
     await callback.message.edit_text(text, parse_mode="HTML")
     
-    await asyncio.sleep(3)
-    await callback.bot.send_message(
-        callback.message.chat.id,
-        "🎯 Главное меню:",
-        reply_markup=ReplyKeyboards.main_menu()
-    )
+    await scheduler.schedule(3, "main_menu", {"chat_id": callback.message.chat.id})
 
 
 
@@ -1068,23 +907,30 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
 async def payment_method_handler(message: Message, state: FSMContext):
     payment_type = "card" if "карта" in message.text else "sbp"
     data = await state.get_data()
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    # Пересчитываем total_amount с учетом единой комиссии
+    # Пересчитываем total_amount; бесплатный обмен резервируется за этой заявкой,
+    # пока она открыта, следующий расчет идет с обычной комиссией
     rub_amount = data['rub_amount']
+    COMMISSION_PERCENT, loyalty_free = await loyalty.reserve(message.from_user.id, rub_amount)
     total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     btc_amount = data['btc_amount']
     btc_rate = data['btc_rate']
     
     # Создаем заявку без processing_fee и admin_fee
-    order_id = await db.create_order(
-        user_id=message.from_user.id,
-        amount_rub=rub_amount,
-        amount_btc=btc_amount,
-        btc_address=data.get('btc_address', data.get('address', '')),
-        rate=btc_rate,
-        total_amount=total_amount,
-        payment_type=payment_type
-    )
+    try:
+        order_id = await db.create_order(
+            user_id=message.from_user.id,
+            amount_rub=rub_amount,
+            amount_btc=btc_amount,
+            btc_address=data.get('btc_address', data.get('address', '')),
+            rate=btc_rate,
+            total_amount=total_amount,
+            payment_type=payment_type,
+            loyalty_free=loyalty_free
+        )
+    except Exception:
+        if loyalty_free:
+            await loyalty.release(message.from_user.id)
+        raise
     
     api_response = await onlypays_api.create_order(
         amount=int(total_amount),
@@ -1093,6 +939,11 @@ async def payment_method_handler(message: Message, state: FSMContext):
     )
     
     if not api_response.get('success'):
+        # Без реквизитов заявку не оплатить: закрываем ее, резерв бесплатного обмена возвращается
+        await order_sm.transition(
+            order_id, 'cancelled', from_statuses=('waiting',), actor='system',
+            details={'reason': 'onlypays_create_failed', 'error': api_response.get('error')}
+        )
         await message.answer(
             f"❌ Ошибка создания заявки: {api_response.get('error', 'Неизвестная ошибка')}\n\n"
             "Попробуйте позже или обратитесь в поддержку.",
@@ -1178,7 +1029,7 @@ async def check_status_handler(message: Message):
                     'status': 'finished',
                     'personal_id': str(order['id']),
                     'received_sum': status_data.get('received_sum', order['total_amount'])
-                }, message.bot)  # Добавляем bot как параметр
+                })
                 
                 await message.answer(
                     f"✅ <b>Заявка #{order.get('personal_id', order['id'])} оплачена!</b>\n\n"
@@ -1188,7 +1039,10 @@ async def check_status_handler(message: Message):
                     parse_mode="HTML"
                 )
             elif status_data['status'] == 'cancelled':
-                await db.update_order(order['id'], status='cancelled')
+                await order_sm.transition(
+                    order['id'], 'cancelled', from_statuses=('waiting',),
+                    actor='client'
+                )
                 await message.answer(
                     f"❌ Заявка #{order.get('personal_id', order['id'])} отменена.\n\n"
                     f"Создайте новую заявку для обмена.",
@@ -1241,7 +1095,10 @@ async def confirm_cancel_order_handler(message: Message):
             api_response = await onlypays_api.cancel_order(order['onlypays_id'])
             
             if api_response.get('success'):
-                await db.update_order(order['id'], status='cancelled')
+                await order_sm.transition(
+                    order['id'], 'cancelled', from_statuses=('waiting',),
+                    actor='client'
+                )
                 await message.answer(
                     f"❌ Заявка #{display_id} отменена.\n\n"  # Используем display_id
                     "Создайте новую заявку для обмена.",
@@ -1323,7 +1180,8 @@ async def how_to_exchange_handler(message: Message):
 @router.message(F.text == "Друзья")
 async def referral_handler(message: Message):
     try:
-        user = await db.get_user(message.from_user.id)
+        referral_fields = ('user_id', 'referral_count', 'referral_balance')
+        user = await db.get_user(message.from_user.id, fields=referral_fields)
         if not user:
             # Если пользователь не найден, создаем его
             await db.add_user(
@@ -1332,7 +1190,7 @@ async def referral_handler(message: Message):
                 message.from_user.first_name,
                 message.from_user.last_name
             )
-            user = await db.get_user(message.from_user.id)
+            user = await db.get_user(message.from_user.id, fields=referral_fields)
         
         if not user:
             await message.answer(
@@ -1342,29 +1200,31 @@ async def referral_handler(message: Message):
             )
             return
         
-        # Получаем статистику рефералов
-        try:
-            stats = await db.get_referral_stats(message.from_user.id)
-        except:
-            # Если метод не работает, создаем базовую статистику
-            stats = {
-                'referral_count': 0,
-                'referral_balance': 0
-            }
+        # Счетчики хранятся в строке пользователя, отдельный запрос не нужен
+        stats = {
+            'referral_count': user.get('referral_count') or 0,
+            'referral_balance': user.get('referral_balance') or 0
+        }
+        
+        # Выплаты включаются в конфигурации; нулевые условия не показываем
+        bonuses = ""
+        if config.REFERRAL_SIGNUP_BONUS > 0:
+            bonuses += f"• За каждого друга: {config.REFERRAL_SIGNUP_BONUS:g} ₽\n"
+        if config.REFERRAL_PERCENT > 0:
+            bonuses += f"• От каждой сделки друга: {config.REFERRAL_PERCENT:g}%\n"
+        if bonuses:
+            bonuses = f"🎁 <b>Ваши бонусы:</b>\n{bonuses}\n"
+        promise = "\nКогда они зарегистрируются и сделают обмен, вы получите бонусы!" if bonuses else ""
         
         text = (
             f"👥 <b>Реферальная программа</b>\n\n"
-            f"🎁 <b>Ваши бонусы:</b>\n"
-            f"• За каждого друга: 100 ₽\n"
-            f"• От каждой сделки друга: 2%\n\n"
+            f"{bonuses}"
             f"📊 <b>Ваша статистика:</b>\n"
             f"👤 Приглашено друзей: {stats['referral_count']} чел.\n"
             f"💰 Заработано бонусов: {stats['referral_balance']} ₽\n\n"
             f"🔗 <b>Ваша реферальная ссылка:</b>\n"
             f"<code>https://t.me/{config.BOT_USERNAME}?start=r-{message.from_user.id}</code>\n\n"
-            f"📤 <b>Отправьте эту ссылку друзьям!</b>\n"
-            f"Когда они зарегистрируются и сделают обмен, "
-            f"вы получите бонусы!"
+            f"📤 <b>Отправьте эту ссылку друзьям!</b>{promise}"
         )
         
         from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -1377,6 +1237,12 @@ async def referral_handler(message: Message):
                 url=f"https://t.me/share/url?url=https://t.me/{config.BOT_USERNAME}?start=r-{message.from_user.id}&text=Присоединяйся к лучшему криптообменнику {config.EXCHANGE_NAME}!"
             )
         )
+        builder.row(
+            InlineKeyboardButton(
+                text="📜 История бонусов", 
+                callback_data="referral_history"
+            )
+        )
         builder.row(
             InlineKeyboardButton(
                 text="🏠 Главная", 
@@ -1404,7 +1270,27 @@ async def referral_handler(message: Message):
 
 @router.callback_query(F.data == "referral_history")
 async def referral_history_handler(callback: CallbackQuery):
-    await callback.answer("История бонусов пока пуста")
+    user_id = callback.from_user.id
+    ledger = await db.get_referral_ledger(user_id, limit=15)
+    levels = await db.get_referral_levels(user_id, config.REFERRAL_TREE_DEPTH)
+    
+    if not ledger and not levels:
+        await callback.answer("История бонусов пока пуста")
+        return
+    
+    text = "📜 <b>История бонусов</b>\n\n"
+    if levels:
+        text += "👥 <b>Ваша сеть:</b>\n"
+        for depth, count in levels.items():
+            text += f"• {depth}-й уровень: {count} чел.\n"
+        text += "\n"
+    
+    for entry in ledger:
+        created = str(entry['created_at'])[:16]
+        text += f"{created} | {entry['amount']:+.2f} ₽ | {entry['description'] or entry['kind']}\n"
+    
+    await callback.message.answer(text, parse_mode="HTML")
+    await callback.answer()
 
 @router.callback_query(F.data == "referral_main_menu")
 async def referral_main_menu_handler(callback: CallbackQuery):
@@ -1541,7 +1427,6 @@ async def contact_handler(message: Message, state: FSMContext):
             )
             return
         
-        user = await db.get_user(user_id)
         review_text = (
             f"📝 <b>Новый отзыв</b>\n\n"
             f"📅 {current_time.strftime('%d.%m.%Y %H:%M')}\n\n"
@@ -1597,35 +1482,17 @@ async def operator_sent_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     
     try:
-        # Обновляем статус заявки
-        await db.update_order(order_id, status='completed')
-        
-        # Получаем заявку
-        order = await db.get_order(order_id)
+        # Обновляем статус заявки, клиента уведомляет подписчик машины состояний
+        order = await order_sm.transition(
+            order_id, 'completed',
+            actor=f"operator:{callback.from_user.id}"
+        )
         if not order:
-            await callback.answer("Заявка не найдена")
+            await callback.answer("Заявка не найдена или уже обработана", show_alert=True)
             return
         
         display_id = order.get('personal_id', order_id)
         
-        # Уведомляем клиента о завершении
-        text_client = (
-            f"🎉 <b>Заявка завершена!</b>\n\n"
-            f"🆔 Заявка: #{display_id}\n"
-            f"₿ Отправлено: {order['amount_btc']:.8f} BTC\n"
-            f"📍 На адрес: <code>{order['btc_address']}</code>\n\n"
-            f"✅ <b>Bitcoin успешно отправлен!</b>\n"
-            f"Проверьте ваш кошелек.\n\n"
-            f"Спасибо за использование {config.EXCHANGE_NAME}!"
-        )
-        
-        await callback.bot.send_message(
-            order['user_id'],
-            text_client,
-            parse_mode="HTML",
-            reply_markup=ReplyKeyboards.main_menu()
-        )
-        
         # Обновляем сообщение оператора
         await callback.message.edit_text(
             f"✅ <b>ЗАЯВКА ЗАВЕРШЕНА</b>\n\n"
@@ -1649,10 +1516,15 @@ async def operator_problem_handler(callback: CallbackQuery):
     
     try:
         # Обновляем статус заявки
-        await db.update_order(order_id, status='problem')
+        order = await order_sm.transition(
+            order_id, 'problem',
+            actor=f"operator:{callback.from_user.id}"
+        )
+        if not order:
+            await callback.answer("Заявка не найдена или уже обработана", show_alert=True)
+            return
         
-        order = await db.get_order(order_id)
-        display_id = order.get('personal_id', order_id) if order else order_id
+        display_id = order.get('personal_id', order_id)
         
         # Уведомляем в админский чат
         admin_text = (
@@ -1663,11 +1535,7 @@ async def operator_problem_handler(callback: CallbackQuery):
             f"❗ Требуется вмешательство администратора"
         )
         
-        await callback.bot.send_message(
-            config.ADMIN_CHAT_ID,
-            admin_text,
-            parse_mode="HTML"
-        )
+        await outbox.enqueue(config.ADMIN_CHAT_ID, admin_text)
         
         await callback.answer("⚠️ Заявка отмечена как проблемная")
         
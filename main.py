@@ -7,11 +7,24 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from config import config
-from database.models import Database
+from database.storage import close_databases, create_database
+from database.profiler import profiler
+from database.order_cache import order_cache
 from handlers import user, admin, operator, calculator
+from handlers.admin import schedule_maintenance
+from handlers.operator import outbox, scheduler
 from middlewares.chat_type import PrivateChatMiddleware
+from middlewares.metrics import HandlerMetricsMiddleware, UpdateMetricsMiddleware
+from utils.logging_setup import setup_logging
+from utils.metrics import metrics_handler, start_metrics_server
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging(
+    log_dir=config.LOG_DIR,
+    level=config.LOG_LEVEL,
+    max_bytes=config.LOG_MAX_BYTES,
+    backup_count=config.LOG_BACKUP_COUNT,
+    json_format=config.LOG_JSON
+)
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -22,20 +35,34 @@ dp.include_router(user.router)
 dp.include_router(operator.router)
 dp.include_router(calculator.router)
 
+dp.update.outer_middleware(UpdateMetricsMiddleware())
 dp.message.middleware(PrivateChatMiddleware())
 dp.callback_query.middleware(PrivateChatMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
 
 async def init_database():
-    db = Database(config.DATABASE_URL)
+    profiler.enabled = config.DB_PROFILE
+    profiler.slow_threshold = config.DB_SLOW_QUERY_MS / 1000
+    order_cache.max_users = config.ORDER_CACHE_USERS
+    order_cache.depth = config.ORDER_CACHE_DEPTH
+    db = create_database(config.DATABASE_URL)
+    order_cache.ttl = config.ORDER_CACHE_SHARED_TTL if db.shared else config.ORDER_CACHE_TTL
     await db.init_db()
     logger.info("Database initialized")
 
 async def on_startup():
     await init_database()
+    outbox.start(bot)
+    await scheduler.start()
+    await schedule_maintenance()
     await bot.set_webhook(url=config.WEBHOOK_URL + config.WEBHOOK_PATH, drop_pending_updates=True)
     logger.info("Webhook set successfully")
 
 async def on_shutdown():
+    await scheduler.stop()
+    await outbox.stop()
+    await close_databases(config.DATABASE_URL)
     await bot.delete_webhook()
     logger.info("Webhook deleted")
 
@@ -44,19 +71,31 @@ def create_app() -> web.Application:
     webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
     webhook_requests_handler.register(app, path=config.WEBHOOK_PATH)
     setup_application(app, dp, bot=bot)
+    app.router.add_get("/metrics", metrics_handler)
     return app
 
 
 
 async def run_polling():
     logger.info("Starting bot in polling mode")
+    metrics_runner = None
     try:
         await init_database()
+        if config.METRICS_PORT:
+            metrics_runner = await start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+        outbox.start(bot)
+        await scheduler.start()
+        await schedule_maintenance()
         await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot)
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     finally:
+        await scheduler.stop()
+        await outbox.stop()
+        await close_databases(config.DATABASE_URL)
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await bot.session.close()
 
 async def main():
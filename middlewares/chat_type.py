@@ -28,8 +28,8 @@ class PrivateChatMiddleware(BaseMiddleware):
         if user_id in super_admins:
             return await handler(event, data)
         
-        from database.models import Database
-        db = Database(config.DATABASE_URL)
+        from database.storage import create_database
+        db = create_database(config.DATABASE_URL)
         
         try:
             admin_users = await db.get_setting("admin_users", [])
@@ -47,7 +47,8 @@ class PrivateChatMiddleware(BaseMiddleware):
             "/setup_admin_chat", "/set_percentage", "/toggle_captcha",
             "/user_info", "/block_user", "/unblock_user", "/search_user",
             "/recent_users", "/user_stats", "/send_message", "/check_captcha",
-            "/recent_orders", "/pending_orders", "/order_info", 
+            "/recent_orders", "/pending_orders", "/order_info", "/orders", "/search", "/db_profile",
+            "/rebuild_referrals", "/rebuild_totals", "/referral_top", "/backup", "/export",
             "/complete_order", "/cancel_order", "/set_limits", "/set_welcome"
         ]
         
@@ -0,0 +1,59 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from utils.metrics import (
+    HANDLER_ERRORS,
+    HANDLER_SECONDS,
+    HANDLERS_IN_FLIGHT,
+    UPDATE_SECONDS,
+    UPDATES_TOTAL,
+)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейтов: количество и полное время обработки по типу события"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        event_type = event.event_type
+        UPDATES_TOTAL.inc(event_type=event_type)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, event_type=event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: выбранный обработчик известен только здесь"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        callback = getattr(handler_object, 'callback', None)
+        labels = {
+            'router': getattr(callback, '__module__', 'unknown'),
+            'handler': getattr(callback, '__name__', 'unknown'),
+        }
+        
+        HANDLERS_IN_FLIGHT.inc(**labels)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(**labels)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, **labels)
+            HANDLERS_IN_FLIGHT.dec(**labels)
@@ -0,0 +1,281 @@
+# tests/test_sqlite.py
+"""Проверки хранилища SQLite: миграции, смена статусов, очередь уведомлений,
+кэш заявок и программа лояльности.
+
+Каждый тест работает со своей базой во временном каталоге.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+from database.migrations import LATEST_VERSION, LOYALTY_EVERY, get_version, migrate
+from database.models import Database
+from database.order_cache import order_cache
+from database.order_state import OrderStateMachine
+from utils.loyalty import LoyaltyProgram
+from utils.notifications import NotificationOutbox
+
+
+class SQLiteTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.directory.name, 'bot.db'))
+        await self.db.init_db()
+        self._user_ids = iter(range(1000, 2000))
+
+    async def asyncTearDown(self):
+        order_cache.invalidate(self.db.db_path)
+        self.directory.cleanup()
+
+    async def create_user(self, **fields) -> int:
+        user_id = next(self._user_ids)
+        self.assertTrue(await self.db.add_user(user_id, f'user{user_id}', f'User{user_id}'))
+        if fields:
+            await self.db.update_user(user_id, **fields)
+        return user_id
+
+    async def create_order(self, user_id: int, total_amount: float = 6250, loyalty_free: bool = False,
+                           btc_address: str = 'bc1qtest') -> int:
+        return await self.db.create_order(
+            user_id, 5000, 0.0008, btc_address, 6500000, total_amount, 'card', loyalty_free=loyalty_free
+        )
+
+    async def execute(self, query: str, *args):
+        async with self.db.connect() as db:
+            await db.execute(query, args)
+            await db.commit()
+
+    async def make_archivable(self, order_ids):
+        for order_id in order_ids:
+            await self.db.transition_order_status(order_id, ['waiting'], 'completed')
+        placeholders = ', '.join('?' for _ in order_ids)
+        await self.execute(
+            f"UPDATE orders SET created_at = datetime('now', '-400 days') WHERE id IN ({placeholders})",
+            *order_ids
+        )
+
+
+class MigrationTests(SQLiteTestCase):
+    async def test_new_database_is_latest(self):
+        async with self.db.connect() as db:
+            self.assertEqual(await get_version(db), LATEST_VERSION)
+            self.assertEqual(await migrate(db), (LATEST_VERSION, LATEST_VERSION))
+            for table, column in (('orders', 'loyalty_free'), ('orders', 'received_sum'),
+                                  ('users', 'loyalty_free_used'), ('users', 'last_order_at'),
+                                  ('users', 'delivery_error')):
+                async with db.execute(f'PRAGMA table_info({table})') as cursor:
+                    columns = {row[1] for row in await cursor.fetchall()}
+                self.assertIn(column, columns, f'{table}.{column}')
+
+    async def test_loyalty_backfill_counts_completed_orders(self):
+        user_id = await self.create_user()
+        order_ids = [await self.create_order(user_id) for _ in range(LOYALTY_EVERY + 2)]
+        for order_id in order_ids:
+            await self.db.transition_order_status(order_id, ['waiting'], 'completed')
+        # Счетчик total_operations раньше не велся
+        await self.execute('UPDATE users SET total_operations = 0, loyalty_free_used = 0')
+        await self.execute(f'PRAGMA user_version = {LATEST_VERSION - 1}')
+        
+        await self.db.init_db()
+        user = await self.db.get_user(user_id, fields=('loyalty_free_used',))
+        self.assertEqual(user['loyalty_free_used'], (LOYALTY_EVERY + 2) // LOYALTY_EVERY)
+
+    async def test_rebuild_user_totals_includes_archive(self):
+        user_id = await self.create_user()
+        order_ids = [await self.create_order(user_id, total_amount=1000) for _ in range(4)]
+        await self.make_archivable(order_ids[:3])
+        await self.db.transition_order_status(order_ids[3], ['waiting'], 'cancelled')
+        self.assertEqual(await self.db.archive_orders(retention_days=30, pause=0), 3)
+        await self.execute('UPDATE users SET total_operations = 0, total_amount = 0')
+        
+        await self.db.rebuild_user_totals(pause=0)
+        user = await self.db.get_user(user_id, fields=('total_operations', 'total_amount'))
+        self.assertEqual(user['total_operations'], 3)
+        self.assertEqual(user['total_amount'], 3000)
+
+
+class TransitionTests(SQLiteTestCase):
+    async def test_concurrent_transitions_apply_once(self):
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id)
+        
+        results = await asyncio.gather(
+            self.db.transition_order_status(order_id, ['waiting'], 'paid_by_client', actor='onlypays'),
+            self.db.transition_order_status(order_id, ['waiting'], 'cancelled', actor='onlypays'),
+            self.db.transition_order_status(order_id, ['waiting'], 'paid_by_client', actor='onlypays'),
+        )
+        applied = [result for result in results if result]
+        self.assertEqual(len(applied), 1)
+        
+        order, from_status = applied[0]
+        self.assertEqual(from_status, 'waiting')
+        events = await self.db.get_order_events(order_id)
+        self.assertEqual([event['to_status'] for event in events], [order['status']])
+
+    async def test_completion_updates_user_totals(self):
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id, total_amount=6250)
+        
+        result = await self.db.transition_order_status(order_id, ['waiting'], 'completed', actor='operator:1')
+        self.assertIsNotNone(result)
+        self.assertIsNotNone(result[0]['completed_at'])
+        self.assertIsNone(await self.db.transition_order_status(order_id, ['waiting'], 'completed'))
+        
+        user = await self.db.get_user(user_id, fields=('total_operations', 'total_amount'))
+        self.assertEqual(user['total_operations'], 1)
+        self.assertEqual(user['total_amount'], 6250)
+
+    async def test_state_machine_checks_transitions(self):
+        state_machine = OrderStateMachine(self.db)
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id)
+        
+        with self.assertRaises(ValueError):
+            await state_machine.transition(order_id, 'waiting')
+        self.assertIsNone(await state_machine.transition(order_id, 'completed', from_statuses=['paid_by_client']))
+        
+        order = await state_machine.transition(order_id, 'paid_by_client', actor='onlypays')
+        self.assertEqual(order['status'], 'paid_by_client')
+        self.assertIsNone(await state_machine.transition(order_id, 'paid_by_client'))
+        order = await state_machine.transition(order_id, 'completed', actor='operator:1')
+        self.assertEqual(order['status'], 'completed')
+
+
+class OutboxTests(SQLiteTestCase):
+    async def test_concurrent_claims_are_disjoint(self):
+        ids = {await self.db.enqueue_notification(1, f'message {n}') for n in range(20)}
+        
+        batches = await asyncio.gather(*(self.db.get_due_notifications(limit=8) for _ in range(4)))
+        claimed = [row['id'] for batch in batches for row in batch]
+        self.assertEqual(len(claimed), len(set(claimed)))
+        self.assertTrue(set(claimed) <= ids)
+        
+        # Выданные строки отложены на время аренды
+        rest = await self.db.get_due_notifications(limit=50)
+        self.assertEqual(set(claimed) | {row['id'] for row in rest}, ids)
+        self.assertEqual(await self.db.get_due_notifications(limit=50), [])
+
+    async def test_transition_enqueues_notifications(self):
+        outbox = NotificationOutbox(self.db)
+        state_machine = OrderStateMachine(self.db, outbox)
+
+        @state_machine.notify('paid_by_client')
+        async def notify_client(event):
+            await outbox.enqueue(event.order['user_id'], f"paid {event.order['id']} from {event.from_status}")
+        
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id)
+        await state_machine.transition(order_id, 'paid_by_client')
+        # Отклоненный переход уведомлений не ставит
+        await state_machine.transition(order_id, 'paid_by_client')
+        
+        notifications = await self.db.get_due_notifications(limit=50)
+        self.assertEqual([(row['chat_id'], row['text']) for row in notifications],
+                         [(user_id, f'paid {order_id} from waiting')])
+
+    async def test_failing_notifier_keeps_transition(self):
+        outbox = NotificationOutbox(self.db)
+        state_machine = OrderStateMachine(self.db, outbox)
+
+        @state_machine.notify('cancelled')
+        async def broken(event):
+            raise RuntimeError('broken template')
+        
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id)
+        order = await state_machine.transition(order_id, 'cancelled')
+        self.assertEqual(order['status'], 'cancelled')
+        self.assertEqual(await self.db.get_due_notifications(limit=50), [])
+
+
+class OrderCacheTests(SQLiteTestCase):
+    async def test_transition_updates_cached_history(self):
+        user_id = await self.create_user()
+        order_id = await self.create_order(user_id)
+        self.assertEqual([order['status'] for order in await self.db.get_user_orders(user_id)], ['waiting'])
+        self.assertTrue(order_cache.has(self.db.db_path, user_id))
+        
+        await self.db.transition_order_status(order_id, ['waiting'], 'paid_by_client')
+        self.assertTrue(order_cache.has(self.db.db_path, user_id))
+        self.assertEqual([order['status'] for order in await self.db.get_user_orders(user_id)], ['paid_by_client'])
+        
+        second_id = await self.create_order(user_id)
+        self.assertEqual([order['id'] for order in await self.db.get_user_orders(user_id)], [second_id, order_id])
+
+    async def test_read_overlapping_change_is_not_cached(self):
+        user_id = await self.create_user()
+        await self.create_order(user_id)
+        generation = order_cache.generation()
+        orders = await self.db.get_user_orders(user_id)
+        order_cache.invalidate(self.db.db_path, user_id)
+        
+        order_cache.put(self.db.db_path, user_id, orders, complete=True, generation=generation)
+        self.assertFalse(order_cache.has(self.db.db_path, user_id))
+
+    async def test_zero_ttl_disables_cache(self):
+        user_id = await self.create_user()
+        await self.create_order(user_id)
+        ttl = order_cache.ttl
+        order_cache.ttl = 0
+        try:
+            self.assertEqual(len(await self.db.get_user_orders(user_id)), 1)
+            self.assertFalse(order_cache.has(self.db.db_path, user_id))
+        finally:
+            order_cache.ttl = ttl
+
+
+class LoyaltyTests(SQLiteTestCase):
+    async def test_free_exchange_reserved_once_and_released_on_cancel(self):
+        user_id = await self.create_user(total_operations=9)
+        
+        reserved = await asyncio.gather(*(self.db.reserve_free_exchange(user_id, 10) for _ in range(3)))
+        self.assertEqual(sorted(reserved), [False, False, True])
+        
+        order_id = await self.create_order(user_id, loyalty_free=True)
+        await self.db.transition_order_status(order_id, ['waiting'], 'cancelled')
+        user = await self.db.get_user(user_id, fields=('loyalty_free_used',))
+        self.assertEqual(user['loyalty_free_used'], 0)
+        self.assertTrue(await self.db.reserve_free_exchange(user_id, 10))
+
+    async def test_reserve_and_release(self):
+        loyalty = LoyaltyProgram(self.db, every=10, max_amount=6000)
+        commission = await self.db.get_commission_percentage()
+        user_id = await self.create_user(total_operations=9)
+        
+        self.assertEqual(await loyalty.reserve(user_id, 7000), (commission, False))
+        self.assertEqual(await loyalty.reserve(user_id, 5000), (0.0, True))
+        self.assertEqual(await loyalty.reserve(user_id, 5000), (commission, False))
+        self.assertFalse(await loyalty.next_is_free(user_id))
+        
+        # Заявку создать не удалось: резерв возвращается
+        await loyalty.release(user_id)
+        self.assertTrue(await loyalty.next_is_free(user_id))
+        self.assertEqual(await loyalty.reserve(user_id, 5000), (0.0, True))
+
+    async def test_disabled_program(self):
+        loyalty = LoyaltyProgram(self.db, every=0)
+        user_id = await self.create_user(total_operations=9)
+        
+        self.assertFalse((await loyalty.reserve(user_id, 1000))[1])
+        self.assertFalse(await loyalty.next_is_free(user_id))
+        self.assertEqual(loyalty.note, '')
+
+
+class ArchiveTests(SQLiteTestCase):
+    async def test_search_includes_archive(self):
+        user_id = await self.create_user()
+        order_ids = [await self.create_order(user_id, btc_address=f'bc1qsearch{n}') for n in range(3)]
+        await self.make_archivable(order_ids[:2])
+        self.assertEqual(await self.db.archive_orders(retention_days=30, pause=0), 2)
+        
+        found = await self.db.search_orders('bc1qsearch')
+        self.assertEqual(sorted((row['id'], row['archived']) for row in found),
+                         [(order_ids[0], 1), (order_ids[1], 1), (order_ids[2], 0)])
+        self.assertEqual([row['id'] for row in await self.db.search_orders('bc1qsearch1')], [order_ids[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# utils/backup.py
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+SUFFIX = '.db.gz'
+# Снимок архива лежит рядом со снимком рабочей базы: <база>-<время>.archive.db.gz
+ARCHIVE_SUFFIX = '.archive' + SUFFIX
+
+# Один снимок за раз: ручной /backup и плановая задача не должны копировать базу параллельно
+_lock = asyncio.Lock()
+
+
+def snapshot_prefix(db_path: str) -> str:
+    return os.path.splitext(os.path.basename(db_path))[0] + '-'
+
+
+def snapshot_set(name: str) -> str:
+    """Имя набора (база и время), к которому относится файл снимка"""
+    return name.split('.', 1)[0]
+
+
+def list_backups(directory: str, db_path: str) -> List[Tuple[str, int]]:
+    """Файлы снимков (имя, размер) от старых к новым; время создания зашито в имя"""
+    if not os.path.isdir(directory):
+        return []
+    prefix = snapshot_prefix(db_path)
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefix) and entry.name.endswith(SUFFIX) and entry.is_file():
+                files.append((entry.name, entry.stat().st_size))
+    return sorted(files)
+
+
+def list_backup_sets(directory: str, db_path: str) -> List[Tuple[str, List[Tuple[str, int]]]]:
+    """Наборы снимков (имя набора, файлы) от старых к новым: рабочая база и архив одного момента"""
+    sets = {}
+    for name, size in list_backups(directory, db_path):
+        sets.setdefault(snapshot_set(name), []).append((name, size))
+    # В наборе сначала рабочая база, потом архив
+    return [(key, sorted(files, key=lambda file: file[0].endswith(ARCHIVE_SUFFIX)))
+            for key, files in sorted(sets.items())]
+
+
+def rotate_backups(directory: str, db_path: str, keep: int) -> List[str]:
+    """Удаляет самые старые наборы снимков сверх keep, возвращает удаленные имена файлов"""
+    removed = []
+    sets = list_backup_sets(directory, db_path)
+    for _, files in sets[:max(len(sets) - keep, 0)]:
+        for name, _ in files:
+            os.remove(os.path.join(directory, name))
+            removed.append(name)
+    return removed
+
+
+def gzip_file(source: str, target: str):
+    """Потоковое сжатие блоками, без чтения снимка в память"""
+    with open(source, 'rb') as src, gzip.open(target, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
+
+
+async def create_backup(db, directory: str, keep: int = 7, pages: int = 1000, sleep: float = 0.05) -> List[str]:
+    """Онлайн-снимок базы db (Database) и ее архива в directory: backup API, gzip, ротация.
+    
+    Копирование идет порциями по pages страниц в потоке aiosqlite с паузой
+    sleep между порциями, сжатие и ротация - в отдельном потоке, так что
+    цикл событий и запись в базу не блокируются. Оба файла получают одно
+    время в имени и ротируются вместе. Возвращает пути к .db.gz: база, архив.
+    """
+    async with _lock:
+        os.makedirs(directory, exist_ok=True)
+        name = snapshot_prefix(db.db_path) + datetime.now().strftime('%Y%m%d-%H%M%S')
+        paths = [os.path.join(directory, name + SUFFIX), os.path.join(directory, name + ARCHIVE_SUFFIX)]
+        raw_paths = [path[:-len('.gz')] + '.part' for path in paths]
+        
+        try:
+            await db.backup_to(raw_paths[0], pages=pages, sleep=sleep, archive_target_path=raw_paths[1])
+            for raw_path, path in zip(raw_paths, paths):
+                await asyncio.to_thread(gzip_file, raw_path, path + '.part')
+            for path in paths:
+                os.replace(path + '.part', path)
+        finally:
+            for leftover in raw_paths + [path + '.part' for path in paths]:
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        
+        removed = await asyncio.to_thread(rotate_backups, directory, db.db_path, keep)
+        logger.info(
+            f"Database backup created: {', '.join(f'{path} ({os.path.getsize(path)} bytes)' for path in paths)}, "
+            f"rotated {len(removed)}"
+        )
+        return paths
@@ -2,6 +2,8 @@
 import aiohttp
 import logging
 from typing import Optional
+from config import config
+from utils.metrics import API_ERRORS, API_SECONDS, timed
 
 logger = logging.getLogger(__name__)
 
@@ -9,18 +11,20 @@ class BitcoinAPI:
     """Класс для работы с Bitcoin API"""
     
     @staticmethod
+    @timed(API_SECONDS, api="coingecko", method="get_btc_rate")
     async def get_btc_rate() -> Optional[float]:
         """Получение текущего курса BTC/RUB"""
         try:
             async with aiohttp.ClientSession() as session:
                 # Используем CoinGecko API
                 async with session.get(
-                    'https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=rub'
+                    f'{config.COINGECKO_API_URL}/simple/price?ids=bitcoin&vs_currencies=rub'
                 ) as response:
                     if response.status == 200:
                         data = await response.json()
                         return data['bitcoin']['rub']
         except Exception as e:
+            API_ERRORS.inc(api="coingecko", method="get_btc_rate")
             logger.error(f"Error fetching BTC rate: {e}")
         
         # Заглушка - примерный курс
@@ -0,0 +1,23 @@
+# utils/delivery.py
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+# Чаты, куда ничего не доставить, пока пользователь сам не напишет боту
+UNDELIVERABLE = ('blocked', 'deactivated', 'chat_not_found', 'forbidden')
+
+
+def classify_delivery_error(error: Exception) -> str:
+    """Класс ошибки отправки: blocked, deactivated, chat_not_found, forbidden, flood или error"""
+    if isinstance(error, TelegramRetryAfter):
+        return 'flood'
+    
+    message = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        # "bot was blocked by the user", "user is deactivated"
+        if 'deactivated' in message:
+            return 'deactivated'
+        if 'blocked' in message:
+            return 'blocked'
+        return 'forbidden'
+    if isinstance(error, TelegramBadRequest) and 'chat not found' in message:
+        return 'chat_not_found'
+    return 'error'
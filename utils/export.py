@@ -0,0 +1,45 @@
+# utils/export.py
+import asyncio
+import csv
+import gzip
+import os
+import tempfile
+from typing import AsyncIterator, List, Sequence
+
+
+class CsvGzipWriter:
+    """CSV в gzip-файле; BOM в начале, чтобы Excel открыл кириллицу"""
+
+    def __init__(self, path: str, header: Sequence[str]):
+        self._file = gzip.open(path, 'wt', encoding='utf-8-sig', newline='', compresslevel=6)
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+
+    def write(self, rows: List[Sequence]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+async def export_csv_gz(header: Sequence[str], chunks: AsyncIterator[List[Sequence]], prefix: str = 'export') -> tuple:
+    """Пишет пачки строк во временный .csv.gz, возвращает (путь, число строк).
+    
+    Запись и сжатие каждой пачки идут в отдельном потоке, в памяти только
+    текущая пачка; удалить файл после отправки должен вызывающий.
+    """
+    fd, path = tempfile.mkstemp(prefix=f'{prefix}-', suffix='.csv.gz')
+    os.close(fd)
+    total = 0
+    try:
+        writer = await asyncio.to_thread(CsvGzipWriter, path, header)
+        try:
+            async for rows in chunks:
+                await asyncio.to_thread(writer.write, rows)
+                total += len(rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, total
@@ -0,0 +1,75 @@
+# utils/logging_setup.py
+import atexit
+import json
+import logging
+import os
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+# Поля контекста, которые передаются через extra={...}
+CONTEXT_FIELDS = ('order_id', 'user_id', 'personal_id', 'onlypays_id', 'chat_id', 'latency_ms')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись лога - одна JSON-строка"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(log_dir: str = 'logs', level: str = 'INFO', max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 5, json_format: bool = True) -> QueueListener:
+    """Логи пишутся в фоновом потоке: в цикле событий запись только кладется в очередь"""
+    global _listener
+    if _listener:
+        return _listener
+    
+    os.makedirs(log_dir, exist_ok=True)
+    
+    file_handler = RotatingFileHandler(
+        os.path.join(log_dir, 'bot.log'),
+        maxBytes=max_bytes,
+        backupCount=backup_count,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level.upper())
+    
+    _listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает фоновый поток"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
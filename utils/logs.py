@@ -0,0 +1,99 @@
+# utils/logs.py
+import gzip
+import io
+import os
+import re
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+BLOCK_SIZE = 64 * 1024
+
+
+def list_log_files(directory: str = '.') -> List[Tuple[str, int]]:
+    """Лог-файлы каталога (включая ротированные) с размерами, одним проходом scandir"""
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if '.log' in entry.name and entry.is_file():
+                files.append((entry.name, entry.stat().st_size))
+    return sorted(files)
+
+
+def resolve_log_path(name: str, directory: str = '.') -> Optional[str]:
+    """Путь к лог-файлу внутри каталога или None; выход за пределы каталога запрещен"""
+    name = os.path.basename(name)
+    if '.log' not in name:
+        name += '.log'
+    path = os.path.join(directory, name)
+    return path if os.path.isfile(path) else None
+
+
+def tail_lines(path: str, count: int = 50) -> List[str]:
+    """Последние count строк файла: читаем блоки с конца, не загружая весь файл"""
+    if count <= 0:
+        return []
+    
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        blocks = []
+        newlines = 0
+        while position > 0 and newlines <= count:
+            step = min(BLOCK_SIZE, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step)
+            newlines += block.count(b'\n')
+            blocks.append(block)
+        data = b''.join(reversed(blocks))
+    
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    return lines[-count:]
+
+
+def _id_pattern(prefix: str, value: int) -> str:
+    # "order 12", "order_id=12", "заявка #12", JSON "order_id": 12
+    return rf'(?:{prefix})[\W_]{{0,5}}(?:id[\W_]{{0,3}})?{value}(?!\d)'
+
+
+def build_filter(order_id: int = None, user_id: int = None, level: str = None,
+                 text: str = None):
+    """Предикат для строки лога; все заданные условия должны выполняться"""
+    patterns = []
+    if order_id is not None:
+        patterns.append(re.compile(_id_pattern(r'order|заявк\w*|#', order_id), re.IGNORECASE))
+    if user_id is not None:
+        patterns.append(re.compile(_id_pattern(r'user|пользовател\w*|chat', user_id), re.IGNORECASE))
+    if level:
+        level = level.upper()
+        patterns.append(re.compile(rf'(?: - {level} - |"level(?:name)?": "{level}")'))
+    if text:
+        patterns.append(re.compile(re.escape(text), re.IGNORECASE))
+
+    def matches(line: str) -> bool:
+        return all(pattern.search(line) for pattern in patterns)
+    return matches
+
+
+def iter_matching_lines(path: str, **filters) -> Iterator[str]:
+    """Потоковый grep по файлу: в памяти только текущая строка"""
+    matches = build_filter(**filters)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if matches(line):
+                yield line.rstrip('\n')
+
+
+def grep_lines(path: str, limit: int = 50, **filters) -> List[str]:
+    """Последние limit совпадений фильтра"""
+    return list(deque(iter_matching_lines(path, **filters), maxlen=limit))
+
+
+def gzip_lines(lines: Iterable[str]) -> bytes:
+    """Сжимает строки в gzip для отправки документом"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as archive:
+        for line in lines:
+            archive.write(line.encode('utf-8') + b'\n')
+    return buffer.getvalue()
@@ -0,0 +1,77 @@
+# utils/loyalty.py
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+
+class LoyaltyProgram:
+    """Каждый every-й обмен на сумму до max_amount - без комиссии.
+    
+    Заработанные бесплатные обмены считаются по users.total_operations, выданные -
+    по users.loyalty_free_used (одна строка по user_id, история заявок не
+    читается). Признак "следующий обмен бесплатный" для расчетов кэшируется на
+    ttl секунд; завершение и отмена заявки сбрасывают запись (см. handlers.operator).
+    Сам бесплатный обмен выдается только через reserve() при создании заявки:
+    резерв атомарен в базе, поэтому вторая заявка, пока первая открыта, идет
+    с обычной комиссией, а отмена заявки резерв возвращает.
+    """
+
+    def __init__(self, db, every: int = 10, max_amount: float = 6000, ttl: float = 300.0,
+                 max_users: int = 10000):
+        self.db = db
+        self.every = every
+        self.max_amount = max_amount
+        self.ttl = ttl
+        self.max_users = max_users
+        # user_id -> (время истечения, следующий обмен бесплатный)
+        self._eligible: 'OrderedDict[int, Tuple[float, bool]]' = OrderedDict()
+
+    @property
+    def note(self) -> str:
+        """Строка о программе для экранов расчета; пустая, если программа выключена (every <= 0)"""
+        if self.every <= 0:
+            return ""
+        return f"🎁 <b>Без комиссии</b>: каждый {self.every}-й обмен до {self.max_amount:,.0f} ₽\n\n"
+
+    async def next_is_free(self, user_id: int) -> bool:
+        if self.every <= 0:
+            return False
+        
+        cached = self._eligible.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            self._eligible.move_to_end(user_id)
+            return cached[1]
+        
+        user = await self.db.get_user(user_id, fields=('total_operations', 'loyalty_free_used'))
+        completed = (user['total_operations'] or 0) if user else 0
+        used = (user['loyalty_free_used'] or 0) if user else 0
+        eligible = (completed + 1) // self.every > used
+        
+        self._eligible[user_id] = (time.monotonic() + self.ttl, eligible)
+        self._eligible.move_to_end(user_id)
+        if len(self._eligible) > self.max_users:
+            self._eligible.popitem(last=False)
+        return eligible
+
+    async def commission_for(self, user_id: int, rub_amount: float) -> Tuple[float, bool]:
+        """(процент комиссии, обмен бесплатный по программе) для расчета заявки"""
+        if rub_amount <= self.max_amount and await self.next_is_free(user_id):
+            return 0.0, True
+        return await self.db.get_commission_percentage(), False
+
+    async def reserve(self, user_id: int, rub_amount: float) -> Tuple[float, bool]:
+        """Как commission_for, но бесплатный обмен сразу резервируется за создаваемой заявкой"""
+        if self.every > 0 and rub_amount <= self.max_amount:
+            reserved = await self.db.reserve_free_exchange(user_id, self.every)
+            self.invalidate(user_id)
+            if reserved:
+                return 0.0, True
+        return await self.db.get_commission_percentage(), False
+
+    async def release(self, user_id: int):
+        """Возврат резерва, если заявка не была создана"""
+        await self.db.release_free_exchange(user_id)
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id: int):
+        self._eligible.pop(user_id, None)
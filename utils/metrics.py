@@ -0,0 +1,196 @@
+# utils/metrics.py
+import bisect
+import functools
+import inspect
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from aiohttp import web
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # По каждому набору меток: счетчики корзин (последняя - +Inf), сумма, количество
+        self.values: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def summary(self) -> List[Tuple[LabelValues, int, float, float]]:
+        """(метки, количество, среднее, оценка p95 по корзинам)"""
+        result = []
+        for key, (counts, total, count) in self.values.items():
+            threshold = count * 0.95
+            cumulative = 0
+            p95 = float('inf')
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                if cumulative >= threshold:
+                    p95 = bound
+                    break
+            result.append((key, count, total / count, p95))
+        return result
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.label_names, key, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+UPDATES_TOTAL = registry.register(Counter(
+    'bot_updates_total', 'Telegram updates received', ('event_type',)))
+UPDATE_SECONDS = registry.register(Histogram(
+    'bot_update_duration_seconds', 'Full update processing time', ('event_type',)))
+HANDLER_SECONDS = registry.register(Histogram(
+    'bot_handler_duration_seconds', 'Handler execution time', ('router', 'handler')))
+HANDLER_ERRORS = registry.register(Counter(
+    'bot_handler_errors_total', 'Handler exceptions', ('router', 'handler')))
+HANDLERS_IN_FLIGHT = registry.register(Gauge(
+    'bot_handlers_in_flight', 'Handlers currently running', ('router', 'handler')))
+DB_SECONDS = registry.register(Histogram(
+    'bot_db_call_duration_seconds', 'Database method execution time', ('method',)))
+DB_ERRORS = registry.register(Counter(
+    'bot_db_call_errors_total', 'Database method exceptions', ('method',)))
+API_SECONDS = registry.register(Histogram(
+    'bot_external_api_duration_seconds', 'External API call time', ('api', 'method')))
+API_ERRORS = registry.register(Counter(
+    'bot_external_api_errors_total', 'External API call errors', ('api', 'method')))
+ORDER_CACHE_REQUESTS = registry.register(Counter(
+    'bot_order_cache_requests_total', 'User order history cache lookups', ('result',)))
+
+
+def timed(histogram: Histogram, errors: Counter = None, **labels):
+    """Декоратор: время выполнения корутины в гистограмму, исключения - в счетчик"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if errors:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def instrument_methods(histogram: Histogram, errors: Counter = None, label: str = 'method'):
+    """Декоратор класса: оборачивает все публичные async-методы в timed"""
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if not name.startswith('_') and inspect.iscoroutinefunction(func):
+                setattr(cls, name, timed(histogram, errors, **{label: name})(func))
+        return cls
+    return decorator
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер с /metrics для режима polling"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
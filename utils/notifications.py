@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple, Union
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+from utils.delivery import UNDELIVERABLE, classify_delivery_error
+
+logger = logging.getLogger(__name__)
+
+Markup = Union[InlineKeyboardMarkup, ReplyKeyboardMarkup]
+
+# Строки очереди, которые собирает NotificationOutbox.collect вместо записи в БД
+_collected: ContextVar[Optional[List[Tuple]]] = ContextVar('collected_notifications', default=None)
+
+
+def dump_markup(reply_markup: Optional[Markup]) -> Optional[str]:
+    if reply_markup is None:
+        return None
+    return reply_markup.model_dump_json(exclude_none=True)
+
+
+def load_markup(data: Optional[str]) -> Optional[Markup]:
+    if not data:
+        return None
+    payload = json.loads(data)
+    if 'inline_keyboard' in payload:
+        return InlineKeyboardMarkup.model_validate(payload)
+    return ReplyKeyboardMarkup.model_validate(payload)
+
+
+class NotificationOutbox:
+    """Очередь уведомлений в БД с фоновой доставкой в Telegram"""
+
+    def __init__(self, db, rate_per_second: float = 25, chat_interval: float = 1.0,
+                 batch_size: int = 50, max_attempts: int = 5, idle_interval: float = 5.0):
+        self.db = db
+        self.send_interval = 1 / rate_per_second
+        self.chat_interval = chat_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.idle_interval = idle_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_sent: Dict[int, float] = {}
+
+    async def enqueue(self, chat_id: int, text: str, reply_markup: Markup = None,
+                      parse_mode: str = "HTML") -> Optional[int]:
+        """Ставит уведомление в очередь; внутри collect только добавляет строку в сборку"""
+        collected = _collected.get()
+        if collected is not None:
+            collected.append((chat_id, text, dump_markup(reply_markup), parse_mode))
+            return None
+        
+        notification_id = await self.db.enqueue_notification(
+            chat_id, text, dump_markup(reply_markup), parse_mode
+        )
+        self._wakeup.set()
+        return notification_id
+
+    @contextmanager
+    def collect(self):
+        """Собирает уведомления текущей задачи в список строк (chat_id, text, reply_markup, parse_mode).
+        
+        Строки записывает вызывающий код в своей транзакции, после коммита
+        доставку будит wakeup.
+        """
+        rows: List[Tuple] = []
+        token = _collected.set(rows)
+        try:
+            yield rows
+        finally:
+            _collected.reset(token)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        logger.info("Notification dispatcher started")
+        while True:
+            try:
+                batch = await self.db.get_due_notifications(self.batch_size)
+                if not batch:
+                    await self._sleep_until_due()
+                    continue
+                
+                sent_ids = []
+                try:
+                    for notification in batch:
+                        if await self._deliver(bot, notification):
+                            sent_ids.append(notification['id'])
+                finally:
+                    await self.db.mark_notifications_sent(sent_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Notification dispatcher error: {e}")
+                await asyncio.sleep(self.idle_interval)
+
+    async def _sleep_until_due(self):
+        self._wakeup.clear()
+        next_at = await self.db.get_next_notification_time()
+        timeout = self.idle_interval
+        if next_at is not None:
+            timeout = min(max(next_at - time.time(), 0), self.idle_interval)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _deliver(self, bot, notification: Dict) -> bool:
+        chat_id = notification['chat_id']
+        
+        # Не чаще одного сообщения в chat_interval для одного чата
+        wait = self._last_sent.get(chat_id, 0) + self.chat_interval - time.monotonic()
+        if wait > 0:
+            await self.db.reschedule_notification(notification['id'], wait, count_attempt=False)
+            return False
+        
+        try:
+            await bot.send_message(
+                chat_id,
+                notification['text'],
+                parse_mode=notification['parse_mode'],
+                reply_markup=load_markup(notification['reply_markup'])
+            )
+        except TelegramRetryAfter as e:
+            logger.warning(f"Flood control, retry after {e.retry_after}s")
+            await self.db.reschedule_notification(
+                notification['id'], e.retry_after, str(e), count_attempt=False
+            )
+            await asyncio.sleep(e.retry_after)
+            return False
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logger.error(f"Notification {notification['id']} to {chat_id} rejected: {e}", extra={'chat_id': chat_id})
+            await self.db.mark_notification_failed(notification['id'], str(e))
+            reason = classify_delivery_error(e)
+            if reason in UNDELIVERABLE:
+                await self.db.mark_undeliverable([(chat_id, reason)])
+            return False
+        except Exception as e:
+            attempts = notification['attempts'] + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"Notification {notification['id']} to {chat_id} failed: {e}", extra={'chat_id': chat_id})
+                await self.db.mark_notification_failed(notification['id'], str(e))
+            else:
+                await self.db.reschedule_notification(notification['id'], 2 ** attempts, str(e))
+            return False
+        
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        if len(self._last_sent) > 10000:
+            self._last_sent = {
+                chat: sent for chat, sent in self._last_sent.items()
+                if now - sent < self.chat_interval
+            }
+        await asyncio.sleep(self.send_interval)
+        return True
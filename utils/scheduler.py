@@ -0,0 +1,112 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TaskHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Повтор, если забрать задачи из базы не удалось
+CLAIM_RETRY_DELAY = 5.0
+
+
+class TaskScheduler:
+    """Отложенные задачи: куча в памяти с одним таймером, копия в scheduled_tasks для рестартов.
+    
+    Куча только будит таймер: выполняются задачи, которые узел забрал из
+    scheduled_tasks (claim_due_scheduled_tasks). Если таблица общая для
+    нескольких узлов, каждая задача выполняется один раз, в том числе
+    задачи, поставленные другим узлом.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._heap: List[Tuple[float, int, str, Dict[str, Any]]] = []
+        self._handlers: Dict[str, TaskHandler] = {}
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler: TaskHandler):
+        self._handlers[kind] = handler
+
+    def task(self, kind: str):
+        """Декоратор для регистрации обработчика задачи"""
+        def decorator(handler: TaskHandler) -> TaskHandler:
+            self.register(kind, handler)
+            return handler
+        return decorator
+
+    async def schedule(self, delay: float, kind: str, payload: Dict[str, Any] = None) -> int:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown scheduled task kind: {kind}")
+        
+        run_at = time.time() + delay
+        payload = payload or {}
+        task_id = await self.db.add_scheduled_task(kind, payload, run_at)
+        self._push(run_at, task_id, kind, payload)
+        return task_id
+
+    def has_pending(self, kind: str) -> bool:
+        return any(task[2] == kind for task in self._heap)
+
+    def _push(self, run_at: float, task_id: int, kind: str, payload: Dict[str, Any]):
+        heapq.heappush(self._heap, (run_at, task_id, kind, payload))
+        # Будим таймер, только если новая задача стала ближайшей
+        if self._heap[0][1] == task_id:
+            self._changed.set()
+
+    async def start(self):
+        if self._task and not self._task.done():
+            return
+        for task in await self.db.get_scheduled_tasks():
+            heapq.heappush(self._heap, (task['run_at'], task['id'], task['kind'], task['payload']))
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Task scheduler started, {len(self._heap)} pending tasks")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            due = []
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+            
+            try:
+                claimed = await self.db.claim_due_scheduled_tasks(now)
+            except Exception as e:
+                logger.error(f"Scheduled tasks claim error: {e}")
+                for _, task_id, kind, payload in due:
+                    heapq.heappush(self._heap, (now + CLAIM_RETRY_DELAY, task_id, kind, payload))
+                continue
+            
+            for task in claimed:
+                asyncio.create_task(self._execute(task['id'], task['kind'], task['payload']))
+
+    async def _execute(self, task_id: int, kind: str, payload: Dict[str, Any]):
+        handler = self._handlers.get(kind)
+        if not handler:
+            logger.error(f"No handler for scheduled task {task_id} ({kind})")
+            return
+        try:
+            await handler(payload)
+        except Exception as e:
+            logger.error(f"Scheduled task {task_id} ({kind}) error: {e}")
@@ -1,36 +1,27 @@
-# webhook.py
 import logging
 from aiohttp import web
-from database.models import Database
-from config import config
+from handlers.operator import process_onlypays_webhook
+from utils.metrics import metrics_handler
 
 async def handle_payment_notification(request):
     try:
         data = await request.json()
-        order_id = data.get("id")
-        status = data.get("status")
-        personal_id = data.get("personal_id")
-        received_sum = data.get("received_sum")
-
-        db = Database(config.DATABASE_URL)
-        if status == "finished":
-            await db.update_order(personal_id, status="finished", received_sum=received_sum)
-            order = await db.get_order(personal_id)
-            if order:
-                await bot.send_message(
-                    order["user_id"],
-                    f"✅ Заявка #{personal_id} выполнена!\n"
-                    f"Получено: {received_sum:,.0f} ₽\n"
-                    f"Bitcoin {'отправлен на адрес' if order['direction'] == 'rub_to_crypto' else 'получен'}.",
-                    parse_mode="HTML"
-                )
+        # Статус меняется через машину состояний: дубликаты и гонки отсекаются в БД
+        await process_onlypays_webhook(data)
         return web.json_response({"success": True})
-    except Exception as e:
+    except (ValueError, TypeError) as e:
         logging.error(f"Notification error: {e}")
         return web.json_response({"success": False, "error": str(e)}, status=400)
+    except Exception as e:
+        # Сбой БД и т.п.: ответ 5xx, OnlyPays повторит уведомление
+        logging.error(f"Notification error: {e}")
+        return web.json_response({"success": False, "error": str(e)}, status=500)
 
 app = web.Application()
-app.add_routes([web.post("/onlypays/notification", handle_payment_notification)])
+app.add_routes([
+    web.post("/onlypays/notification", handle_payment_notification),
+    web.get("/metrics", metrics_handler)
+])
 
 async def start_webhook():
     runner = web.AppRunner(app)